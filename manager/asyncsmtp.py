@@ -0,0 +1,244 @@
+import asynchat
+import base64
+import errno
+import logging
+import smtplib
+import socket
+import ssl
+import time
+
+log = logging.getLogger(__name__)
+
+class SMTPSession(asynchat.async_chat):
+	'''
+		A non-blocking SMTP client connection for an asyncore loop. It logs in
+		and then sends one message at a time. Many sessions can share a single
+		loop since none of them ever block waiting on the server.
+
+		The owner is told how things go through these callbacks:
+
+			session_ready(session)                       ready for a message
+			session_sent(session, item)                  item was accepted
+			session_refused(session, item, code, reply)  item was refused
+			session_closed(session, item)                connection is gone,
+			                                             item is None if the
+			                                             session was idle
+	'''
+
+	CONNECTING, HANDSHAKE, GREETING, EHLO, HELO, AUTH, READY, MAIL, RCPT, DATA, MESSAGE, RSET, QUIT = range(0, 13)
+
+	def __init__(self, owner, host, port, username='', password='', use_ssl=True, map=None):
+		asynchat.async_chat.__init__(self, map=map)
+		self.owner         = owner
+		self.username      = username
+		self.password      = password
+		self.use_ssl       = use_ssl
+		self.state         = self.CONNECTING
+		self.item          = None
+		self.logged_in     = False
+		self.last_activity = time.time()
+		self._lines        = []
+		self._reply        = []
+		self._closed       = False
+		self._want_write   = False
+		self.set_terminator('\r\n')
+		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.connect((host, port))
+
+	@property
+	def waiting(self):
+		'''
+			Waiting on the server, as opposed to waiting for a message
+		'''
+		return self.state != self.READY
+
+	def start(self, item, from_address, to_address, msg):
+		'''
+			Send msg. item is handed back in the callback that says how it went.
+		'''
+		self.item = item
+		self._to  = to_address
+		self._msg = msg
+		self._command(self.MAIL, 'MAIL FROM:%s' % smtplib.quoteaddr(from_address))
+
+	def quit(self):
+		self._command(self.QUIT, 'QUIT')
+		self.close_when_done()
+
+	def _command(self, state, command):
+		self.state         = state
+		self.last_activity = time.time()
+		self.push(str(command) + '\r\n')
+
+	def _ready(self):
+		self.state     = self.READY
+		self.logged_in = True
+		self.owner.session_ready(self)
+
+	def _done(self, callback, *args):
+		item, self.item, self._msg = self.item, None, None
+		callback(self, item, *args)
+
+	def handle_connect(self):
+		if self.use_ssl:
+			self.state  = self.HANDSHAKE
+			self.socket = ssl.wrap_socket(self.socket, do_handshake_on_connect=False)
+			self._handshake()
+		else:
+			self.state = self.GREETING
+
+	def _handshake(self):
+		try:
+			self.socket.do_handshake()
+		except ssl.SSLError, e:
+			if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+				self._want_write = e.args[0] == ssl.SSL_ERROR_WANT_WRITE
+				return
+			raise
+		self._want_write = False
+		self.state       = self.GREETING
+
+	def handle_read(self):
+		if self.state == self.HANDSHAKE:
+			self._handshake()
+			return
+		asynchat.async_chat.handle_read(self)
+		# Data already decrypted by the SSL layer doesn't wake up select()
+		while self.use_ssl and not self._closed and self.socket.pending() > 0:
+			asynchat.async_chat.handle_read(self)
+
+	def handle_write(self):
+		if self.state == self.HANDSHAKE:
+			self._handshake()
+			return
+		asynchat.async_chat.handle_write(self)
+
+	def writable(self):
+		if self.state == self.HANDSHAKE:
+			return self._want_write
+		return asynchat.async_chat.writable(self)
+
+	def recv(self, buffer_size):
+		try:
+			data = self.socket.recv(buffer_size)
+		except ssl.SSLError, e:
+			if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+				return ''
+			raise
+		except socket.error, e:
+			if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+				return ''
+			raise
+		if not data:
+			self.handle_close()
+		return data
+
+	def send(self, data):
+		try:
+			return self.socket.send(data)
+		except ssl.SSLError, e:
+			if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+				return 0
+			raise
+		except socket.error, e:
+			if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+				return 0
+			raise
+
+	def collect_incoming_data(self, data):
+		self._lines.append(data)
+
+	def found_terminator(self):
+		line, self._lines = ''.join(self._lines), []
+		self.last_activity = time.time()
+		try:
+			code = int(line[:3])
+		except ValueError:
+			log.error('Unexpected reply from the SMTP server: %r' % line)
+			self.handle_close()
+			return
+		self._reply.append(line[4:].strip())
+		if line[3:4] == '-':
+			# More lines to come
+			return
+		reply, self._reply = '\n'.join(self._reply), []
+		self._handle_reply(code, reply)
+
+	def _handle_reply(self, code, reply):
+		state = self.state
+		if code == 421:
+			# The server is closing the connection. Same as a disconnect.
+			self.handle_close()
+		elif state == self.GREETING:
+			if code != 220:
+				self._fail_connection(code, reply)
+			else:
+				self._command(self.EHLO, 'EHLO %s' % socket.getfqdn())
+		elif state == self.EHLO and code != 250:
+			# Not an ESMTP server
+			self._command(self.HELO, 'HELO %s' % socket.getfqdn())
+		elif state in (self.EHLO, self.HELO):
+			if code != 250:
+				self._fail_connection(code, reply)
+			elif self.username:
+				self._command(self.AUTH, 'AUTH PLAIN %s' % base64.b64encode('\0%s\0%s' % (self.username, self.password)))
+			else:
+				self._ready()
+		elif state == self.AUTH:
+			if code != 235:
+				self._fail_connection(code, reply)
+			else:
+				self._ready()
+		elif state == self.MAIL:
+			if code != 250:
+				self._refused(code, reply)
+			else:
+				self._command(self.RCPT, 'RCPT TO:%s' % smtplib.quoteaddr(self._to))
+		elif state == self.RCPT:
+			if code not in (250, 251):
+				self._refused(code, reply)
+			else:
+				self._command(self.DATA, 'DATA')
+		elif state == self.DATA:
+			if code != 354:
+				self._refused(code, reply)
+			else:
+				data = smtplib.quotedata(self._msg)
+				if data[-2:] != '\r\n':
+					data += '\r\n'
+				self._command(self.MESSAGE, data + '.')
+		elif state == self.MESSAGE:
+			if code != 250:
+				self._refused(code, reply)
+			else:
+				self._done(self.owner.session_sent)
+				self._ready()
+		elif state == self.RSET:
+			if code != 250:
+				self._fail_connection(code, reply)
+			else:
+				self._ready()
+		elif state == self.QUIT:
+			self.handle_close()
+
+	def _refused(self, code, reply):
+		self._done(self.owner.session_refused, code, reply)
+		if not self._closed:
+			self._command(self.RSET, 'RSET')
+
+	def _fail_connection(self, code, reply):
+		log.error('SMTP server refused the connection: %d %s' % (code, reply))
+		self.handle_close()
+
+	def handle_error(self):
+		log.exception('SMTP session error')
+		self.handle_close()
+
+	def handle_close(self):
+		if self._closed:
+			return
+		self._closed = True
+		self.close()
+		item, self.item, self._msg = self.item, None, None
+		if self.state != self.QUIT:
+			self.owner.session_closed(self, item)
@@ -0,0 +1,80 @@
+from django.core.management.base import CommandError
+from django.db                   import connection
+from django.db.backends          import BaseDatabaseWrapper
+import multiprocessing
+
+def percentile(values, percent):
+	'''
+		The value percent (e.g. 99) percent of values are at or below, 0 if
+		there are none
+	'''
+	if len(values) == 0:
+		return 0
+	values = sorted(values)
+	return values[min(len(values) - 1, len(values) * percent / 100)]
+
+def create_test_db():
+	'''
+		Create the test database to benchmark against. Returns the name of
+		the real database, to pass to destroy_test_db(). Sending and
+		tracking use the database from other threads and processes, which
+		would each get a separate, empty in-memory SQLite database, so that
+		is refused.
+	'''
+	old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+	if connection.settings_dict['NAME'] == ':memory:':
+		connection.creation.destroy_test_db(old_database_name, verbosity=0)
+		raise CommandError('The test database is an in-memory SQLite database. Set its TEST_NAME to a file.')
+	return old_database_name
+
+class QueryCounter(object):
+	'''
+		Counts the database queries made by every thread and worker process
+		while installed. Unlike DEBUG, it doesn't keep a log of them, which
+		would grow with every query.
+	'''
+
+	def __init__(self):
+		self.count     = multiprocessing.Value('l', 0)
+		self._original = None
+
+	def install(self):
+		self._original = BaseDatabaseWrapper.__dict__['cursor']
+		original, count = self._original, self.count
+
+		def cursor(wrapper):
+			return CountingCursor(original(wrapper), count)
+
+		BaseDatabaseWrapper.cursor = cursor
+
+	def uninstall(self):
+		if self._original is not None:
+			BaseDatabaseWrapper.cursor = self._original
+			self._original = None
+
+class CountingCursor(object):
+	'''
+		Adds each query made through cursor to count
+	'''
+
+	def __init__(self, cursor, count):
+		self._cursor = cursor
+		self._count  = count
+
+	def _counted(self):
+		with self._count.get_lock():
+			self._count.value += 1
+
+	def execute(self, *args, **kwargs):
+		self._counted()
+		return self._cursor.execute(*args, **kwargs)
+
+	def executemany(self, *args, **kwargs):
+		self._counted()
+		return self._cursor.executemany(*args, **kwargs)
+
+	def __getattr__(self, attr):
+		return getattr(self._cursor, attr)
+
+	def __iter__(self):
+		return iter(self._cursor)
@@ -0,0 +1,129 @@
+from django.conf import settings
+import logging
+import os
+import smtplib
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class SMTPConnectionPool(object):
+	'''
+		Keeps logged in SMTP connections around so they can be reused instead
+		of paying for the TLS handshake and AUTH for every connection. Idle
+		connections are checked with a NOOP before being handed out again and
+		are recycled after max_messages messages.
+	'''
+
+	class ConnectionException(Exception):
+		pass
+
+	# Connections idle for longer than this are checked with a NOOP
+	_NOOP_AFTER = 5
+
+	_shared      = None
+	_shared_lock = threading.Lock()
+
+	def __init__(self, host, port, username='', password='', ssl=True, max_messages=1000):
+		self.host         = host
+		self.port         = port
+		self.username     = username
+		self.password     = password
+		self.ssl          = ssl
+		self.max_messages = max_messages
+		self._idle        = []
+		self._lock        = threading.Lock()
+		self._pid         = os.getpid()
+
+	@classmethod
+	def shared(cls):
+		'''
+			The process wide pool for the AMAZON_SMTP setting. Setting ssl to
+			False in AMAZON_SMTP allows a plain SMTP server (e.g. python -m smtpd)
+			to be used for testing.
+		'''
+		with cls._shared_lock:
+			if cls._shared is None:
+				cls._shared = cls(
+					settings.AMAZON_SMTP['host'],
+					settings.AMAZON_SMTP['port'],
+					username     = settings.AMAZON_SMTP['username'],
+					password     = settings.AMAZON_SMTP['password'],
+					ssl          = settings.AMAZON_SMTP.get('ssl', True),
+					max_messages = settings.AMAZON_SMTP.get('max_messages', 1000))
+			return cls._shared
+
+	def _connect(self):
+		try:
+			if self.ssl:
+				connection = smtplib.SMTP_SSL(self.host, self.port)
+			else:
+				connection = smtplib.SMTP(self.host, self.port)
+			if self.username:
+				connection.login(self.username, self.password)
+		except (smtplib.SMTPException, IOError), e:
+			log.exception('Unable to connect to %s:%s' % (self.host, self.port))
+			raise self.ConnectionException(str(e))
+		connection.messages_sent = 0
+		return connection
+
+	def _close(self, connection):
+		try:
+			connection.quit()
+		except (smtplib.SMTPException, IOError):
+			connection.close()
+
+	def get(self):
+		'''
+			Check out a connection, connecting a new one if none are idle.
+			Raises ConnectionException if a new connection can't be made.
+		'''
+		while True:
+			with self._lock:
+				if self._pid != os.getpid():
+					# Forked. The idle connections belong to the parent
+					# process so leave them alone.
+					self._idle = []
+					self._pid  = os.getpid()
+				if len(self._idle) == 0:
+					break
+				connection, returned = self._idle.pop()
+
+			if time.time() - returned > self._NOOP_AFTER:
+				try:
+					if connection.noop()[0] != 250:
+						raise smtplib.SMTPServerDisconnected()
+				except (smtplib.SMTPException, IOError):
+					connection.close()
+					continue
+			return connection
+		return self._connect()
+
+	def put(self, connection, sent=1):
+		'''
+			Check a connection back in after sending sent messages with it.
+		'''
+		connection.messages_sent += sent
+		if connection.messages_sent >= self.max_messages:
+			self._close(connection)
+		else:
+			with self._lock:
+				self._idle.append((connection, time.time()))
+
+	def discard(self, connection):
+		'''
+			Throw away a connection that has errored (e.g. SMTPServerDisconnected).
+		'''
+		try:
+			connection.close()
+		except (smtplib.SMTPException, IOError):
+			pass
+
+	def close(self):
+		'''
+			Close all the idle connections.
+		'''
+		with self._lock:
+			idle, self._idle = self._idle, []
+		for connection, returned in idle:
+			self._close(connection)
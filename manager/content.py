@@ -0,0 +1,112 @@
+from django.conf import settings
+import logging
+import requests
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class ContentFetcher(object):
+	'''
+		Fetches the content of emails over HTTP. Connections are kept alive
+		and reused between fetches. Responses are kept in a cache with their
+		ETag/Last-Modified headers so content that hasn't changed since it
+		was last fetched only costs a 304. Each fetch has to be done within
+		timeout seconds so a slow server can't hold up sending.
+
+		The cache needs lookup(uri), returning an object with etag,
+		last_modified and content attributes or None, and
+		store(uri, etag, last_modified, content).
+	'''
+
+	class TimeoutException(IOError):
+		pass
+
+	_CHUNK_SIZE = 16 * 1024
+
+	_shared      = None
+	_shared_lock = threading.Lock()
+
+	def __init__(self, cache=None, timeout=60):
+		self.cache    = cache
+		self.timeout  = timeout
+		self._session = requests.Session()
+
+	@classmethod
+	def shared(cls, cache=None):
+		'''
+			The process wide fetcher. The CONTENT_TIMEOUT setting is the
+			timeout.
+		'''
+		with cls._shared_lock:
+			if cls._shared is None:
+				cls._shared = cls(cache, timeout=getattr(settings, 'CONTENT_TIMEOUT', 60))
+			return cls._shared
+
+	def fetch(self, *uris):
+		'''
+			Fetch the content of all the uris at the same time. Returns the
+			content as unicode in the same order. Raises IOError if any of them
+			can't be fetched.
+		'''
+		# The cache is only used from this thread
+		cached  = [self.cache.lookup(uri) if self.cache is not None else None for uri in uris]
+		results = [None] * len(uris)
+
+		def fetch_one(index):
+			try:
+				results[index] = self._get(uris[index], cached[index])
+			except IOError, e:
+				results[index] = e
+
+		threads = [threading.Thread(target=fetch_one, args=(index,)) for index in range(1, len(uris))]
+		for thread in threads:
+			thread.start()
+		fetch_one(0)
+		for thread in threads:
+			thread.join()
+
+		contents = []
+		for uri, result in zip(uris, results):
+			if isinstance(result, IOError):
+				raise result
+			content, validators = result
+			if validators is not None and self.cache is not None:
+				self.cache.store(uri, validators[0], validators[1], content)
+			contents.append(content)
+		return contents
+
+	def _get(self, uri, cached):
+		'''
+			Returns the content and, if it should be cached, its ETag and
+			Last-Modified headers
+		'''
+		headers = {}
+		if cached is not None:
+			if cached.etag:
+				headers['If-None-Match'] = cached.etag
+			if cached.last_modified:
+				headers['If-Modified-Since'] = cached.last_modified
+
+		deadline = time.time() + self.timeout
+		response = self._session.get(uri, headers=headers, timeout=self.timeout, stream=True)
+		try:
+			if response.status_code == 304 and cached is not None:
+				log.debug('%s has not changed' % uri)
+				return cached.content, None
+			response.raise_for_status()
+
+			# The timeout above only covers each read
+			chunks = []
+			for chunk in response.iter_content(self._CHUNK_SIZE):
+				if time.time() > deadline:
+					raise self.TimeoutException('Fetching %s took longer than %d seconds' % (uri, self.timeout))
+				chunks.append(chunk)
+		finally:
+			response.close()
+
+		content = unicode(''.join(chunks), response.encoding or 'utf-8', 'replace')
+		etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+		if etag or last_modified:
+			return content, (etag, last_modified)
+		return content, None
@@ -1,5 +1,8 @@
 from django.core.management.base import BaseCommand
-from manager.models              import Email
+from optparse                    import make_option
+from manager.models              import Email, Instance
+from manager.sending             import ENGINES
+from manager.scheduling          import Scheduler, ConcurrentSends
 from datetime                    import datetime
 import logging
 
@@ -9,13 +12,72 @@ log = logging.getLogger(__name__)
 class Command(BaseCommand):
 	'''
 		Handles sending emails. Should be set to run according to the
-		PROCESSING_INTERVAL_DURATION setting in settings_local.py
+		PROCESSING_INTERVAL_DURATION setting in settings_local.py, or run
+		once with --daemon to keep running and send emails as they come due.
 	'''
 
+	option_list = BaseCommand.option_list + (
+		make_option(
+			'--processes',
+			action  = 'store',
+			type    = 'int',
+			dest    = 'processes',
+			default = 1,
+			help    = 'Number of worker processes to split each instance\'s recipients between. The default of 1 sends from this process.'
+		),
+		make_option(
+			'--engine',
+			action  = 'store',
+			type    = 'choice',
+			choices = sorted(ENGINES.keys()),
+			dest    = 'engine',
+			default = 'threads',
+			help    = 'How to send: threads (one SMTP connection per thread) or eventloop (many SMTP sessions on one event loop). The default is threads.'
+		),
+		make_option(
+			'--resume',
+			action  = 'store_true',
+			dest    = 'resume',
+			default = False,
+			help    = 'First finish sending instances that were interrupted, e.g. by mailer-process dying part way through.'
+		),
+		make_option(
+			'--daemon',
+			action  = 'store_true',
+			dest    = 'daemon',
+			default = False,
+			help    = 'Keep running and send previews and emails as they come due instead of sending what is due in this processing interval and exiting.'
+		),
+		make_option(
+			'--prerender',
+			action  = 'store_true',
+			dest    = 'prerender',
+			default = False,
+			help    = 'Render the messages of each email into a spool when its previews go out (PREVIEW_LEAD_TIME ahead) so sending only has to stream them.'
+		),
+	)
+
 	def handle(self, *args, **options):
 		log.info('The mailer-process command is starting...')
 
-		now       = datetime.now()
+		now = datetime.now()
+
+		Instance.objects.clean_spool(now=now)
+
+		# Everything is sent at the same time, sharing the sending rate
+		sends = ConcurrentSends()
+
+		if options['resume']:
+			interrupted = Instance.objects.interrupted(now=now)
+			log.info('There is/are %d interrupted instance(s) to resume.' % len(interrupted))
+			for instance in interrupted:
+				log.info('Resuming the following email now: %s' % instance.email.title)
+				sends.start(instance.email.title, instance.resume, processes=options['processes'], engine=options['engine'])
+
+		if options['daemon']:
+			log.info('Scheduling emails to send as they come due.')
+			Scheduler(processes=options['processes'], engine=options['engine'], prerender=options['prerender']).run()
+
 		previews  = Email.objects.previewing_now(now=now)
 		instances = Email.objects.sending_now(now=now)
 
@@ -24,9 +86,17 @@ class Command(BaseCommand):
 			log.info('Previewing the following email now: %s ' % email.title)
 			email.send_preview()
 
+		if options['prerender']:
+			prerenders = Email.objects.prerendering_now(now=now)
+			log.info('There is/are %d email(s) to prerender.' % len(prerenders))
+			for email in prerenders:
+				log.info('Prerendering the following email now: %s' % email.title)
+				sends.start(email.title, email.prerender)
+
 		log.info('There is/are %d instance(s) to send.' % len(instances))
 		for email in instances:
 			log.info('Sending the following email now: %s' % email.title)
-			email.send()
+			sends.start(email.title, email.send, processes=options['processes'], engine=options['engine'])
+		sends.wait()
 
 		log.info('The mailer-process command is finished.')
\ No newline at end of file
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db                   import connection
+from optparse                    import make_option
+from manager.tracking            import TrackingBuffer
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+	'''
+		Writes the URL clicks and opens buffered by the tracking views to the
+		database. Should be scheduled to run every minute or so, or run once
+		with --daemon to keep writing them as they come in.
+	'''
+
+	option_list = BaseCommand.option_list + (
+		make_option(
+			'--daemon',
+			action  = 'store_true',
+			dest    = 'daemon',
+			default = False,
+			help    = 'Keep running and write what has been buffered every --interval seconds instead of writing it once and exiting.'
+		),
+		make_option(
+			'--interval',
+			action  = 'store',
+			type    = 'float',
+			dest    = 'interval',
+			default = 5,
+			help    = 'Seconds between writes with --daemon. The default is 5.'
+		),
+	)
+
+	def handle(self, *args, **options):
+		buffer = TrackingBuffer.shared()
+		while True:
+			start = time.time()
+			try:
+				clicks, opens = buffer.consume()
+			except Exception:
+				if not options['daemon']:
+					raise
+				# Whatever wasn't recorded is tried again next time
+				log.exception('Unable to record the buffered clicks and opens')
+			else:
+				if clicks > 0 or opens > 0:
+					log.info('Recorded %d click(s) and %d open(s) in %.2fs.' % (clicks, opens, time.time() - start))
+			if not options['daemon']:
+				break
+			# Don't hold on to a connection the database might drop while idle
+			connection.close()
+			time.sleep(options['interval'])
@@ -0,0 +1,268 @@
+from django.core.management.base import BaseCommand
+from optparse                    import make_option
+from django.conf                 import settings
+from django.db                   import connection
+from manager.models              import Email, Instance, Recipient, RecipientAttribute, RecipientGroup
+from manager.benchmarking        import QueryCounter, create_test_db, percentile
+from datetime                    import datetime
+import asyncore
+import BaseHTTPServer
+import logging
+import resource
+import smtpd
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+	'''
+		Measures how fast an email is sent without sending any mail or
+		touching the real database. A test database is filled with synthetic
+		recipients, the content is served by a local HTTP server and the
+		mail goes to a local SMTP sink that can throttle and disconnect the
+		way Amazon does.
+	'''
+
+	help = 'Benchmark Email.send() against a local SMTP sink.'
+
+	option_list = BaseCommand.option_list + (
+		make_option(
+			'--recipients',
+			action  = 'store',
+			type    = 'int',
+			dest    = 'recipients',
+			default = 1000,
+			help    = 'Number of synthetic recipients to send to. The default is 1000.'
+		),
+		make_option(
+			'--links',
+			action  = 'store',
+			type    = 'int',
+			dest    = 'links',
+			default = 20,
+			help    = 'Number of tracked links in the email. The default is 20.'
+		),
+		make_option(
+			'--rate',
+			action  = 'store',
+			type    = 'int',
+			dest    = 'rate',
+			default = 1000,
+			help    = 'Sending rate per second to allow instead of AMAZON_SMTP[\'rate\']. The default is 1000.'
+		),
+		make_option(
+			'--processes',
+			action  = 'store',
+			type    = 'int',
+			dest    = 'processes',
+			default = 1,
+			help    = 'Same as mailer-process --processes.'
+		),
+		make_option(
+			'--engine',
+			action  = 'store',
+			dest    = 'engine',
+			default = 'threads',
+			help    = 'Same as mailer-process --engine.'
+		),
+		make_option(
+			'--throttle-every',
+			action  = 'store',
+			type    = 'int',
+			dest    = 'throttle_every',
+			default = 0,
+			help    = 'Reject every nth message for exceeding the sending rate. The default of 0 never does.'
+		),
+		make_option(
+			'--disconnect-every',
+			action  = 'store',
+			type    = 'int',
+			dest    = 'disconnect_every',
+			default = 0,
+			help    = 'Drop the connection instead of accepting every nth message. The default of 0 never does.'
+		),
+	)
+
+	def handle(self, *args, **options):
+		old_database_name = create_test_db()
+		old_amazon_smtp   = settings.AMAZON_SMTP
+		content           = ContentServer(options['links'])
+		sink              = SMTPSink(options['throttle_every'], options['disconnect_every'])
+		queries           = QueryCounter()
+		try:
+			settings.AMAZON_SMTP = dict(
+				old_amazon_smtp,
+				host     = '127.0.0.1',
+				port     = sink.port,
+				username = '',
+				password = '',
+				ssl      = False,
+				rate     = options['rate'],
+				quota    = options['recipients'] * 10)
+
+			print 'Creating %d recipients...' % options['recipients']
+			email = self._create_email(content, options['recipients'])
+
+			print 'Sending...'
+			queries.install()
+			start = time.time()
+			email.send(processes=options['processes'], engine=options['engine'])
+			elapsed = time.time() - start
+			queries.uninstall()
+
+			instance = Instance.objects.get(email=email)
+			sent     = instance.recipient_details.exclude(when=None).count()
+			print 'Recipients:      %d' % options['recipients']
+			print 'Sent:            %d (%d accepted by the sink)' % (sent, sink.accepted)
+			print 'Elapsed:         %.2fs' % elapsed
+			print 'Messages/second: %.1f' % (sent / max(elapsed, .001))
+			print 'Latency p50:     %.1fms' % (sink.percentile(50) * 1000)
+			print 'Latency p99:     %.1fms' % (sink.percentile(99) * 1000)
+			print 'Throttled:       %d (%d injected)' % (instance.throttle_count, sink.throttled)
+			print 'Disconnected:    %d injected' % sink.disconnected
+			print 'Queries:         %d' % queries.count.value
+			print 'Peak RSS:        %dKB (largest worker process %dKB)' % (
+				resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+				resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+		finally:
+			queries.uninstall()
+			settings.AMAZON_SMTP = old_amazon_smtp
+			content.close()
+			sink.close()
+			connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+	def _create_email(self, content, count, batch_size=500):
+		group = RecipientGroup.objects.create(name='Benchmark')
+		for start in xrange(0, count, batch_size):
+			addresses = ['recipient%d@example.com' % i for i in xrange(start, min(start + batch_size, count))]
+			Recipient.objects.bulk_create([Recipient(email_address=address) for address in addresses])
+
+			recipient_ids = Recipient.objects.filter(email_address__in=addresses).values_list('pk', flat=True)
+			RecipientAttribute.objects.bulk_create(
+				[RecipientAttribute(recipient_id=recipient_id, name='First Name', value='First%d' % recipient_id) for recipient_id in recipient_ids] +
+				[RecipientAttribute(recipient_id=recipient_id, name='City', value='Orlando') for recipient_id in recipient_ids])
+			RecipientGroup.recipients.through.objects.bulk_create(
+				[RecipientGroup.recipients.through(recipientgroup_id=group.pk, recipient_id=recipient_id) for recipient_id in recipient_ids])
+
+		now   = datetime.now()
+		email = Email.objects.create(
+			active             = True,
+			title              = 'Benchmark',
+			subject            = 'Benchmark',
+			source_html_uri    = content.url('html'),
+			source_text_uri    = content.url('text'),
+			start_date         = now.date(),
+			send_time          = now.time(),
+			from_email_address = 'benchmark@example.com',
+			from_friendly_name = 'Benchmark',
+			track_urls         = True,
+			track_opens        = True,
+			preview            = False
+		)
+		email.recipient_groups.add(group)
+		return email
+
+class ContentServer(object):
+	'''
+		Serves the html and text of the email from a local HTTP server
+	'''
+
+	def __init__(self, links):
+		html = '\n'.join(
+			['<html><body>', '<p>Hello !@!First Name!@!,</p>', '<p>Greetings from !@!City!@!</p>'] +
+			['<p><a href="http://example.com/article/%d">Article %d</a></p>' % (i, i) for i in xrange(0, links)] +
+			['!@!UNSUBSCRIBE!@!', '</body></html>'])
+		text = 'Hello,\n\nThis is the text version of the email.\n'
+
+		class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = html if self.path.endswith('html') else text
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/html; charset=us-ascii')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		self._server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+		self._thread = threading.Thread(target=self._server.serve_forever, name='ContentServer')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def url(self, name):
+		return 'http://127.0.0.1:%d/%s' % (self._server.server_address[1], name)
+
+	def close(self):
+		self._server.shutdown()
+		self._server.server_close()
+
+class SMTPSink(smtpd.SMTPServer):
+	'''
+		Accepts and throws away mail. Every throttle_every-th message is
+		rejected the way Amazon rejects messages for exceeding the sending
+		rate and every disconnect_every-th connection is dropped instead of
+		accepting the message. The time from MAIL to the end of DATA is kept
+		for each message.
+	'''
+
+	THROTTLED = '454 Throttling failure: Maximum sending rate exceeded.'
+
+	class Channel(smtpd.SMTPChannel):
+		def smtp_MAIL(self, arg):
+			self.started = time.time()
+			smtpd.SMTPChannel.smtp_MAIL(self, arg)
+
+		def found_terminator(self):
+			if self._SMTPChannel__state != self.DATA:
+				smtpd.SMTPChannel.found_terminator(self)
+			elif self._SMTPChannel__server.disconnect():
+				self.close()
+			else:
+				smtpd.SMTPChannel.found_terminator(self)
+				self._SMTPChannel__server.latencies.append(time.time() - self.started)
+
+	def __init__(self, throttle_every, disconnect_every):
+		smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+		# Sending opens lots of connections at once
+		self.listen(512)
+		self.port             = self.socket.getsockname()[1]
+		self.throttle_every   = throttle_every
+		self.disconnect_every = disconnect_every
+		self.messages         = 0
+		self.accepted         = 0
+		self.throttled        = 0
+		self.disconnected     = 0
+		self.latencies        = []
+		self._thread          = threading.Thread(target=asyncore.loop, kwargs={'timeout':.1, 'use_poll':True}, name='SMTPSink')
+		self._thread.daemon   = True
+		self._thread.start()
+
+	def handle_accept(self):
+		pair = self.accept()
+		if pair is not None:
+			conn, addr = pair
+			self.Channel(self, conn, addr)
+
+	def disconnect(self):
+		self.messages += 1
+		if self.disconnect_every and self.messages % self.disconnect_every == 0:
+			self.disconnected += 1
+			return True
+		return False
+
+	def process_message(self, peer, mailfrom, rcpttos, data):
+		if self.throttle_every and self.messages % self.throttle_every == 0:
+			self.throttled += 1
+			return self.THROTTLED
+		self.accepted += 1
+
+	def percentile(self, percent):
+		return percentile(self.latencies, percent)
+
+	def close(self):
+		smtpd.SMTPServer.close(self)
+		# Close the connections too
+		asyncore.close_all()
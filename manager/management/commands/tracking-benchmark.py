@@ -0,0 +1,324 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse                    import make_option
+from django.conf                 import settings
+from django.db                   import connection
+from django.core.urlresolvers    import reverse
+from django.core.handlers.wsgi   import WSGIHandler
+from django.test.client          import Client
+from manager.models              import Email, Instance, Recipient, URL
+from manager.tracking            import TrackingBuffer, TrackingApplication
+from manager.benchmarking        import QueryCounter, create_test_db, percentile
+from util                        import calc_link_mac, calc_open_mac
+from datetime                    import datetime
+from wsgiref                     import simple_server
+import httplib
+import json
+import logging
+import random
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import urllib
+
+log = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+	'''
+		Measures how many opens and clicks per second the tracking endpoints
+		handle and how long each takes, without touching the real database
+		or buffer. A test database is filled with a synthetic instance,
+		recipients and tracked URLs, and requests for properly signed open
+		and redirect URLs are replayed against the endpoints at the given
+		concurrency.
+	'''
+
+	help = 'Benchmark the open and redirect tracking endpoints.'
+
+	TARGETS = ('client', 'django', 'tracking')
+
+	option_list = BaseCommand.option_list + (
+		make_option(
+			'--target',
+			action  = 'store',
+			type    = 'choice',
+			choices = TARGETS,
+			dest    = 'target',
+			default = 'client',
+			help    = 'What to send the requests to: client (the Django test client, in this process), django (apache/python.wsgi on a local WSGI server) or tracking (apache/tracking.wsgi on a local WSGI server). The default is client.'
+		),
+		make_option(
+			'--requests',
+			action  = 'store',
+			type    = 'int',
+			dest    = 'requests',
+			default = 10000,
+			help    = 'Number of requests to make. The default is 10000.'
+		),
+		make_option(
+			'--concurrency',
+			action  = 'store',
+			type    = 'int',
+			dest    = 'concurrency',
+			default = 10,
+			help    = 'Number of requests to make at the same time. The default is 10.'
+		),
+		make_option(
+			'--recipients',
+			action  = 'store',
+			type    = 'int',
+			dest    = 'recipients',
+			default = 1000,
+			help    = 'Number of synthetic recipients the requests are spread over. Fewer recipients than requests means repeated opens. The default is 1000.'
+		),
+		make_option(
+			'--links',
+			action  = 'store',
+			type    = 'int',
+			dest    = 'links',
+			default = 20,
+			help    = 'Number of tracked links in the instance. The default is 20.'
+		),
+		make_option(
+			'--opens',
+			action  = 'store',
+			type    = 'float',
+			dest    = 'opens',
+			default = .5,
+			help    = 'Fraction of the requests that are opens rather than clicks. The default is .5.'
+		),
+		make_option(
+			'--json',
+			action  = 'store_true',
+			dest    = 'json',
+			default = False,
+			help    = 'Print the results as JSON, e.g. to compare them across changes.'
+		),
+	)
+
+	def handle(self, *args, **options):
+		if options['requests'] < 1 or options['concurrency'] < 1 or options['recipients'] < 1 or options['links'] < 1:
+			raise CommandError('--requests, --concurrency, --recipients and --links must be at least 1.')
+
+		old_database_name = create_test_db()
+		old_spool_folder  = getattr(settings, 'SPOOL_FOLDER', None)
+		spool_folder      = tempfile.mkdtemp()
+		queries           = QueryCounter()
+		server            = None
+		try:
+			settings.SPOOL_FOLDER = spool_folder
+
+			if not options['json']:
+				print 'Creating %d recipients and %d links...' % (options['recipients'], options['links'])
+			requests = self._create_requests(options)
+
+			if options['target'] == 'client':
+				target = ClientTarget()
+			else:
+				application = WSGIHandler()
+				if options['target'] == 'tracking':
+					application = TrackingApplication(fallback=application)
+				server = target = ServerTarget(application)
+
+			if not options['json']:
+				print 'Making %d requests to %s...' % (len(requests), options['target'])
+			queries.install()
+			elapsed, latencies, errors = self._replay(target, requests, options['concurrency'])
+			queries.uninstall()
+			request_queries = queries.count.value
+
+			# What record-tracking then has to do
+			queries.count.value = 0
+			queries.install()
+			start          = time.time()
+			buffer         = TrackingBuffer.shared()
+			buffer._SETTLE = 0
+			clicks, opens  = buffer.consume()
+			recorded       = time.time() - start
+			queries.uninstall()
+
+			results = {
+				'target'             : options['target'],
+				'requests'           : len(requests),
+				'concurrency'        : options['concurrency'],
+				'opens'              : len([request for request in requests if request[0] == 'open']),
+				'clicks'             : len([request for request in requests if request[0] == 'redirect']),
+				'errors'             : errors,
+				'elapsed'            : elapsed,
+				'requests_per_second': len(requests) / max(elapsed, .001),
+				'latency_ms'         : {
+					'p50': percentile(latencies, 50) * 1000,
+					'p95': percentile(latencies, 95) * 1000,
+					'p99': percentile(latencies, 99) * 1000,
+					'max': max(latencies) * 1000,
+				},
+				'queries_per_request': request_queries / float(len(requests)),
+				'recorded'           : {
+					'clicks' : clicks,
+					'opens'  : opens,
+					'elapsed': recorded,
+					'queries': queries.count.value,
+				},
+			}
+		finally:
+			queries.uninstall()
+			if server is not None:
+				server.close()
+			if old_spool_folder is None:
+				del settings.SPOOL_FOLDER
+			else:
+				settings.SPOOL_FOLDER = old_spool_folder
+			shutil.rmtree(spool_folder)
+			connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+		if options['json']:
+			print json.dumps(results, indent=1, sort_keys=True)
+		else:
+			print 'Requests:            %d (%d opens, %d clicks)' % (results['requests'], results['opens'], results['clicks'])
+			print 'Errors:              %d' % results['errors']
+			print 'Elapsed:             %.2fs' % results['elapsed']
+			print 'Requests/second:     %.1f' % results['requests_per_second']
+			print 'Latency p50:         %.2fms' % results['latency_ms']['p50']
+			print 'Latency p95:         %.2fms' % results['latency_ms']['p95']
+			print 'Latency p99:         %.2fms' % results['latency_ms']['p99']
+			print 'Latency max:         %.2fms' % results['latency_ms']['max']
+			print 'Queries/request:     %.3f' % results['queries_per_request']
+			print 'Recorded:            %d clicks and %d opens in %.2fs with %d queries' % (
+				results['recorded']['clicks'], results['recorded']['opens'], results['recorded']['elapsed'], results['recorded']['queries'])
+
+	def _create_requests(self, options, batch_size=500):
+		'''
+			Create the instance, recipients and URLs and return the requests
+			to make, as (endpoint, path with query string) in random order
+		'''
+		now   = datetime.now()
+		email = Email.objects.create(
+			title              = 'Benchmark',
+			subject            = 'Benchmark',
+			source_html_uri    = 'http://example.com/email.html',
+			start_date         = now.date(),
+			send_time          = now.time(),
+			from_email_address = 'benchmark@example.com',
+			track_urls         = True,
+			track_opens        = True,
+			preview            = False
+		)
+		instance = Instance.objects.create(email=email, sent_html='', requested_start=now)
+		URL.objects.bulk_create([
+			URL(instance=instance, name='http://example.com/article/%d' % i, position=i)
+			for i in xrange(0, options['links'])])
+		url_ids = list(instance.urls.values_list('pk', flat=True))
+
+		for start in xrange(0, options['recipients'], batch_size):
+			Recipient.objects.bulk_create([
+				Recipient(email_address='recipient%d@example.com' % i)
+				for i in xrange(start, min(start + batch_size, options['recipients']))])
+		recipient_ids = list(Recipient.objects.values_list('pk', flat=True))
+
+		open_path     = reverse('manager-email-open')
+		redirect_path = reverse('manager-email-redirect')
+		requests      = []
+		for i in xrange(0, options['requests']):
+			recipient_id = random.choice(recipient_ids)
+			if random.random() < options['opens']:
+				requests.append(('open', '?'.join([open_path, urllib.urlencode({
+					'instance' :instance.pk,
+					'recipient':recipient_id,
+					'mac'      :calc_open_mac(recipient_id, instance.pk)
+				})])))
+			else:
+				url_id = random.choice(url_ids)
+				requests.append(('redirect', '?'.join([redirect_path, urllib.urlencode({
+					'link'     :url_id,
+					'recipient':recipient_id,
+					'mac'      :calc_link_mac(url_id, recipient_id)
+				})])))
+		return requests
+
+	def _replay(self, target, requests, concurrency):
+		'''
+			Make requests from concurrency threads. Returns how long it took,
+			the latency of each request and how many failed.
+		'''
+		pending   = list(reversed(requests))
+		latencies = []
+		errors    = [0]
+		lock      = threading.Lock()
+		expected  = {'open':200, 'redirect':302}
+
+		def replay():
+			while True:
+				with lock:
+					if len(pending) == 0:
+						return
+					endpoint, path = pending.pop()
+				start = time.time()
+				try:
+					status = target.get(path)
+				except Exception:
+					log.exception('Unable to get %s' % path)
+					status = None
+				latency = time.time() - start
+				with lock:
+					latencies.append(latency)
+					if status != expected[endpoint]:
+						errors[0] += 1
+
+		threads = [threading.Thread(target=replay, name='Replay-%d' % i) for i in xrange(0, concurrency)]
+		start   = time.time()
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		return time.time() - start, latencies, errors[0]
+
+class ClientTarget(object):
+	'''
+		Makes requests through the Django test client, i.e. the whole of
+		Django but no HTTP
+	'''
+
+	def __init__(self):
+		self._clients = threading.local()
+
+	def get(self, path):
+		if not hasattr(self._clients, 'client'):
+			self._clients.client = Client()
+		return self._clients.client.get(path).status_code
+
+class ServerTarget(object):
+	'''
+		Serves application from a local WSGI server with a thread per
+		request, the way Apache serves it with mod_wsgi, and makes requests
+		to it over HTTP
+	'''
+
+	class Server(SocketServer.ThreadingMixIn, simple_server.WSGIServer):
+		daemon_threads      = True
+		request_queue_size  = 512
+
+	class Handler(simple_server.WSGIRequestHandler):
+		def log_message(self, *args):
+			pass
+
+	def __init__(self, application):
+		self._server = self.Server(('127.0.0.1', 0), self.Handler)
+		self._server.set_app(application)
+		self._thread = threading.Thread(target=self._server.serve_forever, name='ServerTarget')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def get(self, path):
+		http = httplib.HTTPConnection('127.0.0.1', self._server.server_address[1])
+		try:
+			http.request('GET', path)
+			response = http.getresponse()
+			response.read()
+			return response.status
+		finally:
+			http.close()
+
+	def close(self):
+		self._server.shutdown()
+		self._server.server_close()
@@ -1,23 +1,21 @@
-from django.db                import models
+from django.db                import models, connection, transaction
 from django.conf              import settings
 from datetime                 import datetime, timedelta
 from django.db.models         import Q, F
-from util                     import calc_url_mac, calc_open_mac, calc_unsubscribe_mac
-from django.core.urlresolvers import reverse
-from email.mime.multipart     import MIMEMultipart
-from email.mime.text          import MIMEText
+from util                     import LinkFactory
 from django.http              import HttpResponseRedirect
 from django.core.exceptions   import SuspiciousOperation
+from manager.rendering        import CompiledTemplate, MessageTemplate
+from manager.throttling       import SendingLimiter
+from manager.connections      import SMTPConnectionPool
+from manager.sending          import Delivery
+from manager.content          import ContentFetcher
+from manager.spool            import Spool, SpoolWriter
+from manager.timings          import StageTimings
 import hmac
 import logging
 import smtplib
 import re
-import urllib
-import time
-import Queue
-import threading
-import requests
-import random
 
 log = logging.getLogger(__name__)
 
@@ -72,19 +70,49 @@ class Recipient(models.Model):
 
 	@property
 	def unsubscribe_url(self):
-		# Use prefix='/' for reverse here instead of relying on get_script_prefix inside of
-		# reverse. This is because this method is called by management commands which
-		# have no concept of get_script_prefix().
-		return '?'.join([
-			settings.PROJECT_URL + reverse('manager-recipient-subscriptions', kwargs={'pk':self.pk}, prefix='/'),
-			urllib.urlencode({
-				'mac'      :calc_unsubscribe_mac(self.pk)
-			})
-		])
+		return LinkFactory.shared().unsubscribe_url(self.pk)
 
 	def __str__(self):
 		return self.email_address
 
+class RecipientAttributeManager(models.Manager):
+	'''
+		A custom manager to look up the attributes of many recipients at once
+		instead of one query per recipient per attribute.
+	'''
+
+	def lookup(self, names, **filters):
+		'''
+			Fetch the named attributes of every recipient matched by filters in
+			a single query. Returns a dict keyed by recipient pk of dicts keyed by
+			attribute name. Values are encoded the same way Recipient.__getattr__
+			encodes them. Missing attributes are left out.
+		'''
+		attributes = {}
+		if len(names) == 0:
+			return attributes
+
+		# The name comparison is done by the database, which may be case
+		# insensitive (e.g. MySQL). Hand each value back under the name(s)
+		# it was requested by, just like __getattr__ would.
+		requested = {}
+		for name in set(names):
+			requested.setdefault(name.lower(), []).append(name)
+
+		rows = self.filter(name__in=list(set(names)), **filters).values_list('recipient', 'name', 'value')
+		for recipient_id, name, value in rows.iterator():
+			recipient_attributes = attributes.setdefault(recipient_id, {})
+			value                = value.encode('ascii', 'ignore')
+			for requested_name in requested.get(name.lower(), ()):
+				recipient_attributes[requested_name] = value
+		return attributes
+
+	def for_recipients(self, names, recipients):
+		'''
+			Attributes of the given recipients (a queryset or list of pks)
+		'''
+		return self.lookup(names, recipient__in=recipients)
+
 class RecipientAttribute(models.Model):
 	'''
 		Describes an attribute of a recipient. The purpose of this class is 
@@ -94,6 +122,8 @@ class RecipientAttribute(models.Model):
 		it's value. This table is populated by the custom import script for each
 		data source.
 	'''
+	objects = RecipientAttributeManager()
+
 	recipient = models.ForeignKey(Recipient, related_name='attributes')
 	name      = models.CharField(max_length=100)
 	value     = models.CharField(max_length=1000,blank=True)
@@ -151,7 +181,7 @@ class EmailManager(models.Manager):
 		for candidate in Email.objects.sending_today(now=now):
 			if candidate.send_time >= send_interval_start and candidate.send_time <= send_interval_end:
 				requested_start = datetime.combine(now.date(), candidate.send_time)
-				if candidate.instances.filter(requested_start=requested_start).count() == 0:
+				if candidate.instances.filter(requested_start=requested_start, prerendered=None).count() == 0:
 					email_pks.append(candidate.pk)
 		return Email.objects.filter(pk__in=email_pks)
 
@@ -174,6 +204,25 @@ class EmailManager(models.Manager):
 					email_pks.append(candidate.pk)
 		return Email.objects.filter(pk__in=email_pks)
 
+	def prerendering_now(self, now=None):
+		'''
+			Emails to prerender. Same interval as previewing_now() but for
+			every email that doesn't have an instance yet.
+		'''
+		if now is None:
+			now = datetime.now()
+		preview_lead_time      = timedelta(seconds=settings.PREVIEW_LEAD_TIME)
+		preview_interval_start = (now + preview_lead_time).time()
+		preview_interval_end   = (now + preview_lead_time + self.processing_interval_duration).time()
+
+		email_pks = []
+		for candidate in Email.objects.sending_today(now=now):
+			if candidate.send_time >= preview_interval_start and candidate.send_time <= preview_interval_end:
+				requested_start = datetime.combine(now.date(), candidate.send_time)
+				if not candidate.instances.filter(requested_start=requested_start).exists():
+					email_pks.append(candidate.pk)
+		return Email.objects.filter(pk__in=email_pks)
+
 class Email(models.Model):
 	'''
 		Describes the details of an email. The details of what happens when
@@ -243,6 +292,7 @@ class Email(models.Model):
 	preview            = models.BooleanField(default=True, help_text=_HELP_TEXT['preview'])
 	preview_recipients = models.TextField(null=True, blank=True, help_text=_HELP_TEXT['preview_recipients'])
 	unsubscriptions    = models.ManyToManyField(Recipient, related_name='unsubscriptions')
+	modified           = models.DateTimeField(auto_now=True, null=True)
 	
 	@property
 	def smtp_from_address(self):
@@ -251,6 +301,46 @@ class Email(models.Model):
 		else:
 			return self.from_email_address
 
+	def sends_on(self, date):
+		'''
+			Whether the email is sent on date. Same rules as
+			EmailManager.sending_today().
+		'''
+		if not self.active:
+			return False
+		elif self.recurrence == self.Recurs.never:
+			return self.start_date == date
+		elif self.recurrence == self.Recurs.daily:
+			return True
+		elif self.recurrence == self.Recurs.weekly:
+			return self.start_date.isoweekday() == date.isoweekday()
+		elif self.recurrence == self.Recurs.monthly:
+			return self.start_date.day == date.day
+		return False
+
+	def next_send(self, after):
+		'''
+			The first time at or after after that the email is sent. None if
+			it isn't sent within the next year.
+		'''
+		date = after.date()
+		for i in xrange(0, 367):
+			when = datetime.combine(date, self.send_time)
+			if when >= after and self.sends_on(date):
+				return when
+			date += timedelta(days=1)
+		return None
+
+	@property
+	def recipients(self):
+		'''
+			Everyone the email is sent to
+		'''
+		return Recipient.objects.filter(
+			groups__in = self.recipient_groups.all()).exclude(
+				pk__in=self.unsubscriptions.all()).distinct().exclude(
+				disable=True)
+
 	@property
 	def total_sent(self):
 		return sum(list(i.recipient_details.count() for i in self.instances.all()))
@@ -260,15 +350,7 @@ class Email(models.Model):
 		'''
 			Fetch and decode the remote html.
 		'''
-		if self.source_html_uri == '':
-			raise HTMLContentMissingException()
-		else:
-			try:
-				request = requests.get(self.source_html_uri)
-				return request.text.encode('ascii', 'ignore')
-			except IOError, e:
-				log.exception('Unable to fetch email html')
-				raise self.EmailException()
+		return self.content()[0]
 
 	@property
 	def text(self):
@@ -278,25 +360,40 @@ class Email(models.Model):
 		'''
 		if self.source_text_uri is None or self.source_text_uri == '':
 			raise self.TextContentMissingException()
-		else:
-			try:
-				page = urllib.urlopen(self.source_text_uri)
-				content = page.read()
-				return content.encode('ascii', 'ignore')
-			except IOError, e:
-				log.exception('Unable to fetch email text')
-				raise self.EmailException()
+		return self.content()[1]
 
-	def send_preview(self):
+	def content(self):
 		'''
-			Send preview emails
+			Fetch and decode the remote html and text at the same time. The text
+			is None if the source_text_uri field is blank.
 		'''
-		html = self.html
+		if self.source_html_uri == '':
+			raise self.HTMLContentMissingException()
 
+		uris = [self.source_html_uri]
+		if self.source_text_uri:
+			uris.append(self.source_text_uri)
 		try:
-			text = self.text
-		except self.TextContentMissingException:
-			text = None
+			content = ContentFetcher.shared(CachedContent.objects).fetch(*uris)
+		except IOError, e:
+			log.exception('Unable to fetch email content')
+			raise self.EmailException()
+
+		content = [c.encode('ascii', 'ignore') for c in content]
+		return content[0], (content[1] if len(content) > 1 else None)
+
+	def send_preview(self, requested_start=None):
+		'''
+			Send preview emails for the instance that will be sent at
+			requested_start, today at send_time by default. How long each
+			stage took is logged.
+		'''
+		if requested_start is None:
+			requested_start = datetime.combine(datetime.now().today(), self.send_time)
+
+		timings = StageTimings()
+		with timings.time(StageTimings.CONTENT):
+			html, text = self.content()
 
 		# The recipients for the preview emails aren't the same as regular
 		# recipients. They are defined in the comma-separate field preview_recipients
@@ -313,246 +410,228 @@ class Email(models.Model):
 		'''
 		text_explanation = 'This is a preview of an email that will go out in one (1) hour.\n\nThe content of the email when it is sent will be re-requested from the source for the real delivery.'
 
+		pool = SMTPConnectionPool.shared()
 		try:
-			amazon = smtplib.SMTP_SSL(settings.AMAZON_SMTP['host'], settings.AMAZON_SMTP['port'])
-			amazon.login(settings.AMAZON_SMTP['username'], settings.AMAZON_SMTP['password'])
-		except smtplib.SMTPException, e:
+			amazon = pool.get()
+		except SMTPConnectionPool.ConnectionException, e:
 			log.exception('Unable to connect to Amazon')
 			raise self.AmazonConnectionException()
 		else:
 			preview_instance = PreviewInstance.objects.create(
 				email           = self,
 				recipients      = self.preview_recipients,
-				requested_start = datetime.combine(datetime.now().today(), self.send_time)
+				requested_start = requested_start
 			)
 
-			for recipient in recipients:
-				# Use alterantive subclass here so that both HTML and plain
-				# versions can be attached
-				msg            = MIMEMultipart('alternative')
-				msg['subject'] = self.subject + ' **PREVIEW**'
-				msg['From']    = self.smtp_from_address
-				msg['To']      = recipient
-
-				msg.attach(MIMEText(html_explanation + html, 'html', _charset='us-ascii'))
-
-				if text is not None:
-					msg.attach(MIMEText(text_explanation + text, 'plain', _charset='us-ascii' ))
+			template = MessageTemplate(
+				self.subject + ' **PREVIEW**',
+				self.smtp_from_address,
+				None if text is None else text_explanation + text)
 
+			for recipient in recipients:
 				try:
-					amazon.sendmail(self.from_email_address, recipient, msg.as_string())
+					with timings.time(StageTimings.SERIALIZATION):
+						msg = template.render(recipient, html_explanation + html)
+					with timings.time(StageTimings.SMTP):
+						amazon.sendmail(self.from_email_address, recipient, msg)
+				except smtplib.SMTPServerDisconnected, e:
+					log.exception('Unable to send email.')
+					pool.discard(amazon)
+					try:
+						amazon = pool.get()
+					except SMTPConnectionPool.ConnectionException, e:
+						log.exception('Unable to connect to Amazon')
+						raise self.AmazonConnectionException()
 				except smtplib.SMTPException, e:
 					log.exception('Unable to send email.')
-			amazon.quit()
+			pool.put(amazon, sent=len(recipients))
+			log.info('Timings for the preview of %s: %s' % (self.title, timings))
 
-	def send(self, additional_subject=''):
+	def send(self, additional_subject='', processes=1, engine='threads', requested_start=None):
 		'''
 			Send an email instance.
 			1. Fetch the content.
 			2. Create the instance.
 			3. Fetch recipients
-			4. Connect to Amazon
-			5. Create the InstanceRecipientDetails for each recipient
+			4. Create the InstanceRecipientDetails for each recipient
+			5. Connect to Amazon
 			6. Construct the customized message
 			7. Send the message
 			8. Cleanup
 
-			Takes additional_subject for testing purposes
+			Takes additional_subject for testing purposes. With more than one
+			process, the sending is split between that many worker processes.
+			engine picks how each process sends (see manager.sending.ENGINES).
+			requested_start is today at send_time by default. Nothing is sent
+			if there is already an instance for it.
 		'''
+		if requested_start is None:
+			requested_start = datetime.combine(datetime.now().today(), self.send_time)
 
-		class SendingThread(threading.Thread):
-			
-			_AMAZON_RECONNECT_THRESHOLD = 10
-			_ERROR_THRESHOLD            = 20
+		timings = StageTimings()
+		with timings.time(StageTimings.CONTENT):
+			html, text = self.content()
 
-			def run(self):
-				amazon             = None
-				reconnect          = False
-				reconnect_counter  = 0
-				error              = False
-				error_counter      = 0
-				rate_limit_counter = 0
-				
-				while True:
-					if recipient_details_queue.empty():
-						log.debug('%s queue empty, exiting.' % self.name)
-						break
+		recipients = self.recipients
 
-					recipient_details = recipient_details_queue.get()
+		# Create all the instancerecipientdetails before hand so in case sending
+		# fails, we know who hasn't been sent too. The instance only exists
+		# once all of them do so an interrupted send can be resumed.
+		with transaction.commit_on_success():
+			# Lock the email so only one instance is created for requested_start
+			# however many mailer-processes are running
+			list(Email.objects.select_for_update().filter(pk=self.pk))
+			instance = None
+			for existing in self.instances.filter(requested_start=requested_start):
+				if existing.prerendered is None:
+					log.info('%s has already been sent for %s' % (self.title, requested_start))
+					return
+				instance = existing
+
+			if instance is None:
+				instance = Instance.objects.create(
+					email           = self,
+					sent_html       = html,
+					sent_text       = text,
+					requested_start = requested_start,
+					opens_tracked   = self.track_opens,
+					urls_tracked    = self.track_urls
+				)
+				log.debug('staging recipients...')
+				with timings.time(StageTimings.AUDIENCE):
+					instance.stage_recipients(recipients)
+			else:
+				with timings.time(StageTimings.AUDIENCE):
+					# The spooled messages have the plain subject
+					instance.start_prerendered(html, text, recipients, spooled=not additional_subject)
 
-					try:
-						if amazon is None or reconnect:
-							try:
-								amazon = smtplib.SMTP_SSL(settings.AMAZON_SMTP['host'], settings.AMAZON_SMTP['port'])
-								amazon.login(settings.AMAZON_SMTP['username'], settings.AMAZON_SMTP['password'])
-							except:
-								if reconnect_counter == SendingThread._AMAZON_RECONNECT_THRESHOLD:
-									log.debug('%s, reached reconnect threshold, exiting')
-									raise
-								reconnect_counter += 1
-								reconnect         = True
-								continue
-							else:
-								reconnect = False
-
-						# Customize the email for this recipient
-						customized_html = recipient_details.instance.sent_html
-						# Replace template placeholders
-						delimiter = recipient_details.instance.email.replace_delimiter
-						for placeholder in placeholders:
-							replacement = ''
-							if placeholder.lower() != 'unsubscribe':
-								if recipient_attributes[recipient_details.recipient.pk][placeholder] is None:
-									log.error('Recipient %s is missing attribute %s' % (str(recipient_details.recipient), placeholder))
-								else:
-									replacement = recipient_attributes[recipient_details.recipient.pk][placeholder]
-								customized_html = customized_html.replace(delimiter + placeholder + delimiter, replacement)
-						# URL Tracking
-						if recipient_details.instance.urls_tracked:
-							for url in tracking_urls:
-								tracking_url = '?'.join([
-									settings.PROJECT_URL + reverse('manager-email-redirect'),
-									urllib.urlencode({
-										'instance'  :recipient_details.instance.pk,
-										'recipient' :recipient_details.recipient.pk,
-										'url'       :urllib.quote(url.name),
-										'position'  :url.position,
-										# The mac uniquely identifies the recipient and acts as a secure integrity check
-										'mac'       :calc_url_mac(url.name, url.position, recipient_details.recipient.pk, recipient_details.instance.pk)
-									})
-								])
-
-								customized_html = customized_html.replace(
-									'href="' + url.name + '"',
-									'href="' + tracking_url + '"',
-									1
-								)
-						# Open Tracking
-						if recipient_details.instance.opens_tracked:
-							customized_html += '<img src="%s" />' % '?'.join([
-								settings.PROJECT_URL + reverse('manager-email-open'),
-								urllib.urlencode({
-									'recipient':recipient_details.recipient.pk,
-									'instance' :recipient_details.instance.pk,
-									'mac'      :calc_open_mac(recipient_details.recipient.pk, recipient_details.instance.pk)
-								})
-							])
-						# Unsubscribe link
-						customized_html = re.sub(
-							re.escape(delimiter) + 'UNSUBSCRIBE' + re.escape(delimiter),
-							'<a href="%s" style="color:blue;text-decoration:none;">unsubscribe</a>' % recipient_details.recipient.unsubscribe_url,
-							customized_html)
-
-						# Construct the message
-						msg            = MIMEMultipart('alternative')
-						msg['subject'] = subject
-						msg['From']    = display_from
-						msg['To']      = recipient_details.recipient.email_address
-						msg.attach(MIMEText(customized_html, 'html', _charset='us-ascii'))
-						if text is not None:
-							msg.attach(MIMEText(text, 'plain', _charset='us-ascii' ))
-
-						log.debug('thread: %s, email: %s' % (self.name, recipient_details.recipient.email_address))
-						try:
-							amazon.sendmail(real_from, recipient_details.recipient.email_address, msg.as_string())
-						except smtplib.SMTPResponseException, e:
-							if e.smtp_error.find('Maximum sending rate exceeded') >= 0:
-								recipient_details_queue.put(recipient_details)
-								log.debug('thread %s, maximum sending rate exceeded, sleeping for a bit')
-								time.sleep(float(1) + random.random())
-							else:
-								recipient_details.exception_msg = str(e)
-						except smtplib.SMTPServerDisconnected:
-							# Connection error
-							log.debug('thread %s, connection error, sleeping for a bit')
-							time.sleep(float(1) + random.random())
-							recipient_details_queue.put(recipient_details)
-							reconnect = True
-						else:
-							recipient_details.when = datetime.now()
-						finally:
-							recipient_details.save()
-					except Exception, e:
-						if error_counter == SendingThread._ERROR_THRESHOLD:
-							recipient_details_queue.task_done()
-							log.debug('%s, reached error threshold, exiting')
-							with recipient_details_queue.mutex:
-								recipient_details_queue.queue.clear()
-								return
-						error_counter += 1
-						log.exception('%s exception' % self.name)
-
-					recipient_details_queue.task_done()
+		instance.delivery(self.subject + str(additional_subject), text, timings).send(processes=processes, engine=engine)
 
-		try:
-			text = self.text
-		except self.TextContentMissingException:
-			text = None
-
-		instance = Instance.objects.create(
-			email           = self,
-			sent_html       = self.html,
-			requested_start = datetime.combine(datetime.now().today(), self.send_time),
-			opens_tracked   = self.track_opens,
-			urls_tracked    = self.track_urls
-		)
+	def prerender(self, requested_start=None):
+		'''
+			Create the instance for requested_start ahead of time and render
+			every recipient's message into its spool, so send() only has to
+			stream them out. requested_start is today at send_time by default.
+		'''
+		if requested_start is None:
+			requested_start = datetime.combine(datetime.now().today(), self.send_time)
 
-		recipients = Recipient.objects.filter(
-			groups__in = self.recipient_groups.all()).exclude(
-				pk__in=self.unsubscriptions.all()).distinct().exclude(
-				disable=True)
+		html, text = self.content()
 
-		# The interval between ticks is one second. This is used to make
-		# sure that the threads don't exceed the sending limit
-		subject                 = self.subject + str(additional_subject)
-		display_from            = self.smtp_from_address
-		real_from               = self.from_email_address
-		recipient_details_queue = Queue.Queue()
-		success                 = True
-		recipient_attributes    = {}
-		placeholders            = instance.placeholders
-		tracking_urls           = instance.tracking_urls
+		with transaction.commit_on_success():
+			list(Email.objects.select_for_update().filter(pk=self.pk))
+			if self.instances.filter(requested_start=requested_start).exists():
+				log.info('%s has already been prerendered or sent for %s' % (self.title, requested_start))
+				return
 
-		# Create all the instancerecipientdetails before hand so in case sending
-		# fails, we know who hasn't been sent too
-		# Here, also, we want to lookup the recipients attributes that are used
-		# in the template. Do this upfront because looking up each one in the 
-		# sending loop is too slow
-		log.debug('building recipients and recipient attributes...')
-		for recipient in recipients:
-			recipient_attributes[recipient.pk] = {}
-			for placeholder in placeholders:
-				try:
-					recipient_attributes[recipient.pk][placeholder] = getattr(recipient, placeholder)
-				except AttributeError:
-					recipient_attributes[recipient.pk][placeholder] = None
+			instance = Instance.objects.create(
+				email           = self,
+				sent_html       = html,
+				sent_text       = text,
+				requested_start = requested_start,
+				opens_tracked   = self.track_opens,
+				urls_tracked    = self.track_urls,
+				# Names the spool, so it has to read back the same from any database
+				prerendered     = datetime.now().replace(microsecond=0)
+			)
+			instance.stage_recipients(self.recipients)
 
-			recipient_details_queue.put(
-				InstanceRecipientDetails.objects.create(
-					recipient = recipient,
-					instance  = instance))
+		instance.prerender(self.subject, text)
 
-		log.debug('spin up sending threads...')
-		html_lock        = threading.Lock()
-		for i in xrange(0, settings.AMAZON_SMTP['rate'] - 1):
-			sending_thread = SendingThread()
-			sending_thread.start()
+	def __str__(self):
+		return self.title
 
-		# Block the main thread until the queue is empty
-		recipient_details_queue.join()
+class CachedContentManager(models.Manager):
+	'''
+		The cache used by ContentFetcher
+	'''
 
-		instance.end = datetime.now()
-		instance.save()
+	def lookup(self, uri):
+		try:
+			return self.get(uri=uri)
+		except CachedContent.DoesNotExist:
+			return None
+
+	def store(self, uri, etag, last_modified, content):
+		cached, created = self.get_or_create(uri=uri, defaults={'content':content})
+		cached.etag          = etag
+		cached.last_modified = last_modified
+		cached.content       = content
+		cached.save()
+
+class CachedContent(models.Model):
+	'''
+		The last response from an email content source along with what's
+		needed to ask the source whether it has changed since.
+	'''
+	objects = CachedContentManager()
 
-	def __str__(self):
-		return self.title
+	uri           = models.CharField(max_length=200, unique=True)
+	etag          = models.CharField(max_length=255, null=True)
+	last_modified = models.CharField(max_length=64, null=True)
+	content       = models.TextField()
+	fetched       = models.DateTimeField(auto_now=True)
+
+class InstanceManager(models.Manager):
+	'''
+		A custom manager to find instances whose sending was interrupted.
+	'''
+	processing_interval_duration = timedelta(seconds=settings.PROCESSING_INTERVAL_DURATION)
+
+	def interrupted(self, now=None):
+		'''
+			Instances that never finished and haven't sent anything for a whole
+			processing interval, e.g. because mailer-process died part way
+			through sending them.
+		'''
+		if now is None:
+			now = datetime.now()
+		cutoff = now - self.processing_interval_duration
+
+		instance_pks = []
+		for candidate in Instance.objects.filter(end=None, start__lte=cutoff, prerendered=None):
+			if not candidate.recipient_details.filter(when__gte=cutoff).exists():
+				instance_pks.append(candidate.pk)
+		return Instance.objects.filter(pk__in=instance_pks)
+
+	def clean_spool(self, now=None):
+		'''
+			Delete the prerendered instances that will never be sent, because
+			their email was deactivated or their send time has passed, and
+			remove any spool of an instance that has finished or no longer
+			exists.
+		'''
+		if now is None:
+			now = datetime.now()
+		cutoff = now - self.processing_interval_duration
+
+		abandoned = Instance.objects.exclude(prerendered=None).filter(models.Q(email__active=False) | models.Q(requested_start__lt=cutoff))
+		for instance in abandoned.select_related('email'):
+			with transaction.commit_on_success():
+				list(Email.objects.select_for_update().filter(pk=instance.email_id))
+				if Instance.objects.select_for_update().filter(pk=instance.pk, prerendered=instance.prerendered).exists():
+					log.info('Removing the unsent prerendered instance of %s for %s' % (instance.email.title, instance.requested_start))
+					Spool.remove(instance.pk)
+					instance.delete()
+
+		# Files are listed first so any instance they belong to is committed
+		# by the time the ones still needed are looked up
+		instance_ids = Spool.instance_ids()
+		transaction.commit_unless_managed()
+		needed = set(Instance.objects.filter(pk__in=instance_ids, end=None).values_list('pk', flat=True))
+		for instance_id in instance_ids - needed:
+			log.info('Removing the spool of instance %d' % instance_id)
+			Spool.remove(instance_id)
 
 class Instance(models.Model):
 	'''
 		Describes what happens when an email is actual sent.
 	'''
+	objects = InstanceManager()
+
 	email           = models.ForeignKey(Email, related_name='instances')
 	sent_html       = models.TextField()
+	sent_text       = models.TextField(null=True)
 	requested_start = models.DateTimeField()
 	start           = models.DateTimeField(auto_now_add=True)
 	end             = models.DateTimeField(null=True)
@@ -560,6 +639,21 @@ class Instance(models.Model):
 	recipients      = models.ManyToManyField(Recipient, through='InstanceRecipientDetails')
 	opens_tracked   = models.BooleanField(default=False)
 	urls_tracked    = models.BooleanField(default=False)
+	throttle_count  = models.PositiveIntegerField(default=0)
+	send_rate       = models.FloatField(null=True)
+	# When the instance was created ahead of time to prerender its messages.
+	# None once sending starts.
+	prerendered     = models.DateTimeField(null=True)
+	# How long each stage of sending took (see StageTimings), as JSON
+	timings         = models.TextField(null=True, blank=True)
+
+	# How many InstanceRecipientDetails are inserted per query when staging
+	_STAGING_BATCH_SIZE = 1000
+
+	# How many InstanceRecipientDetails are fetched per query when sending.
+	# Their recipients' attributes are looked up with one parameter per
+	# recipient and SQLite allows at most 999.
+	_SENDING_CHUNK_SIZE = 500
 	
 	@property
 	def in_progress(self):
@@ -580,19 +674,44 @@ class Instance(models.Model):
 	def sent_count(self):
 		return self.recipient_details.exclude(when=None).count()
 
+	@property
+	def stage_timings(self):
+		'''
+			How long each stage of sending took, one row per stage (see
+			StageTimings.rows())
+		'''
+		return StageTimings.loads(self.timings).rows()
+
 	@property
 	def placeholders(self):
 		delimiter    = self.email.replace_delimiter
 		placeholders = re.findall(re.escape(delimiter) + '(.+)' + re.escape(delimiter), self.sent_html)
 		return filter(lambda p: p.lower() != 'unsubscribe', placeholders)
 
+	@property
+	def compiled_html(self):
+		'''
+			The sent html compiled for rendering recipient by recipient. It is
+			built once and then shared by all the sending threads.
+		'''
+		if getattr(self, '_compiled_html', None) is None:
+			self._compiled_html = CompiledTemplate(
+				self.sent_html,
+				self.email.replace_delimiter,
+				self.placeholders,
+				self.tracking_urls,
+				self.opens_tracked,
+				self.pk)
+		return self._compiled_html
+
 	@property
 	def tracking_urls(self):
 		if not self.urls_tracked:
 			return []
 
-		hrefs = re.findall('<a(?:.*)href="([^"]+)"', self.sent_html)
-		urls  = []
+		hrefs     = re.findall('<a(?:.*)href="([^"]+)"', self.sent_html)
+		urls      = []
+		positions = {}
 
 		for href in hrefs:
 			# Check to see if this URL is trackable. Links that don't start
@@ -604,12 +723,187 @@ class Instance(models.Model):
 			except SuspiciousOperation:
 				continue
 			else:
+				# Count the positions here rather than in the database so the
+				# URLs created when sending started are found again on resume
+				position        = positions.get(href, 0)
+				positions[href] = position + 1
 				urls.append(URL.objects.get_or_create(
 					instance = self,
 					name     = href,
-					position = URL.objects.filter(instance=self, name=href).count())[0])
+					position = position)[0])
 		return urls
 
+	def pending_recipient_details(self, shard=None, shards=None):
+		'''
+			The InstanceRecipientDetails that haven't been sent or failed yet.
+			If shards is given, only those in the shard-th of that many shards.
+		'''
+		details = self.recipient_details.filter(when=None, exception_msg=None).select_related('recipient')
+		if shards is not None:
+			pk = '.'.join([
+				connection.ops.quote_name(InstanceRecipientDetails._meta.db_table),
+				connection.ops.quote_name(InstanceRecipientDetails._meta.pk.column)
+			])
+			details = details.extra(where=[pk + ' %% %s = %s'], params=[shards, shard])
+		return details
+
+	def pending_recipient_chunks(self, shard=None, shards=None, spool=None, timings=None):
+		'''
+			The pending_recipient_details in chunks of _SENDING_CHUNK_SIZE.
+			Chunks are paged by pk rather than with an OFFSET so each one is as
+			cheap to fetch as the first. The recipient attributes used in the
+			template are looked up for each chunk as a whole, because looking
+			up each one in the sending loop is too slow. They aren't looked up
+			for details whose message is in spool. The queries are timed if
+			timings are given.
+		'''
+		if timings is None:
+			timings = StageTimings()
+		placeholders = self.compiled_html.placeholders
+		last_pk      = 0
+		while True:
+			with timings.time(StageTimings.AUDIENCE):
+				chunk = list(self.pending_recipient_details(shard, shards).filter(pk__gt=last_pk).order_by('pk')[:self._SENDING_CHUNK_SIZE])
+			if len(chunk) == 0:
+				break
+			last_pk    = chunk[-1].pk
+			unrendered = [details.recipient_id for details in chunk if spool is None or details.pk not in spool]
+			attributes = {}
+			if len(unrendered) > 0 and len(placeholders) > 0:
+				with timings.time(StageTimings.ATTRIBUTES):
+					attributes = RecipientAttribute.objects.for_recipients(placeholders, unrendered)
+			for details in chunk:
+				# All the details share this instance. Don't let each one
+				# look it up again.
+				details.instance   = self
+				details.attributes = attributes.get(details.recipient_id, {})
+			yield chunk
+
+	def delivery(self, subject, text, timings=None):
+		'''
+			What is needed to send this instance, including its spool if it
+			was prerendered. timings has any stages already timed.
+		'''
+		return Delivery(
+			self,
+			subject,
+			text,
+			SendingLimiter.shared(
+				settings.AMAZON_SMTP['rate'],
+				settings.AMAZON_SMTP['quota'],
+				lambda: InstanceRecipientDetails.objects.filter(when__gte=datetime.now() - timedelta(days=1)).values_list('when', flat=True).iterator()),
+			SMTPConnectionPool.shared(),
+			spool=Spool.open(self.pk),
+			timings=timings)
+
+	def prerender(self, subject, text):
+		'''
+			Render the message of every staged recipient into the spool. Gives
+			up if sending starts in the meantime. Instances sent in batches
+			have only one message so they aren't prerendered.
+		'''
+		delivery = Delivery(self, subject, text, None, None)
+		if delivery.batched:
+			log.info('%s is sent in batches, there is nothing to prerender' % self.email.title)
+			return
+		writer   = SpoolWriter(Spool.path(self.pk, self.prerendered))
+		try:
+			count = 0
+			for chunk in self.pending_recipient_chunks():
+				for details in chunk:
+					writer.write(details.pk, delivery.message(details))
+				count += len(chunk)
+				# Don't see the instance as it was when this transaction started
+				transaction.commit_unless_managed()
+				if not Instance.objects.filter(pk=self.pk, prerendered=self.prerendered).exists():
+					log.info('Sending started before prerendering finished')
+					writer.abort()
+					return
+
+			# send() claims or throws away the spool with the email locked, so
+			# it either sees this one complete or it never becomes usable
+			transaction.commit_unless_managed()
+			with transaction.commit_on_success():
+				list(Email.objects.select_for_update().filter(pk=self.email_id))
+				if not Instance.objects.select_for_update().filter(pk=self.pk, prerendered=self.prerendered).exists():
+					log.info('Sending started before prerendering finished')
+					writer.abort()
+					return
+				writer.close()
+		except Exception:
+			writer.abort()
+			raise
+		log.info('Prerendered %d message(s) for %s' % (count, self.email.title))
+
+	def start_prerendered(self, html, text, recipients, spooled=True):
+		'''
+			Get a prerendered instance ready to send. Must be called with the
+			email locked. The spool is claimed for sending (see Spool.claim())
+			unless the email or its content has changed since it was
+			prerendered, or spooled is False. Otherwise it is thrown away,
+			along with one still being written, and the messages are rendered
+			while sending instead. Recipients that were added or removed since
+			are staged or unstaged.
+		'''
+		content_changed = html != self.sent_html or text != self.sent_text
+		changed         = content_changed or (self.email.modified is not None and self.email.modified > self.prerendered)
+		if changed:
+			log.info('%s changed since it was prerendered' % self.email.title)
+		if changed or not spooled or not Spool.claim(self.pk, self.prerendered):
+			Spool.remove(self.pk)
+		if content_changed:
+			URL.objects.filter(instance=self).delete()
+			self.sent_html      = html
+			self.sent_text      = text
+			self._compiled_html = None
+		self.start       = datetime.now()
+		self.prerendered = None
+		self.save()
+
+		self.recipient_details.filter(when=None).exclude(recipient__in=recipients).delete()
+		self.stage_recipients(recipients.exclude(pk__in=self.recipient_details.values('recipient')))
+
+	def finish(self, throttles, sent, duration, timings=None):
+		'''
+			Record the end of sending. The instance is successful if every
+			recipient was either sent to or failed for good. The send rate is
+			that of this attempt, which sent sent messages in duration seconds.
+			The timings are added to those of any earlier attempt.
+		'''
+		if timings is not None:
+			timings.merge(StageTimings.loads(self.timings).summary())
+			self.timings = timings.dumps()
+		self.end            = datetime.now()
+		self.success        = not self.pending_recipient_details().exists()
+		self.throttle_count = self.throttle_count + throttles
+		self.send_rate      = sent / max(duration, 0.001)
+		self.save()
+		if self.success:
+			Spool.remove(self.pk)
+
+	def resume(self, processes=1, engine='threads'):
+		'''
+			Send to the recipients an interrupted send didn't get to. The html,
+			text and tracking URLs stored when sending started are used again
+			so the content isn't fetched again.
+		'''
+		self.delivery(self.email.subject, self.sent_text).send(processes=processes, engine=engine)
+
+	def stage_recipients(self, recipients):
+		'''
+			Create an InstanceRecipientDetails for each recipient in batches
+			instead of one INSERT per recipient. Only the recipient ids are
+			fetched so the recipient objects aren't held in memory.
+		'''
+		batch = []
+		for recipient_id in recipients.values_list('pk', flat=True).iterator():
+			batch.append(InstanceRecipientDetails(recipient_id=recipient_id, instance=self))
+			if len(batch) == self._STAGING_BATCH_SIZE:
+				InstanceRecipientDetails.objects.bulk_create(batch)
+				batch = []
+		if len(batch) > 0:
+			InstanceRecipientDetails.objects.bulk_create(batch)
+
 	class Meta:
 		ordering = ('-start',)
 
@@ -663,3 +957,6 @@ class InstanceOpen(models.Model):
 	recipient = models.ForeignKey(Recipient, related_name='instances_opened')
 	instance  = models.ForeignKey(Instance, related_name='opens')
 	when      = models.DateTimeField(auto_now_add=True)
+
+	class Meta:
+		unique_together = (('instance', 'recipient'),)
@@ -0,0 +1,172 @@
+from util                     import LinkFactory
+from email.header             import Header
+from email.mime.multipart     import MIMEMultipart
+from email.mime.text          import MIMEText
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+UNSUBSCRIBE_LINK = '<a href="%s" style="color:blue;text-decoration:none;">unsubscribe</a>'
+
+class CompiledTemplate(object):
+	'''
+		The sent html of an instance broken up into literal chunks and the
+		slots that change per recipient. Customizing the html for a recipient
+		is then a single join instead of a replace over the whole document for
+		every placeholder and URL.
+
+		The slots are found by doing the same replacements, in the same order,
+		that used to be done for each recipient, except with markers instead
+		of the recipient's values. This keeps the output identical.
+	'''
+
+	LITERAL, PLACEHOLDER, URL, OPEN, UNSUBSCRIBE = range(0, 5)
+
+	_MARKER    = '\x00%d\x00'
+	_MARKER_RE = re.compile('\x00(\d+)\x00')
+
+	def __init__(self, html, delimiter, placeholders, tracking_urls, opens_tracked, instance_id):
+		self.instance_id  = instance_id
+		self.links        = LinkFactory(instance_id)
+		self.placeholders = []
+		self.segments     = []
+
+		slots = []
+		def mark(kind, value=None):
+			slots.append((kind, value))
+			return self._MARKER % (len(slots) - 1)
+
+		# Replace template placeholders
+		for placeholder in placeholders:
+			token = delimiter + placeholder + delimiter
+			if placeholder.lower() != 'unsubscribe' and token in html:
+				html = html.replace(token, mark(self.PLACEHOLDER, placeholder))
+				self.placeholders.append(placeholder)
+
+		# URL Tracking
+		for url in tracking_urls:
+			html = html.replace(
+				'href="' + url.name + '"',
+				'href="' + mark(self.URL, url) + '"',
+				1
+			)
+
+		# Open Tracking
+		if opens_tracked:
+			html += '<img src="%s" />' % mark(self.OPEN)
+
+		# Unsubscribe link
+		html = re.sub(
+			re.escape(delimiter) + 'UNSUBSCRIBE' + re.escape(delimiter),
+			mark(self.UNSUBSCRIBE),
+			html)
+
+		for i, chunk in enumerate(self._MARKER_RE.split(html)):
+			if i % 2 == 0:
+				if chunk != '':
+					self.segments.append((self.LITERAL, chunk))
+			else:
+				self.segments.append(slots[int(chunk)])
+
+	@property
+	def personalized(self):
+		'''
+			Whether the html is any different from one recipient to the next
+		'''
+		return any(kind != self.LITERAL for kind, value in self.segments)
+
+	def render(self, recipient, attributes):
+		'''
+			The html customized for recipient. attributes is a dict of the
+			recipient's attribute values keyed by placeholder.
+		'''
+		for placeholder in self.placeholders:
+			if attributes.get(placeholder) is None:
+				log.error('Recipient %s is missing attribute %s' % (str(recipient), placeholder))
+
+		chunks = []
+		for kind, value in self.segments:
+			if kind == self.LITERAL:
+				chunks.append(value)
+			elif kind == self.PLACEHOLDER:
+				chunks.append(attributes.get(value) or '')
+			elif kind == self.URL:
+				chunks.append(self.links.tracking_url(value, recipient.pk))
+			elif kind == self.OPEN:
+				chunks.append(self.links.open_url(recipient.pk))
+			elif kind == self.UNSUBSCRIBE:
+				chunks.append(UNSUBSCRIBE_LINK % self.links.unsubscribe_url(recipient.pk))
+		return ''.join(chunks)
+
+class MessageTemplate(object):
+	'''
+		A message built the way it always has been, with MIMEMultipart, but
+		serialized once with markers where the To header and the html go.
+		The headers, the boundary and the text part are the same for every
+		recipient, so making a recipient's message is a join instead of
+		building and serializing a whole MIME tree.
+
+		The recipient's values are written out the same way the email
+		package's Generator would write them so the message is unchanged.
+	'''
+
+	_TO   = '\x00TO\x00'
+	_HTML = '\x00HTML\x00'
+
+	# Generator.as_string() escapes lines of the body that start with From
+	_FROM_RE = re.compile(r'^From ', re.MULTILINE)
+
+	# Generator's default maximum header line length
+	_MAX_HEADER_LENGTH = 78
+
+	def __init__(self, subject, display_from, text):
+		self.subject      = subject
+		self.display_from = display_from
+		self.text         = text
+
+		msg           = self.build(self._TO, self._HTML)
+		serialized    = msg.as_string()
+		self.boundary = msg.get_boundary()
+		self._head, rest         = serialized.split(self._TO, 1)
+		self._middle, self._tail = rest.split(self._HTML, 1)
+
+	def build(self, to, html):
+		'''
+			The message as a MIMEMultipart
+		'''
+		# Use alternative subclass here so that both HTML and plain
+		# versions can be attached
+		msg            = MIMEMultipart('alternative')
+		msg['subject'] = self.subject
+		msg['From']    = self.display_from
+		msg['To']      = to
+		msg.attach(MIMEText(html, 'html', _charset='us-ascii'))
+		if self.text is not None:
+			msg.attach(MIMEText(self.text, 'plain', _charset='us-ascii'))
+		return msg
+
+	def render(self, to, html):
+		'''
+			The serialized message to send html to the address to
+		'''
+		if self.boundary in html:
+			# The html can't contain the boundary. Let the email package
+			# pick another one.
+			return self.build(to, html).as_string()
+		return ''.join([
+			self._head,
+			self._header_value('To', to),
+			self._middle,
+			str(self._FROM_RE.sub('>From ', html)),
+			self._tail
+		])
+
+	def _header_value(self, name, value):
+		if isinstance(value, str):
+			try:
+				unicode(value, 'us-ascii')
+			except UnicodeError:
+				# Raw 8bit data is written as is
+				return value
+		return Header(value, maxlinelen=self._MAX_HEADER_LENGTH, header_name=name).encode()
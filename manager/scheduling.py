@@ -0,0 +1,177 @@
+from django.conf              import settings
+from django.db                import connection
+from django.db.models         import Count, Max
+from django.db.models.signals import post_save, post_delete
+from datetime                 import datetime, timedelta
+from manager.models           import Email, Instance
+import heapq
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+class ConcurrentSends(object):
+	'''
+		Runs sends at the same time, each in its own thread, so a large send
+		doesn't hold up the ones after it. They split the sending rate and
+		quota between them (see SendingLimiter.share()) and each records
+		its own progress and end on its instance. Sends with worker
+		processes are the exception (see start()).
+	'''
+
+	def __init__(self):
+		self._threads = []
+
+	def start(self, title, send, **kwargs):
+		'''
+			Call send with kwargs in a new thread. A send with more than one
+			process instead waits for the others to finish and runs in the
+			calling thread. Its workers are forked, and any lock another
+			thread held at the time (e.g. logging's or LinkFactory's) would
+			stay locked in them for good.
+		'''
+		if kwargs.get('processes', 1) > 1:
+			self.wait()
+			self._run(title, send, kwargs)
+			return
+		self._threads = [thread for thread in self._threads if thread.is_alive()]
+		thread = threading.Thread(target=self._run, args=(title, send, kwargs), name='Send-%s' % title)
+		thread.start()
+		self._threads.append(thread)
+
+	def _run(self, title, send, kwargs):
+		try:
+			send(**kwargs)
+		except Exception:
+			log.exception('Unable to send %s' % title)
+		finally:
+			connection.close()
+
+	def wait(self):
+		'''
+			Block until every send is finished
+		'''
+		for thread in self._threads:
+			thread.join()
+		self._threads = []
+
+class Scheduler(object):
+	'''
+		Sends previews and emails as they come due instead of checking every
+		processing interval. The next time each active email is previewed and
+		sent is kept in a heap and the scheduler sleeps until the earliest
+		one. The heap is rebuilt when an email is saved or deleted, whether
+		in this process or another one (e.g. the web application). With
+		prerender, emails are also prerendered when their previews go out.
+	'''
+
+	PREVIEW, PRERENDER, SEND = range(0, 3)
+
+	# Longest to sleep before checking whether emails were changed by
+	# another process
+	_RELOAD_CHECK = 60
+
+	def __init__(self, processes=1, engine='threads', prerender=False):
+		self.processes = processes
+		self.engine    = engine
+		self.prerender = prerender
+		self.events    = []
+		self.sends     = ConcurrentSends()
+		self._changed  = threading.Event()
+		self._marker   = None
+
+	def _email_changed(self, sender, **kwargs):
+		self._changed.set()
+
+	def _current_marker(self):
+		'''
+			Changes whenever an email is saved or deleted
+		'''
+		marker = Email.objects.aggregate(count=Count('pk'), modified=Max('modified'))
+		return (marker['count'], marker['modified'])
+
+	def load(self, now=None):
+		'''
+			Schedule every active email. Anything that came due in the last
+			processing interval and hasn't been sent yet is sent right away.
+			Prerenders that will no longer be sent are cleaned up first.
+		'''
+		if now is None:
+			now = datetime.now()
+		Instance.objects.clean_spool(now=now)
+		self._changed.clear()
+		self._marker = self._current_marker()
+		self.events  = []
+		after        = now - timedelta(seconds=settings.PROCESSING_INTERVAL_DURATION)
+		for email in Email.objects.filter(active=True):
+			self._schedule(email, after)
+		log.debug('Scheduled %d preview(s) and send(s)' % len(self.events))
+
+	def _schedule(self, email, after):
+		'''
+			Add the next send of email at or after after, and its preview
+		'''
+		requested_start = email.next_send(after)
+		if requested_start is None:
+			return
+		heapq.heappush(self.events, (requested_start, self.SEND, email.pk, requested_start))
+		preview_at = requested_start - timedelta(seconds=settings.PREVIEW_LEAD_TIME)
+		if preview_at >= after:
+			if email.preview:
+				heapq.heappush(self.events, (preview_at, self.PREVIEW, email.pk, requested_start))
+			if self.prerender:
+				heapq.heappush(self.events, (preview_at, self.PRERENDER, email.pk, requested_start))
+
+	def run(self):
+		'''
+			Send everything as it comes due. Never returns.
+		'''
+		post_save.connect(self._email_changed, sender=Email, dispatch_uid='manager.scheduling')
+		post_delete.connect(self._email_changed, sender=Email, dispatch_uid='manager.scheduling')
+		self.load()
+		while True:
+			if self._changed.is_set() or self._marker != self._current_marker():
+				log.info('Emails have changed, rescheduling.')
+				self.load()
+
+			now = datetime.now()
+			if len(self.events) > 0 and self.events[0][0] <= now:
+				self.fire(*heapq.heappop(self.events)[1:])
+				continue
+
+			wait = self._RELOAD_CHECK
+			if len(self.events) > 0:
+				wait = min(wait, (self.events[0][0] - now).total_seconds())
+			# Don't hold on to a connection the database might drop while idle
+			connection.close()
+			self._changed.wait(wait)
+
+	def fire(self, kind, email_pk, requested_start):
+		'''
+			Send the preview or email, or prerender the email, for
+			requested_start unless it already has been. Emails are sent and
+			prerendered in the background so others can start meanwhile.
+		'''
+		try:
+			email = Email.objects.get(pk=email_pk, active=True)
+		except Email.DoesNotExist:
+			return
+
+		try:
+			if kind == self.PREVIEW:
+				if not email.previews.filter(requested_start=requested_start).exists():
+					log.info('Previewing the following email now: %s ' % email.title)
+					email.send_preview(requested_start=requested_start)
+			elif kind == self.PRERENDER:
+				if not email.instances.filter(requested_start=requested_start).exists():
+					log.info('Prerendering the following email now: %s' % email.title)
+					self.sends.start(email.title, email.prerender, requested_start=requested_start)
+			else:
+				if not email.instances.filter(requested_start=requested_start, prerendered=None).exists():
+					log.info('Sending the following email now: %s' % email.title)
+					self.sends.start(email.title, email.send, processes=self.processes, engine=self.engine, requested_start=requested_start)
+		except Exception:
+			log.exception('Unable to send %s' % email.title)
+
+		if kind == self.SEND:
+			self._schedule(email, requested_start + timedelta(seconds=1))
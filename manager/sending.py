@@ -0,0 +1,743 @@
+from django.conf              import settings
+from django.db                import connection
+from datetime                 import datetime
+from manager.asyncsmtp        import SMTPSession
+from manager.connections      import SMTPConnectionPool
+from manager.rendering        import MessageTemplate
+from manager.status           import StatusWriter
+from manager.throttling       import SendingLimiter, ConcurrencyController
+from manager.timings          import StageTimings
+import asyncore
+import collections
+import logging
+import multiprocessing
+import Queue
+import random
+import smtplib
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class Batch(list):
+	'''
+		InstanceRecipientDetails sent as a single message. The recipients are
+		only in the envelope, like Bcc, so none of them see the others.
+	'''
+
+	# What the To header says instead
+	TO = 'undisclosed-recipients:;'
+
+	@staticmethod
+	def details(item):
+		'''
+			The InstanceRecipientDetails an item handed out by an Audience is
+			sent to: the item itself or the ones in a Batch
+		'''
+		return item if isinstance(item, Batch) else [item]
+
+class Delivery(object):
+	'''
+		Everything needed to send an instance to its recipients. It is built
+		once per instance and shared by all the sending threads and processes.
+		Messages that were prerendered come from the spool. How long each
+		stage takes is recorded in timings and saved on the instance.
+
+		When the instance has nothing that changes from one recipient to the
+		next (no placeholders, tracking or unsubscribe link) the message is
+		built once and sent to Batches of up to batch_size recipients each.
+	'''
+
+	def __init__(self, instance, subject, text, limiter, pool, spool=None, timings=None):
+		self.instance     = instance
+		self.subject      = subject
+		self.real_from    = instance.email.from_email_address
+		self.text         = text
+		self.template     = MessageTemplate(subject, instance.email.smtp_from_address, text)
+		self.limiter      = limiter
+		self.pool         = pool
+		self.spool        = spool
+		self.timings      = StageTimings() if timings is None else timings
+		self.batch_size   = 1
+		if not instance.compiled_html.personalized:
+			self.batch_size = settings.AMAZON_SMTP.get('recipients_per_message', 50)
+
+	@property
+	def batched(self):
+		return self.batch_size > 1
+
+	def batches(self, chunks):
+		'''
+			The chunks of InstanceRecipientDetails as chunks of Batches
+		'''
+		for chunk in chunks:
+			yield [Batch(chunk[i:i + self.batch_size]) for i in xrange(0, len(chunk), self.batch_size)]
+
+	def message(self, recipient_details):
+		'''
+			The message customized for the recipient of recipient_details. Its
+			attributes are those looked up along with it by
+			Instance.pending_recipient_chunks(). A Batch gets the one message
+			every recipient is sent.
+		'''
+		if isinstance(recipient_details, Batch):
+			if getattr(self, '_batch_message', None) is None:
+				self._batch_message = self.template.render(Batch.TO, self.instance.compiled_html.render(None, {}))
+			return self._batch_message
+		if self.spool is not None:
+			msg = self.spool.get(recipient_details.pk)
+			if msg is not None:
+				return msg
+		recipient       = recipient_details.recipient
+		started         = time.time()
+		customized_html = self.instance.compiled_html.render(recipient, recipient_details.attributes)
+		rendered        = time.time()
+		msg             = self.template.render(recipient.email_address, customized_html)
+		self.timings.record(StageTimings.RENDERING, rendered - started)
+		self.timings.record(StageTimings.SERIALIZATION, time.time() - rendered)
+		return msg
+
+	def send(self, processes=1, engine='threads'):
+		'''
+			Send to every recipient of the instance that hasn't been sent to
+			yet, then record how it went on the instance. engine is one of
+			ENGINES. With more than one process the recipients are sharded
+			across worker processes that each run the engine, otherwise they
+			are all sent by the engine in this process. The limiter is shared
+			evenly with any other instances sending at the same time.
+
+			Batched instances are always sent with threads in this process.
+			There is nothing to render and a fraction of the SMTP
+			transactions, so neither would gain anything.
+
+			The spool is closed once sending is done.
+		'''
+		sender       = ENGINES[engine]
+		concurrency  = sender.concurrency()
+		start        = time.time()
+		# Anything sent by an earlier attempt doesn't count towards the rate
+		already_sent = self.instance.sent_count
+		limiter      = self.limiter
+		self.limiter = limiter.share()
+		try:
+			if self.batched:
+				log.info('Nothing is personalized, sending to %d recipients per message' % self.batch_size)
+				chunks    = self.batches(self.instance.pending_recipient_chunks(timings=self.timings))
+				throttles = ThreadedSender(self, ThreadedSender.concurrency()).send(Audience(chunks))
+			elif processes > 1:
+				throttles = MultiprocessSender(self, processes, sender, max(concurrency / processes, 1)).send()
+			else:
+				throttles = sender(self, concurrency).send(Audience(self.instance.pending_recipient_chunks(spool=self.spool, timings=self.timings)))
+		finally:
+			self.limiter.close()
+			self.limiter = limiter
+			# finish() removes the spool once everything is sent
+			if self.spool is not None:
+				self.spool.close()
+				self.spool = None
+		log.info('Timings for %s: %s' % (self.instance.email.title, self.timings))
+		duration = time.time() - start
+		self.instance.finish(throttles, self.instance.sent_count - already_sent, duration, self.timings)
+
+class Audience(object):
+	'''
+		The InstanceRecipientDetails to send to, loaded chunk by chunk by a
+		background thread into a bounded queue. Sending starts as soon as the
+		first chunk is loaded and loading waits whenever sending falls behind,
+		so memory use stays the same however many recipients there are.
+		Details to try again go on a separate list so a sender never waits
+		on a full queue.
+	'''
+
+	# How long to wait for details before checking whether loading finished
+	_POLL = .1
+
+	def __init__(self, chunks, size=2000):
+		self._chunks  = chunks
+		self._queue   = Queue.Queue(maxsize=size)
+		self._retries = collections.deque()
+		self._loaded  = threading.Event()
+		self._stopped = threading.Event()
+		self._loader  = threading.Thread(target=self._load, name='AudienceLoader')
+		self._loader.daemon = True
+
+	def start(self):
+		self._loader.start()
+
+	def stop(self):
+		'''
+			Throw away whatever hasn't been sent and stop loading
+		'''
+		self._stopped.set()
+		if self._loader.is_alive():
+			self._loader.join()
+		self._retries.clear()
+		while True:
+			try:
+				self._queue.get_nowait()
+			except Queue.Empty:
+				break
+
+	def _load(self):
+		try:
+			for chunk in self._chunks:
+				for details in chunk:
+					while not self._stopped.is_set():
+						try:
+							self._queue.put(details, timeout=self._POLL)
+							break
+						except Queue.Full:
+							pass
+				if self._stopped.is_set():
+					break
+		except Exception:
+			log.exception('Unable to load the recipients')
+		finally:
+			self._loaded.set()
+			connection.close()
+
+	@property
+	def waiting(self):
+		'''
+			How many details are waiting to be handed out
+		'''
+		return self._queue.qsize() + len(self._retries)
+
+	@property
+	def finished(self):
+		'''
+			Whether everything has been handed out
+		'''
+		return self._stopped.is_set() or (self._loaded.is_set() and self.waiting == 0)
+
+	def get(self, block=True):
+		'''
+			The next details to send. Returns None once everything has been
+			handed out or, if block is False, when nothing is waiting.
+		'''
+		while not self._stopped.is_set():
+			try:
+				return self._retries.popleft()
+			except IndexError:
+				pass
+			try:
+				return self._queue.get(block, self._POLL)
+			except Queue.Empty:
+				if not block or self.finished:
+					return None
+		return None
+
+	def retry(self, recipient_details):
+		'''
+			Hand recipient_details out again later
+		'''
+		if not self._stopped.is_set():
+			self._retries.append(recipient_details)
+
+class SendingThread(threading.Thread):
+	'''
+		Takes InstanceRecipientDetails from the audience and sends them until
+		there are no more or the sender has more threads than it wants.
+	'''
+
+	_AMAZON_RECONNECT_THRESHOLD = 10
+	_ERROR_THRESHOLD            = 20
+
+	def __init__(self, sender):
+		super(SendingThread, self).__init__()
+		self.sender = sender
+
+	def run(self):
+		try:
+			self._send()
+		finally:
+			self.sender.retire(self, done=True)
+
+	def _send(self):
+		delivery          = self.sender.delivery
+		audience          = self.sender.audience
+		reconnect_counter = 0
+		error_counter     = 0
+
+		while True:
+			if self.sender.retire(self):
+				log.debug('%s not needed, exiting.' % self.name)
+				break
+
+			item = audience.get()
+			if item is None:
+				log.debug('%s no more recipients, exiting.' % self.name)
+				break
+			details   = Batch.details(item)
+			addresses = [recipient_details.recipient.email_address for recipient_details in details]
+			amazon    = None
+			recorded  = False
+
+			try:
+				# Before taking a connection, which a failure here would leak
+				msg = delivery.message(item)
+
+				try:
+					amazon = delivery.pool.get()
+				except SMTPConnectionPool.ConnectionException:
+					if reconnect_counter == SendingThread._AMAZON_RECONNECT_THRESHOLD:
+						log.debug('%s, reached reconnect threshold' % self.name)
+						raise
+					reconnect_counter += 1
+					self.sender.controller.congested()
+					time.sleep(float(1) + random.random())
+					audience.retry(item)
+					continue
+
+				# Wait for our turn so we don't exceed the sending rate
+				try:
+					with delivery.timings.time(StageTimings.THROTTLING):
+						delivery.limiter.acquire(len(details))
+				except SendingLimiter.QuotaExceeded:
+					log.error('%s, daily sending quota reached, exiting' % self.name)
+					delivery.pool.put(amazon, sent=0)
+					audience.stop()
+					return
+
+				log.debug('thread: %s, email: %s' % (self.name, ', '.join(addresses)))
+				reusable = False
+				accepted = 0
+				started  = time.time()
+				try:
+					with delivery.timings.time(StageTimings.SMTP):
+						refused = amazon.sendmail(delivery.real_from, addresses, msg)
+				except smtplib.SMTPRecipientsRefused, e:
+					reusable = True
+					self._refused(details, e.recipients)
+				except smtplib.SMTPResponseException, e:
+					reusable = True
+					if e.smtp_error.find('Maximum sending rate exceeded') >= 0:
+						log.debug('thread %s, maximum sending rate exceeded, backing off' % self.name)
+						self.sender.throttled()
+						self.sender.controller.congested()
+						audience.retry(item)
+					else:
+						for recipient_details in details:
+							recipient_details.exception_msg = str(e)
+				except smtplib.SMTPServerDisconnected:
+					# Connection error
+					log.debug('thread %s, connection error, sleeping for a bit' % self.name)
+					self.sender.controller.congested()
+					time.sleep(float(1) + random.random())
+					audience.retry(item)
+				else:
+					reusable = True
+					accepted = len(details) - len(refused)
+					self._refused(details, refused)
+					when = datetime.now()
+					for recipient_details in details:
+						if recipient_details.exception_msg is None:
+							recipient_details.when = when
+					self.sender.controller.sent(time.time() - started)
+				finally:
+					# Only recipients Amazon accepted count against the quota
+					if accepted > 0:
+						delivery.limiter.accepted(accepted)
+					if accepted < len(details):
+						delivery.limiter.release(len(details) - accepted)
+					if reusable:
+						delivery.pool.put(amazon)
+					else:
+						delivery.pool.discard(amazon)
+					amazon = None
+					for recipient_details in details:
+						if recipient_details.when is not None or recipient_details.exception_msg is not None:
+							self.sender.status_writer.record(recipient_details.pk, recipient_details.when, recipient_details.exception_msg)
+					recorded = True
+			except Exception, e:
+				if amazon is not None:
+					delivery.pool.discard(amazon)
+				# Don't leave the recipients unsent with nothing to say why
+				if not recorded:
+					for recipient_details in details:
+						self.sender.status_writer.record(recipient_details.pk, None, str(e))
+				if error_counter == SendingThread._ERROR_THRESHOLD:
+					log.debug('%s, reached error threshold, exiting' % self.name)
+					audience.stop()
+					return
+				error_counter += 1
+				log.exception('%s exception' % self.name)
+
+	def _refused(self, details, refused):
+		'''
+			Record the recipients the server refused. refused is keyed by
+			address, like smtplib reports them.
+		'''
+		for recipient_details in details:
+			error = refused.get(recipient_details.recipient.email_address)
+			if error is not None:
+				recipient_details.exception_msg = str(smtplib.SMTPResponseException(*error))
+
+class Sender(object):
+	'''
+		Base for the delivery engines. The recipients to send to come from an
+		Audience and the outcome of each message is written by a StatusWriter
+		so whatever does the sending never touches the database.
+	'''
+
+	def __init__(self, delivery):
+		self.delivery      = delivery
+		self.audience      = None
+		self.status_writer = StatusWriter(delivery.instance.recipient_details.model, timings=delivery.timings, failed=self._unrecorded)
+		self.throttles     = 0
+		self._lock         = threading.Lock()
+
+	@classmethod
+	def concurrency(cls):
+		'''
+			How many messages the engine should have in flight at once
+		'''
+		raise NotImplementedError
+
+	def throttled(self):
+		with self._lock:
+			self.throttles += 1
+		self.delivery.limiter.throttled()
+
+	def _unrecorded(self):
+		'''
+			Called by the status writer when it can't write outcomes. Anyone
+			sent to without the outcome being written would be sent to again
+			on resume, so stop sending.
+		'''
+		log.error('Unable to record what was sent, stopping')
+		self.audience.stop()
+
+	def send(self, audience):
+		'''
+			Send to everyone in audience. Returns how many times Amazon
+			throttled the sending.
+		'''
+		self.audience = audience
+		self.audience.start()
+		self.status_writer.start()
+		try:
+			self._run()
+		finally:
+			self.audience.stop()
+			# Make sure the status of everything that was sent is written
+			self.status_writer.close()
+		return self.throttles
+
+	def _run(self):
+		'''
+			Send to everyone in the audience
+		'''
+		raise NotImplementedError
+
+class ThreadedSender(Sender):
+	'''
+		Sends with up to a number of threads in this process, each with its
+		own SMTP connection. How many are running is decided by a
+		ConcurrencyController so small sends only use a few threads and large
+		ones settle on as many as Amazon keeps up with.
+	'''
+
+	# How often to check whether threads need starting
+	_POLL = .1
+
+	def __init__(self, delivery, threads):
+		super(ThreadedSender, self).__init__(delivery)
+		self.threads    = threads
+		# With several worker processes this process sends its share of the
+		# rate, in proportion to its share of the threads. The rate is per
+		# recipient and the controller counts messages.
+		share           = float(threads) / max(threads, self.concurrency())
+		self.controller = ConcurrencyController(delivery.limiter.bucket.rate * share / delivery.batch_size, threads)
+		self._running   = set()
+
+	@classmethod
+	def concurrency(cls):
+		return settings.AMAZON_SMTP['rate'] - 1
+
+	def retire(self, thread, done=False):
+		'''
+			Whether thread should exit because more threads are running than
+			the controller wants. done says it is exiting anyway.
+		'''
+		with self._lock:
+			if done or len(self._running) > self.controller.limit:
+				self._running.discard(thread)
+				return True
+			return False
+
+	def _run(self):
+		log.debug('spin up sending threads...')
+		while True:
+			limit = self.controller.adjust(self.audience.waiting > 0)
+			with self._lock:
+				running = len(self._running)
+				if running == 0 and self.audience.finished:
+					break
+				# Never more threads than there are messages for
+				for i in xrange(running, min(limit, running + self.audience.waiting)):
+					thread = SendingThread(self)
+					self._running.add(thread)
+					thread.start()
+			time.sleep(self._POLL)
+
+class EventLoopSender(Sender):
+	'''
+		Sends with many SMTP sessions driven by a single asyncore loop in
+		this process. A thread spends most of its time waiting on SMTP round
+		trips, so this keeps far more messages in flight than there could be
+		threads. The sessions are paced by the same SendingLimiter and a
+		message is retried the same way as with threads when Amazon
+		throttles the sending or the connection drops.
+	'''
+
+	_AMAZON_RECONNECT_THRESHOLD = 10
+	_ERROR_THRESHOLD            = 20
+
+	# Longest to wait on the server before treating the session as dead
+	_TIMEOUT = 60
+
+	# Longest to go without checking on reconnects and timeouts
+	_POLL = .05
+
+	def __init__(self, delivery, sessions):
+		super(EventLoopSender, self).__init__(delivery)
+		self.sessions    = sessions
+		self._map        = {}
+		self._open       = set()
+		self._ready      = []
+		self._reconnects = []
+		self._next       = None
+		self._started    = {}
+		self._waiting    = None
+		self._in_flight  = 0
+		self._failures   = 0
+		self._errors     = 0
+		self._stopped    = False
+
+	@classmethod
+	def concurrency(cls):
+		return settings.AMAZON_SMTP.get('sessions', 200)
+
+	def _connect(self):
+		pool    = self.delivery.pool
+		session = SMTPSession(self, pool.host, pool.port, pool.username, pool.password, pool.ssl, map=self._map)
+		self._open.add(session)
+
+	def _stop(self):
+		self._stopped = True
+		self._next    = None
+		self.audience.stop()
+
+	def _grow(self):
+		'''
+			Open sessions for the messages waiting on one, up to self.sessions.
+			Sessions that closed are only replaced once their reconnect delay
+			is up.
+		'''
+		now              = time.time()
+		self._reconnects = [at for at in self._reconnects if at > now]
+		waiting          = self.audience.waiting + (0 if self._next is None else 1)
+		wanted           = min(self.sessions, self._in_flight + waiting)
+		for i in xrange(len(self._open) + len(self._reconnects), wanted):
+			self._connect()
+
+	def _run(self):
+		while self._in_flight > 0 or not (self._stopped or (self._next is None and self.audience.finished)):
+			if not self._stopped:
+				self._grow()
+			wait = self._dispatch()
+
+			now = time.time()
+			for session in list(self._open):
+				if session.waiting and now - session.last_activity > self._TIMEOUT:
+					log.debug('SMTP session timed out')
+					session.handle_close()
+
+			timeout = wait if 0 < wait < self._POLL else self._POLL
+			if len(self._map) > 0:
+				asyncore.loop(timeout=timeout, count=1, map=self._map)
+			else:
+				time.sleep(timeout)
+
+		self._shutdown()
+
+	def _dispatch(self):
+		'''
+			Hand out messages to the ready sessions while the rate allows.
+			Returns how long until the rate allows another.
+		'''
+		delivery = self.delivery
+		while len(self._ready) > 0 and not self._stopped:
+			if self._next is None:
+				self._next = self.audience.get(block=False)
+				if self._next is None:
+					break
+			try:
+				wait = delivery.limiter.try_acquire()
+			except SendingLimiter.QuotaExceeded:
+				log.error('Daily sending quota reached, stopping')
+				self._stop()
+				break
+			if wait > 0:
+				if self._waiting is None:
+					self._waiting = time.time()
+				return wait
+			if self._waiting is not None:
+				delivery.timings.record(StageTimings.THROTTLING, time.time() - self._waiting)
+				self._waiting = None
+
+			recipient_details, self._next = self._next, None
+			try:
+				msg = delivery.message(recipient_details)
+			except Exception:
+				log.exception('Unable to build the message for %s' % recipient_details.recipient.email_address)
+				delivery.limiter.release()
+				self._errors += 1
+				if self._errors == self._ERROR_THRESHOLD:
+					log.debug('Reached error threshold, stopping')
+					self._stop()
+				continue
+
+			log.debug('email: %s' % recipient_details.recipient.email_address)
+			self._in_flight += 1
+			session = self._ready.pop()
+			self._started[session] = time.time()
+			session.start(recipient_details, delivery.real_from, recipient_details.recipient.email_address, msg)
+		return 0
+
+	def _done(self, session, recipient_details, accepted=False):
+		self._in_flight -= 1
+		# Only messages Amazon accepted count against the quota
+		if accepted:
+			self.delivery.limiter.accepted()
+		else:
+			self.delivery.limiter.release()
+		self.delivery.timings.record(StageTimings.SMTP, time.time() - self._started.pop(session))
+		if recipient_details.when is not None or recipient_details.exception_msg is not None:
+			self.status_writer.record(recipient_details.pk, recipient_details.when, recipient_details.exception_msg)
+
+	def session_ready(self, session):
+		self._failures = 0
+		self._ready.append(session)
+
+	def session_sent(self, session, recipient_details):
+		recipient_details.when = datetime.now()
+		self._done(session, recipient_details, accepted=True)
+
+	def session_refused(self, session, recipient_details, code, reply):
+		if reply.find('Maximum sending rate exceeded') >= 0:
+			log.debug('maximum sending rate exceeded, backing off')
+			self.throttled()
+			self.audience.retry(recipient_details)
+		else:
+			recipient_details.exception_msg = str(smtplib.SMTPResponseException(code, reply))
+		self._done(session, recipient_details)
+
+	def session_closed(self, session, recipient_details):
+		self._open.discard(session)
+		if session in self._ready:
+			self._ready.remove(session)
+		if not session.logged_in:
+			self._failures += 1
+			if self._failures == self._AMAZON_RECONNECT_THRESHOLD:
+				log.error('Reached reconnect threshold, stopping')
+				self._stop()
+		if recipient_details is not None:
+			# Connection error. Try it again on another connection.
+			log.debug('connection error, retrying')
+			self.audience.retry(recipient_details)
+			self._done(session, recipient_details)
+		self._reconnects.append(time.time() + float(1) + random.random())
+		self._reconnects.sort()
+
+	def _shutdown(self):
+		for session in list(self._open):
+			if session.logged_in:
+				session.quit()
+			else:
+				session.close()
+		deadline = time.time() + 5
+		while len(self._map) > 0 and time.time() < deadline:
+			asyncore.loop(timeout=self._POLL, count=1, map=self._map)
+		asyncore.close_all(map=self._map)
+
+class MultiprocessSender(object):
+	'''
+		Shards the recipients of an instance across worker processes that
+		each send their shard with one of the ENGINES. Rendering and building
+		messages is CPU bound so this gets around the GIL. The workers share
+		the process wide SendingLimiter, which lives in shared memory, so
+		together they stay within the rate and quota. Each worker reports
+		its timings back to be added to the delivery's.
+	'''
+
+	def __init__(self, delivery, processes, sender, concurrency):
+		self.delivery    = delivery
+		self.processes   = processes
+		self.sender      = sender
+		self.concurrency = concurrency
+
+	def _work(self, shard, results):
+		# Only report what the worker times itself
+		self.delivery.timings = StageTimings()
+		try:
+			sender    = self.sender(self.delivery, self.concurrency)
+			throttles = sender.send(Audience(self.delivery.instance.pending_recipient_chunks(shard, self.processes, self.delivery.spool, self.delivery.timings)))
+		except Exception:
+			log.exception('Worker for shard %d failed' % shard)
+			results.put((shard, None, self.delivery.timings.summary()))
+		else:
+			results.put((shard, throttles, self.delivery.timings.summary()))
+		finally:
+			connection.close()
+
+	def send(self):
+		'''
+			Returns how many times Amazon throttled the sending. No other
+			thread may be running, since one holding a lock when the workers
+			are forked would leave it locked in them (see ConcurrentSends).
+		'''
+		# Build the compiled html, and with it the tracked URLs, once here.
+		# Workers that each built their own would race to create the same
+		# URL rows.
+		self.delivery.instance.compiled_html
+
+		# Each worker needs its own database connection
+		connection.close()
+
+		results = multiprocessing.Queue()
+		workers = []
+		for shard in xrange(0, self.processes):
+			worker = multiprocessing.Process(target=self._work, args=(shard, results), name='SendingWorker-%d' % shard)
+			worker.start()
+			workers.append(worker)
+
+		throttles = 0
+		pending   = set(range(0, self.processes))
+		while len(pending) > 0:
+			try:
+				shard, shard_throttles, timings = results.get(timeout=1)
+			except Queue.Empty:
+				# A worker that died without reporting back is never going to
+				if not any(worker.is_alive() for worker in workers) and results.empty():
+					break
+				continue
+			pending.discard(shard)
+			self.delivery.timings.merge(timings)
+			if shard_throttles is None:
+				log.error('Worker for shard %d did not finish' % shard)
+			else:
+				log.debug('Worker for shard %d finished' % shard)
+				throttles += shard_throttles
+
+		for shard in pending:
+			log.error('Worker for shard %d exited without reporting back' % shard)
+		for worker in workers:
+			worker.join()
+		return throttles
+
+ENGINES = {
+	'threads'   : ThreadedSender,
+	'eventloop' : EventLoopSender,
+}
@@ -0,0 +1,168 @@
+from django.conf import settings
+from array       import array
+import bisect
+import errno
+import glob
+import logging
+import mmap
+import os
+import re
+
+log = logging.getLogger(__name__)
+
+class Spool(object):
+	'''
+		Messages rendered ahead of sending, read back through mmap. The
+		messages are appended one after the other to the data file. The
+		index file has the InstanceRecipientDetails pk, offset and length of
+		each one, in pk order.
+
+		A spool is written under the time its instance was prerendered and
+		only sent from once sending claims it (see claim()). One written for
+		an earlier prerender, or finished after sending started, is never
+		used.
+	'''
+
+	DATA, INDEX = '.spool', '.index'
+
+	_NAME = re.compile(r'^instance-(\d+)[.-]')
+
+	def __init__(self, path):
+		index = array('L')
+		with open(path + self.INDEX, 'rb') as f:
+			index.fromstring(f.read())
+		self._pks     = index[0::3]
+		self._offsets = index[1::3]
+		self._lengths = index[2::3]
+		self._file    = open(path + self.DATA, 'rb')
+		self._data    = None
+		if len(self._pks) > 0:
+			self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+	@classmethod
+	def folder(cls):
+		return getattr(settings, 'SPOOL_FOLDER', os.path.join(settings.PROJECT_FOLDER, 'spool'))
+
+	@classmethod
+	def path(cls, instance_id, prerendered=None):
+		'''
+			Where the spool of an instance is kept, without the extension. The
+			SPOOL_FOLDER setting is the folder. With prerendered, where it is
+			written when the instance was prerendered at that time.
+		'''
+		name = 'instance-%d' % instance_id
+		if prerendered is not None:
+			name += prerendered.strftime('-%Y%m%d%H%M%S')
+		return os.path.join(cls.folder(), name)
+
+	@classmethod
+	def claim(cls, instance_id, prerendered):
+		'''
+			Make the spool written when the instance was prerendered at
+			prerendered the one it is sent with. Returns whether there was a
+			complete one.
+		'''
+		source = cls.path(instance_id, prerendered)
+		target = cls.path(instance_id)
+		if not os.path.exists(source + cls.INDEX):
+			return False
+		os.rename(source + cls.DATA, target + cls.DATA)
+		# The index is what makes the spool visible
+		os.rename(source + cls.INDEX, target + cls.INDEX)
+		return True
+
+	@classmethod
+	def instance_ids(cls):
+		'''
+			The pks of the instances with anything in the spool folder
+		'''
+		try:
+			names = os.listdir(cls.folder())
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise
+			return set()
+		return set(int(match.group(1)) for match in (cls._NAME.match(name) for name in names) if match is not None)
+
+	@classmethod
+	def open(cls, instance_id):
+		'''
+			The spool of an instance. None if it doesn't have a complete one
+			that was claimed for sending.
+		'''
+		path = cls.path(instance_id)
+		if not os.path.exists(path + cls.INDEX):
+			return None
+		return cls(path)
+
+	@classmethod
+	def remove(cls, instance_id):
+		'''
+			Delete every spool of an instance, including ones being written
+			and ones for earlier prerenders
+		'''
+		path = cls.path(instance_id)
+		for name in glob.glob(path + '.*') + glob.glob(path + '-*'):
+			try:
+				os.remove(name)
+			except OSError, e:
+				if e.errno != errno.ENOENT:
+					raise
+
+	def __len__(self):
+		return len(self._pks)
+
+	def __contains__(self, pk):
+		i = bisect.bisect_left(self._pks, pk)
+		return i < len(self._pks) and self._pks[i] == pk
+
+	def get(self, pk):
+		'''
+			The message for the InstanceRecipientDetails pk, None if it
+			wasn't rendered
+		'''
+		i = bisect.bisect_left(self._pks, pk)
+		if i == len(self._pks) or self._pks[i] != pk:
+			return None
+		return self._data[self._offsets[i]:self._offsets[i] + self._lengths[i]]
+
+	def close(self):
+		if self._data is not None:
+			self._data.close()
+		self._file.close()
+
+class SpoolWriter(object):
+	'''
+		Writes a Spool. Messages have to be written in pk order. Nothing can
+		be read until the writer is closed, so a spool that was only partly
+		written is never used.
+	'''
+
+	def __init__(self, path):
+		folder = os.path.dirname(path)
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+		self._path   = path
+		self._file   = open(path + Spool.DATA + '.tmp', 'wb')
+		self._index  = array('L')
+		self._offset = 0
+
+	def write(self, pk, message):
+		self._file.write(message)
+		self._index.extend((pk, self._offset, len(message)))
+		self._offset += len(message)
+
+	def close(self):
+		self._file.close()
+		with open(self._path + Spool.INDEX + '.tmp', 'wb') as f:
+			f.write(self._index.tostring())
+		os.rename(self._path + Spool.DATA + '.tmp', self._path + Spool.DATA)
+		# The index is what makes the spool visible
+		os.rename(self._path + Spool.INDEX + '.tmp', self._path + Spool.INDEX)
+
+	def abort(self):
+		self._file.close()
+		try:
+			os.remove(self._path + Spool.DATA + '.tmp')
+		except OSError:
+			pass
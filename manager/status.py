@@ -0,0 +1,143 @@
+from django.db      import connection, transaction
+from manager.timings import StageTimings
+import logging
+import Queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class StatusWriter(threading.Thread):
+	'''
+		Writes the outcome of each message to InstanceRecipientDetails on
+		behalf of the sending threads. Outcomes are collected and written with
+		one UPDATE per batch instead of one per message, every batch_size
+		outcomes or every interval seconds, whichever comes first. The
+		sending threads never touch the database themselves. Each write is
+		timed if timings are given.
+
+		A batch that can't be written is rolled back and tried again on a
+		new connection. If it still can't be, failed is called so sending
+		stops instead of sending to more recipients whose outcome would be
+		lost (and who would be sent to again on resume). The outcomes are
+		kept and tried again until the writer is closed.
+	'''
+
+	# Rows per UPDATE. Each row takes 5 query parameters and SQLite
+	# allows at most 999.
+	_ROWS_PER_QUERY = 150
+
+	# How many times to try writing a batch and how long to wait before
+	# trying again. The wait doubles each time.
+	_ATTEMPTS   = 4
+	_RETRY_WAIT = .5
+
+	_STOP = object()
+
+	def __init__(self, model, batch_size=500, interval=.5, timings=None, failed=None):
+		super(StatusWriter, self).__init__(name='StatusWriter')
+		self.model      = model
+		self.batch_size = batch_size
+		self.interval   = interval
+		self.timings    = timings
+		self.failed     = failed
+		self._failed    = False
+		self._queue     = Queue.Queue()
+
+	def record(self, details_id, when, exception_msg=None):
+		'''
+			Called by the sending threads once a message has been sent
+			(when) or has failed for good (exception_msg).
+		'''
+		self._queue.put((details_id, when, exception_msg))
+
+	def close(self):
+		'''
+			Write whatever is outstanding and wait for the writer to finish.
+		'''
+		self._queue.put(self._STOP)
+		self.join()
+
+	def run(self):
+		batch    = []
+		deadline = time.time() + self.interval
+		try:
+			while True:
+				try:
+					outcome = self._queue.get(timeout=max(deadline - time.time(), 0))
+				except Queue.Empty:
+					outcome = None
+
+				if outcome is self._STOP:
+					break
+				elif outcome is not None:
+					batch.append(outcome)
+
+				if len(batch) >= self.batch_size or time.time() >= deadline:
+					if self._write(batch):
+						batch = []
+					deadline = time.time() + self.interval
+		finally:
+			if not self._write(batch):
+				log.error('Unable to write the status of these InstanceRecipientDetails: %s' % ', '.join(str(outcome[0]) for outcome in batch))
+			connection.close()
+
+	def _write(self, batch):
+		'''
+			Write batch, trying again on a new connection if that fails.
+			Returns whether it was written.
+		'''
+		if len(batch) == 0:
+			return True
+		wait = self._RETRY_WAIT
+		for attempt in xrange(1, self._ATTEMPTS + 1):
+			start = time.time()
+			try:
+				self._update(batch)
+			except Exception:
+				log.exception('Unable to write the status of %d message(s), attempt %d of %d' % (len(batch), attempt, self._ATTEMPTS))
+				try:
+					transaction.rollback_unless_managed()
+					connection.close()
+				except Exception:
+					log.exception('Unable to roll back')
+				if attempt < self._ATTEMPTS:
+					time.sleep(wait)
+					wait *= 2
+			else:
+				if self.timings is not None:
+					self.timings.record(StageTimings.STATUS, time.time() - start)
+				return True
+
+		if not self._failed and self.failed is not None:
+			self._failed = True
+			self.failed()
+		return False
+
+	def _update(self, batch):
+		qn    = connection.ops.quote_name
+		table = qn(self.model._meta.db_table)
+		pk    = qn(self.model._meta.pk.column)
+		when  = qn(self.model._meta.get_field('when').column)
+		msg   = qn(self.model._meta.get_field('exception_msg').column)
+
+		cursor = connection.cursor()
+		for i in xrange(0, len(batch), self._ROWS_PER_QUERY):
+			rows   = batch[i:i + self._ROWS_PER_QUERY]
+			cases  = ' '.join(['WHEN %s THEN %s'] * len(rows))
+			params = []
+			for details_id, sent, exception_msg in rows:
+				params.extend([details_id, connection.ops.value_to_db_datetime(sent)])
+			for details_id, sent, exception_msg in rows:
+				params.extend([details_id, exception_msg])
+			params.extend([details_id for details_id, sent, exception_msg in rows])
+
+			cursor.execute(
+				'UPDATE %s SET %s = CASE %s %s END, %s = CASE %s %s END WHERE %s IN (%s)' % (
+					table,
+					when, pk, cases,
+					msg,  pk, cases,
+					pk, ', '.join(['%s'] * len(rows))
+				),
+				params)
+		transaction.commit_unless_managed()
@@ -5,15 +5,38 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test              import TestCase, Client
+from django.test              import TestCase, TransactionTestCase, Client
 from manager.models           import *
 from django.conf              import settings
 from datetime                 import datetime, timedelta
-from util                     import calc_url_mac, calc_open_mac, calc_unsubscribe_mac
+from util                     import calc_url_mac, calc_link_mac, calc_open_mac, calc_unsubscribe_mac, LinkFactory
+from manager.rendering        import MessageTemplate
+from manager.throttling       import TokenBucket, SendingLimiter, ConcurrencyController
+from manager.connections      import SMTPConnectionPool
+from manager.status           import StatusWriter
+from manager.sending          import Delivery, Audience, ThreadedSender, EventLoopSender, Batch
+from manager.content          import ContentFetcher
+from manager.scheduling       import Scheduler, ConcurrentSends
+from manager.spool            import Spool, SpoolWriter
+from manager.timings          import StageTimings
+from manager.tracking         import TrackingBuffer, DestinationCache, TrackingApplication, RecentOpens, record_open
+from django.test.utils        import override_settings
 from django.core.urlresolvers import reverse
 from django.http              import HttpResponseRedirect
 from django.core.exceptions   import SuspiciousOperation
+from django.core.signals      import request_finished
+from django.db                import close_connection, DatabaseError
 import urllib
+import time
+import wsgiref.util
+import threading
+import asyncore
+import smtpd
+import socket
+import BaseHTTPServer
+import os
+import shutil
+import tempfile
 
 class RecipientTestCase(TestCase):
 	def setUp(self):
@@ -46,6 +69,20 @@ class RecipientTestCase(TestCase):
 		with self.assertRaises(AttributeError):
 			self.recipient.blah
 
+	def test_attribute_lookup(self):
+		'''
+			The bulk lookup should return the same values as __getattr__ and
+			leave out missing attributes.
+		'''
+		RecipientAttribute.objects.create(
+			recipient=self.recipient,
+			name='last_name',
+			value=u'Recipi\xe9nt')
+		attributes = RecipientAttribute.objects.for_recipients(['first_name', 'last_name', 'blah'], [self.recipient.pk])
+		self.assertEqual(attributes[self.recipient.pk]['first_name'], self.recipient.first_name)
+		self.assertEqual(attributes[self.recipient.pk]['last_name'], self.recipient.last_name)
+		self.assertTrue('blah' not in attributes[self.recipient.pk])
+
 class EmailTestCase(TestCase):
 	def setUp(self):
 		now = datetime.now()
@@ -116,6 +153,7 @@ class EmailTestCase(TestCase):
 			]))
 			self.assertTrue(response.status_code == 302)
 
+			TrackingBuffer.shared().consume()
 			clicks = URLClick.objects.all()
 			self.assertTrue(clicks.count() == 1)
 
@@ -123,6 +161,8 @@ class EmailTestCase(TestCase):
 		'''
 			Test the open tracking. Must be called in the context of an email instance.
 		'''
+		# Pks are reused between tests
+		RecentOpens.shared().clear()
 		client   = Client()
 		response = client.get('?'.join([
 			reverse('manager-email-open'),
@@ -133,6 +173,7 @@ class EmailTestCase(TestCase):
 			})
 		]))
 		self.assertTrue(response.status_code == 200)
+		TrackingBuffer.shared().consume()
 		opens = InstanceOpen.objects.all()
 		self.assertTrue(opens.count() == 1)
 
@@ -215,4 +256,1154 @@ class EmailTestCase(TestCase):
 		self.email.send_time = (datetime.now() + timedelta(seconds=settings.PREVIEW_LEAD_TIME + 30)).time()
 		self.email.save()
 		self.email.send_preview()
-		self.assertTrue(PreviewInstance.objects.count() == 1)
\ No newline at end of file
+		self.assertTrue(PreviewInstance.objects.count() == 1)
+
+class CompiledTemplateTestCase(TestCase):
+	def setUp(self):
+		now = datetime.now()
+
+		self.recipient = Recipient.objects.create(email_address='recipient@example.com')
+		RecipientAttribute.objects.create(recipient=self.recipient, name='First Name', value='Test')
+
+		self.email = Email.objects.create(
+			active             = True,
+			title              = 'Test Email',
+			subject            = 'Test Email Subject',
+			source_html_uri    = 'http://example.com/email.html',
+			start_date         = now.date(),
+			send_time          = now.time(),
+			from_email_address = 'webcom@ucf.edu',
+			track_urls         = True,
+			track_opens        = True
+			)
+		self.instance = Instance.objects.create(
+			email           = self.email,
+			sent_html       = '\n'.join([
+				'<p>Hello !@!First Name!@!,</p>',
+				'<p>!@!Missing!@!</p>',
+				'<a href="http://example.com/">Home</a>',
+				'<a href="http://example.com/">Home again</a>',
+				'<a href="mailto:someone@example.com">Mail</a>',
+				'!@!UNSUBSCRIBE!@!'
+			]),
+			requested_start = now,
+			opens_tracked   = True,
+			urls_tracked    = True
+			)
+
+	def test_render(self):
+		'''
+			Rendering should produce the same html as replacing each placeholder,
+			URL and the unsubscribe link in the whole document.
+		'''
+		compiled   = self.instance.compiled_html
+		urls       = list(URL.objects.filter(instance=self.instance).order_by('position'))
+		attributes = RecipientAttribute.objects.for_recipients(compiled.placeholders, [self.recipient.pk])
+		html       = compiled.render(self.recipient, attributes.get(self.recipient.pk, {}))
+
+		links    = LinkFactory(self.instance.pk)
+		expected = self.instance.sent_html
+		expected = expected.replace('!@!First Name!@!', 'Test').replace('!@!Missing!@!', '')
+		for url in urls:
+			expected = expected.replace('href="%s"' % url.name, 'href="%s"' % links.tracking_url(url, self.recipient.pk), 1)
+		expected += '<img src="%s" />' % links.open_url(self.recipient.pk)
+		expected = expected.replace('!@!UNSUBSCRIBE!@!', '<a href="%s" style="color:blue;text-decoration:none;">unsubscribe</a>' % self.recipient.unsubscribe_url)
+
+		self.assertEqual(len(urls), 2)
+		self.assertEqual(html, expected)
+
+class InstanceTestCase(TestCase):
+	def setUp(self):
+		now = datetime.now()
+		self.email = Email.objects.create(
+			title              = 'Test Email',
+			subject            = 'Test Email Subject',
+			source_html_uri    = 'http://example.com/email.html',
+			start_date         = now.date(),
+			send_time          = now.time(),
+			from_email_address = 'webcom@ucf.edu',
+			track_urls         = True
+			)
+		self.instance = Instance.objects.create(
+			email           = self.email,
+			sent_html       = '<a href="http://example.com/">Home</a>\n<a href="http://example.com/">Home</a>',
+			requested_start = now,
+			urls_tracked    = True
+			)
+		for i in xrange(0, 2):
+			recipient = Recipient.objects.create(email_address='recipient%d@example.com' % i)
+			InstanceRecipientDetails.objects.create(recipient=recipient, instance=self.instance)
+
+	def test_tracking_urls(self):
+		'''
+			Looking up the tracking URLs again, e.g. on resume, should find the
+			same URLs instead of creating new ones.
+		'''
+		urls = [url.pk for url in self.instance.tracking_urls]
+		self.assertEqual(len(urls), 2)
+		self.assertEqual([url.pk for url in self.instance.tracking_urls], urls)
+		self.assertEqual(URL.objects.filter(instance=self.instance).count(), 2)
+
+	def test_interrupted(self):
+		now      = datetime.now()
+		interval = timedelta(seconds=settings.PROCESSING_INTERVAL_DURATION)
+
+		# Just started
+		self.assertEqual(Instance.objects.interrupted(now=now).count(), 0)
+
+		# Started a while ago but still sending
+		Instance.objects.filter(pk=self.instance.pk).update(start=now - interval * 2)
+		self.instance.recipient_details.filter(recipient__email_address='recipient0@example.com').update(when=now)
+		self.assertEqual(Instance.objects.interrupted(now=now).count(), 0)
+
+		# Stopped sending
+		self.assertEqual(list(Instance.objects.interrupted(now=now + interval * 2)), [self.instance])
+
+		# Finished
+		Instance.objects.filter(pk=self.instance.pk).update(end=now)
+		self.assertEqual(Instance.objects.interrupted(now=now + interval * 2).count(), 0)
+
+	def test_prerender(self):
+		'''
+			Prerendered messages should be sent as they were rendered unless
+			the email changes before sending starts.
+		'''
+		folder = tempfile.mkdtemp()
+		try:
+			with override_settings(SPOOL_FOLDER=folder):
+				# Stamps are whole seconds, and the email mustn't look modified since
+				self.instance.prerendered = datetime.now().replace(microsecond=0) + timedelta(seconds=1)
+				self.instance.save()
+				self.instance.prerender('Subject', None)
+				# Not sent from until sending claims it
+				self.assertEqual(Spool.open(self.instance.pk), None)
+
+				recipients = Recipient.objects.all()
+				self.instance.start_prerendered(self.instance.sent_html, None, recipients)
+				self.assertEqual(self.instance.prerendered, None)
+				spool = Spool.open(self.instance.pk)
+				self.assertEqual(len(spool), 2)
+				for details in self.instance.recipient_details.all():
+					message = spool.get(details.pk)
+					self.assertTrue('To: %s' % details.recipient.email_address in message)
+					self.assertTrue('recipient=%d&' % details.recipient.pk in message)
+				spool.close()
+
+				self.instance.prerendered = datetime.now() - timedelta(minutes=1)
+				self.instance.start_prerendered(self.instance.sent_html, None, recipients)
+				self.assertEqual(Spool.open(self.instance.pk), None)
+		finally:
+			shutil.rmtree(folder)
+
+	def test_prerender_superseded(self):
+		'''
+			A spool should never be sent from once sending has started without
+			it, or if it was written for an earlier prerender.
+		'''
+		folder = tempfile.mkdtemp()
+		try:
+			with override_settings(SPOOL_FOLDER=folder):
+				prerendered = datetime.now().replace(microsecond=0) + timedelta(seconds=1)
+				self.instance.prerendered = prerendered
+				self.instance.save()
+				# Sending started while it was being prerendered
+				Instance.objects.filter(pk=self.instance.pk).update(prerendered=None)
+				self.instance.prerender('Subject', None)
+				self.assertEqual(os.listdir(folder), [])
+				self.assertFalse(Spool.claim(self.instance.pk, prerendered))
+
+				# Written for an earlier prerender
+				Instance.objects.filter(pk=self.instance.pk).update(prerendered=prerendered)
+				self.instance.prerender('Subject', None)
+				self.instance.prerendered = prerendered + timedelta(seconds=1)
+				self.instance.start_prerendered(self.instance.sent_html, None, Recipient.objects.all())
+				self.assertEqual(Spool.open(self.instance.pk), None)
+				self.assertEqual(os.listdir(folder), [])
+		finally:
+			shutil.rmtree(folder)
+
+	def test_clean_spool(self):
+		'''
+			Prerendered instances that won't be sent should be deleted, and
+			spools that can't be sent from anymore removed.
+		'''
+		folder = tempfile.mkdtemp()
+		try:
+			with override_settings(SPOOL_FOLDER=folder):
+				now      = datetime.now()
+				interval = timedelta(seconds=settings.PROCESSING_INTERVAL_DURATION)
+				Email.objects.filter(pk=self.email.pk).update(active=True)
+				self.instance.prerendered = now.replace(microsecond=0)
+				self.instance.save()
+				self.instance.prerender('Subject', None)
+				sent = Instance.objects.create(email=self.email, sent_html='', requested_start=now, end=now)
+				SpoolWriter(Spool.path(sent.pk)).close()
+				SpoolWriter(Spool.path(sent.pk + 1000)).close()
+
+				Instance.objects.clean_spool(now=now)
+				self.assertTrue(Instance.objects.filter(pk=self.instance.pk).exists())
+				self.assertEqual(Spool.instance_ids(), set([self.instance.pk]))
+
+				# Its send time has passed
+				Instance.objects.clean_spool(now=now + interval * 2)
+				self.assertFalse(Instance.objects.filter(pk=self.instance.pk).exists())
+				self.assertEqual(os.listdir(folder), [])
+		finally:
+			shutil.rmtree(folder)
+
+class SchedulerTestCase(TestCase):
+	def setUp(self):
+		self.email = Email.objects.create(
+			active             = True,
+			title              = 'Test Email',
+			subject            = 'Test Email Subject',
+			source_html_uri    = 'http://example.com/email.html',
+			start_date         = datetime(2013, 1, 31).date(),
+			send_time          = datetime(2013, 1, 31, 9, 0).time(),
+			recurrence         = Email.Recurs.monthly,
+			from_email_address = 'webcom@ucf.edu',
+			preview            = True
+			)
+
+	def test_next_send(self):
+		'''
+			The next send should follow the same rules as sending_today().
+		'''
+		self.assertEqual(self.email.next_send(datetime(2013, 1, 31, 9, 0)), datetime(2013, 1, 31, 9, 0))
+		self.assertEqual(self.email.next_send(datetime(2013, 1, 31, 9, 1)), datetime(2013, 3, 31, 9, 0))
+
+		self.email.recurrence = Email.Recurs.weekly
+		self.assertEqual(self.email.next_send(datetime(2013, 2, 1)), datetime(2013, 2, 7, 9, 0))
+
+		self.email.recurrence = Email.Recurs.never
+		self.assertEqual(self.email.next_send(datetime(2013, 2, 1)), None)
+
+		for recurrence in (Email.Recurs.never, Email.Recurs.daily, Email.Recurs.weekly, Email.Recurs.monthly):
+			self.email.recurrence = recurrence
+			self.email.save()
+			for day in xrange(0, 40):
+				now = datetime(2013, 1, 25) + timedelta(days=day)
+				self.assertEqual(self.email.sends_on(now.date()), Email.objects.sending_today(now=now).exists())
+
+	def test_schedule(self):
+		'''
+			Sends and previews should be scheduled in order, including any
+			from the last processing interval.
+		'''
+		scheduler = Scheduler()
+		scheduler.load(now=datetime(2013, 3, 31, 9, 5))
+		self.assertEqual(scheduler.events, [
+			(datetime(2013, 3, 31, 9, 0), Scheduler.SEND, self.email.pk, datetime(2013, 3, 31, 9, 0)),
+		])
+
+		scheduler.load(now=datetime(2013, 3, 31, 7, 0))
+		self.assertEqual(sorted(scheduler.events), [
+			(datetime(2013, 3, 31, 8, 0), Scheduler.PREVIEW, self.email.pk, datetime(2013, 3, 31, 9, 0)),
+			(datetime(2013, 3, 31, 9, 0), Scheduler.SEND, self.email.pk, datetime(2013, 3, 31, 9, 0)),
+		])
+
+	def test_fire(self):
+		'''
+			An email already sent for the requested start shouldn't be sent
+			again but its next send should be scheduled.
+		'''
+		requested_start = datetime(2013, 3, 31, 9, 0)
+		Instance.objects.create(email=self.email, sent_html='', requested_start=requested_start)
+		scheduler = Scheduler()
+		scheduler.fire(Scheduler.SEND, self.email.pk, requested_start)
+		self.assertEqual(self.email.instances.count(), 1)
+		self.assertEqual(sorted(scheduler.events), [
+			(datetime(2013, 5, 31, 8, 0), Scheduler.PREVIEW, self.email.pk, datetime(2013, 5, 31, 9, 0)),
+			(datetime(2013, 5, 31, 9, 0), Scheduler.SEND, self.email.pk, datetime(2013, 5, 31, 9, 0)),
+		])
+
+class ConcurrentSendsTestCase(TestCase):
+	def test_processes(self):
+		'''
+			A send with worker processes should wait for the others and run
+			in the calling thread, so nothing else is running when it forks.
+		'''
+		sent    = []
+		threads = threading.active_count()
+		def send(processes=1):
+			time.sleep(.1)
+			sent.append((processes, threading.current_thread().name, threading.active_count() - threads))
+
+		sends = ConcurrentSends()
+		sends.start('Threaded', send)
+		sends.start('Processes', send, processes=2)
+		self.assertEqual(sent, [(1, 'Send-Threaded', 1), (2, threading.current_thread().name, 0)])
+		sends.wait()
+
+class TrackingBufferTestCase(TestCase):
+	def setUp(self):
+		now = datetime.now()
+		self.folder = tempfile.mkdtemp()
+		self.buffer = TrackingBuffer(os.path.join(self.folder, 'tracking'))
+		self.buffer._SETTLE = 0
+		self.email = Email.objects.create(
+			title              = 'Test Email',
+			subject            = 'Test Email Subject',
+			source_html_uri    = 'http://example.com/email.html',
+			start_date         = now.date(),
+			send_time          = now.time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		self.instance  = Instance.objects.create(email=self.email, sent_html='', requested_start=now)
+		self.url       = URL.objects.create(instance=self.instance, name='http://example.com/', position=1)
+		self.recipient = Recipient.objects.create(email_address='recipient@example.com')
+		# Pks are reused between tests
+		RecentOpens.shared().clear()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def test_consume(self):
+		'''
+			Buffered clicks and opens should be inserted once. Ones for things
+			that don't exist are dropped, as are opens already recorded.
+		'''
+		self.buffer.click(self.recipient.pk, self.instance.pk, self.url.name, self.url.position)
+		self.buffer.click(self.recipient.pk, self.instance.pk, self.url.name, 2)
+		self.buffer.click(self.recipient.pk + 1, self.instance.pk, self.url.name, self.url.position)
+		self.buffer.open(self.recipient.pk, self.instance.pk)
+		self.buffer.open(self.recipient.pk, self.instance.pk)
+		self.assertEqual((URLClick.objects.count(), InstanceOpen.objects.count()), (0, 0))
+
+		self.assertEqual(self.buffer.consume(), (1, 1))
+		click = URLClick.objects.get()
+		self.assertEqual((click.recipient, click.url), (self.recipient, self.url))
+		self.assertTrue(datetime.now() - click.when < timedelta(minutes=1))
+		self.assertEqual(self.instance.opens.count(), 1)
+		self.assertEqual(os.listdir(self.folder), [])
+
+		self.buffer.open(self.recipient.pk, self.instance.pk)
+		self.assertEqual(self.buffer.consume(), (0, 0))
+
+		self.buffer.click_url(self.recipient.pk, self.url.pk)
+		self.buffer.click_url(self.recipient.pk, self.url.pk + 1)
+		self.assertEqual(self.buffer.consume(), (1, 0))
+		self.assertEqual(self.url.clicks.count(), 2)
+
+	def test_redirect(self):
+		'''
+			Links that carry the URL pk and links sent before them should both
+			redirect and have their clicks recorded.
+		'''
+		client = Client()
+		with override_settings(SPOOL_FOLDER=self.folder):
+			response = client.get('?'.join([
+				reverse('manager-email-redirect'),
+				urllib.urlencode({
+					'link'      :self.url.pk,
+					'recipient' :self.recipient.pk,
+					'mac'       :calc_link_mac(self.url.pk, self.recipient.pk)
+				})
+			]))
+			self.assertEqual(response.status_code, 302)
+			self.assertEqual(response['Location'], self.url.name)
+
+			response = client.get('?'.join([
+				reverse('manager-email-redirect'),
+				urllib.urlencode({
+					'instance'  :self.instance.pk,
+					'recipient' :self.recipient.pk,
+					'url'       :urllib.quote(self.url.name),
+					'position'  :self.url.position,
+					'mac'       :calc_url_mac(self.url.name, self.url.position, self.recipient.pk, self.instance.pk)
+				})
+			]))
+			self.assertEqual(response.status_code, 302)
+			self.assertEqual(response['Location'], self.url.name)
+
+			# Not found
+			response = client.get('?'.join([reverse('manager-email-redirect'), urllib.urlencode({'link':self.url.pk + 1})]))
+			self.assertNotEqual(response.status_code, 302)
+
+			buffer = TrackingBuffer.shared()
+			buffer._SETTLE = 0
+			self.assertEqual(buffer.consume(), (2, 0))
+
+	def test_application(self):
+		'''
+			The WSGI application should serve the tracking endpoints the same
+			way the views do and pass anything else on.
+		'''
+		def request(path, params, script_name=''):
+			environ = {'SCRIPT_NAME':script_name, 'PATH_INFO':path, 'QUERY_STRING':urllib.urlencode(params)}
+			wsgiref.util.setup_testing_defaults(environ)
+			response = {}
+			def start_response(status, headers):
+				response['status']  = status
+				response['headers'] = dict(headers)
+			response['body'] = ''.join(application(environ, start_response))
+			return response
+
+		application = TrackingApplication(fallback=lambda environ, start_response: ['fallback'])
+		# Like the test client, keep the test's connection open
+		request_finished.disconnect(close_connection)
+		self.addCleanup(request_finished.connect, close_connection)
+		with override_settings(SPOOL_FOLDER=self.folder):
+			response = request(reverse('manager-email-redirect'), {
+				'link'      :self.url.pk,
+				'recipient' :self.recipient.pk,
+				'mac'       :calc_link_mac(self.url.pk, self.recipient.pk)
+			})
+			self.assertEqual(response['status'], '302 FOUND')
+			self.assertEqual(response['headers']['Location'], self.url.name)
+
+			# Mounted on the endpoint itself
+			response = request('', {
+				'instance'  :self.instance.pk,
+				'recipient' :self.recipient.pk,
+				'mac'       :calc_open_mac(self.recipient.pk, self.instance.pk)
+			}, script_name=reverse('manager-email-open'))
+			self.assertEqual(response['status'], '200 OK')
+			self.assertEqual(response['headers']['Content-Type'], 'image/png')
+			self.assertEqual(response['body'], settings.DOT)
+
+			# Wrong mac, still redirects
+			response = request(reverse('manager-email-redirect'), {'link':self.url.pk, 'recipient':self.recipient.pk, 'mac':'wrong'})
+			self.assertEqual(response['status'], '302 FOUND')
+
+			response = request(reverse('manager-email-redirect'), {'link':self.url.pk + 1})
+			self.assertEqual(response['status'], '404 NOT FOUND')
+			self.assertEqual(request('/emails/', {})['body'], 'fallback')
+
+			buffer = TrackingBuffer.shared()
+			buffer._SETTLE = 0
+			self.assertEqual(buffer.consume(), (1, 1))
+
+	def test_recent_opens(self):
+		'''
+			Repeated opens should be dropped before they are buffered, and
+			ones forgotten since shouldn't be recorded twice.
+		'''
+		params = {
+			'instance'  :str(self.instance.pk),
+			'recipient' :str(self.recipient.pk),
+			'mac'       :calc_open_mac(self.recipient.pk, self.instance.pk)
+		}
+		with override_settings(SPOOL_FOLDER=self.folder):
+			buffer = TrackingBuffer.shared()
+			record_open(params)
+			record_open(params)
+			with open(buffer.path + '.events') as f:
+				self.assertEqual(len(f.readlines()), 1)
+			buffer._SETTLE = 0
+			self.assertEqual(buffer.consume(), (0, 1))
+
+			RecentOpens.shared().clear()
+			record_open(params)
+			self.assertEqual(buffer.consume(), (0, 0))
+		self.assertEqual(self.instance.opens.count(), 1)
+
+		recent = RecentOpens(size=2)
+		recent.add((1, 1))
+		recent.add((2, 1))
+		self.assertTrue((1, 1) in recent)
+		# Pushes out the least recently used
+		recent.add((3, 1))
+		self.assertFalse((2, 1) in recent)
+		self.assertTrue((1, 1) in recent)
+
+	def test_destinations(self):
+		'''
+			Destinations should be looked up once while they are cached.
+		'''
+		other = URL.objects.create(instance=self.instance, name='http://example.com/other', position=2)
+		cache = DestinationCache(size=1)
+		self.assertEqual(cache.get(self.url.pk), self.url.name)
+		self.assertEqual(cache.get(self.url.pk + other.pk), None)
+		URL.objects.filter(pk=self.url.pk).update(name='http://example.com/changed')
+		self.assertEqual(cache.get(self.url.pk), self.url.name)
+		# Pushes the first one out
+		self.assertEqual(cache.get(other.pk), other.name)
+		self.assertEqual(cache.get(self.url.pk), 'http://example.com/changed')
+
+class SpoolTestCase(TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.path   = os.path.join(self.folder, 'instance-1')
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def test_spool(self):
+		writer = SpoolWriter(self.path)
+		for pk in (3, 5, 8):
+			writer.write(pk, 'message %d' % pk)
+		# Not readable until it is completely written
+		self.assertFalse(os.path.exists(self.path + Spool.INDEX))
+		writer.close()
+
+		spool = Spool(self.path)
+		self.assertEqual(len(spool), 3)
+		self.assertEqual(spool.get(5), 'message 5')
+		self.assertEqual(spool.get(8), 'message 8')
+		self.assertEqual(spool.get(4), None)
+		self.assertTrue(3 in spool)
+		self.assertFalse(9 in spool)
+		spool.close()
+
+class LinkFactoryTestCase(TestCase):
+	def setUp(self):
+		now = datetime.now()
+		self.recipient = Recipient.objects.create(email_address='recipient@example.com')
+		self.email = Email.objects.create(
+			title              = 'Test Email',
+			subject            = 'Test Email Subject',
+			source_html_uri    = 'http://example.com/email.html',
+			start_date         = now.date(),
+			send_time          = now.time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		self.instance = Instance.objects.create(email=self.email, sent_html='', requested_start=now)
+		self.url      = URL.objects.create(instance=self.instance, name='http://example.com/?a=1&b=2', position=1)
+		self.links    = LinkFactory(self.instance.pk)
+
+	def test_links(self):
+		'''
+			The links should be the same as those built with calc_link_mac,
+			calc_open_mac and calc_unsubscribe_mac.
+		'''
+		for i in xrange(0, 2):
+			self.assertEqual(
+				self.links.tracking_url(self.url, self.recipient.pk),
+				'?'.join([
+					settings.PROJECT_URL + reverse('manager-email-redirect'),
+					urllib.urlencode({
+						'link'      :self.url.pk,
+						'recipient' :self.recipient.pk,
+						'mac'       :calc_link_mac(self.url.pk, self.recipient.pk)
+					})
+				]))
+			self.assertEqual(
+				self.links.open_url(self.recipient.pk),
+				'?'.join([
+					settings.PROJECT_URL + reverse('manager-email-open'),
+					urllib.urlencode({
+						'recipient':self.recipient.pk,
+						'instance' :self.instance.pk,
+						'mac'      :calc_open_mac(self.recipient.pk, self.instance.pk)
+					})
+				]))
+			self.assertEqual(
+				self.links.unsubscribe_url(self.recipient.pk),
+				'?'.join([
+					settings.PROJECT_URL + reverse('manager-recipient-subscriptions', kwargs={'pk':self.recipient.pk}, prefix='/'),
+					urllib.urlencode({
+						'mac'      :calc_unsubscribe_mac(self.recipient.pk)
+					})
+				]))
+
+class MessageTemplateTestCase(TestCase):
+	def test_render(self):
+		'''
+			Rendering should produce the same message as building and
+			serializing it with the email package.
+		'''
+		html = '<p>Hello,</p>\nFrom here on\n<p>From the team</p>'
+		for text in [None, 'Plain text\nFrom the team\n']:
+			for to in ['recipient@example.com', u'recipient@example.com', 'a.very.long.address.' * 5 + '@example.com', 'r\xe9cipient@example.com']:
+				template = MessageTemplate(u'Test Email Subject \xe9', 'Test <webcom@ucf.edu>', text)
+				msg      = template.build(to, html)
+				msg.set_boundary(template.boundary)
+				self.assertEqual(template.render(to, html), msg.as_string())
+
+	def test_boundary_in_html(self):
+		template = MessageTemplate('Test Email Subject', 'webcom@ucf.edu', None)
+		rendered = template.render('recipient@example.com', template.boundary)
+		self.assertEqual(rendered.count(template.boundary), 1)
+
+class AudienceTestCase(TestCase):
+	def test_get(self):
+		'''
+			Everything loaded, and retried, should be handed out even though
+			the queue holds less than all of it.
+		'''
+		audience = Audience(([i * 3 + j for j in xrange(0, 3)] for i in xrange(0, 4)), size=2)
+		audience.start()
+		handed_out = []
+		while True:
+			details = audience.get()
+			if details is None:
+				break
+			if details == 5 and 5 not in handed_out:
+				audience.retry(details)
+			handed_out.append(details)
+		self.assertEqual(sorted(handed_out), sorted(range(0, 12) + [5]))
+		self.assertTrue(audience.finished)
+
+	def test_stop(self):
+		audience = Audience(([i] for i in xrange(0, 100)), size=2)
+		audience.start()
+		audience.get()
+		audience.stop()
+		self.assertEqual(audience.get(), None)
+
+class SendingLimiterTestCase(TestCase):
+	def test_rate(self):
+		'''
+			Tokens should be handed out no faster than the rate.
+		'''
+		bucket = TokenBucket(50)
+		start  = time.time()
+		for i in xrange(0, 11):
+			bucket.acquire()
+		self.assertTrue(time.time() - start >= 0.19)
+
+	def test_rate_many(self):
+		'''
+			Taking more tokens than the bucket holds should hold up whatever
+			comes after for as long as they take.
+		'''
+		bucket = TokenBucket(50)
+		bucket.acquire(10)
+		start = time.time()
+		bucket.acquire()
+		self.assertTrue(time.time() - start >= 0.17)
+
+	def test_quota(self):
+		now     = datetime.now()
+		limiter = SendingLimiter(1000, 2, sent=[now - timedelta(hours=23), now - timedelta(hours=25)])
+		self.assertEqual(limiter.sent, 1)
+		limiter.acquire()
+		with self.assertRaises(SendingLimiter.QuotaExceeded):
+			limiter.acquire()
+		# Room is given back for messages that weren't accepted
+		limiter.release()
+		limiter.acquire()
+		limiter.accepted()
+		self.assertEqual(limiter.sent, 2)
+		with self.assertRaises(SendingLimiter.QuotaExceeded):
+			limiter.acquire()
+		# Sends leave the window after a day
+		limiter._expire(time.time() + 23.5 * 60 * 60)
+		self.assertEqual(limiter.sent, 1)
+		limiter.acquire()
+
+		# Every recipient of a message counts
+		limiter = SendingLimiter(1000, 3)
+		with self.assertRaises(SendingLimiter.QuotaExceeded):
+			limiter.acquire(4)
+		limiter.acquire(3)
+
+	def test_share(self):
+		'''
+			Instances sending at the same time should split the rate evenly and
+			share the quota.
+		'''
+		limiter = SendingLimiter(100, 3)
+		large   = limiter.share()
+		small   = limiter.share()
+		self.assertEqual((large.bucket.rate, small.bucket.rate), (50, 50))
+
+		self.assertEqual(small.try_acquire(), 0)
+		self.assertTrue(small.try_acquire() > 0)
+		large.acquire()
+		small.close()
+		self.assertEqual(large.bucket.rate, 100)
+		large.acquire()
+		with self.assertRaises(SendingLimiter.QuotaExceeded):
+			large.acquire()
+
+		# The share's tokens are given back when the quota is reached
+		limiter = SendingLimiter(1, 1)
+		share   = limiter.share()
+		limiter.acquire()
+		with self.assertRaises(SendingLimiter.QuotaExceeded):
+			share.acquire()
+		self.assertEqual(share.bucket.try_acquire(), 0)
+
+class StageTimingsTestCase(TestCase):
+	def test_record(self):
+		timings = StageTimings()
+		for seconds in (.002, .003, .004, .2):
+			timings.record(StageTimings.SMTP, seconds)
+		with timings.time(StageTimings.CONTENT):
+			pass
+
+		summary = timings.summary()
+		self.assertEqual(summary[StageTimings.SMTP]['count'], 4)
+		self.assertAlmostEqual(summary[StageTimings.SMTP]['total'], .209)
+		self.assertEqual(summary[StageTimings.SMTP]['max'], .2)
+		self.assertEqual(summary[StageTimings.CONTENT]['count'], 1)
+		self.assertEqual(timings.percentile(StageTimings.SMTP, .5), .005)
+		self.assertEqual(timings.percentile(StageTimings.SMTP, .95), .2)
+		self.assertEqual([row['stage'] for row in timings.rows()], [StageTimings.LABELS[StageTimings.CONTENT], StageTimings.LABELS[StageTimings.SMTP]])
+
+	def test_merge(self):
+		'''
+			Timings from another process or attempt should add up, including
+			after being saved and loaded again.
+		'''
+		first = StageTimings()
+		first.record(StageTimings.SMTP, .01)
+		second = StageTimings()
+		second.record(StageTimings.SMTP, .5)
+		second.record(StageTimings.STATUS, .01)
+		second.merge(StageTimings.loads(first.dumps()).summary())
+
+		summary = second.summary()
+		self.assertEqual(summary[StageTimings.SMTP]['count'], 2)
+		self.assertEqual(summary[StageTimings.SMTP]['max'], .5)
+		self.assertEqual(sum(summary[StageTimings.SMTP]['histogram']), 2)
+		self.assertEqual(summary[StageTimings.STATUS]['count'], 1)
+
+class ConcurrencyControllerTestCase(TestCase):
+	def test_growth(self):
+		'''
+			The limit should double until the first back off, then grow by one.
+		'''
+		controller = ConcurrencyController(100, 10)
+		now        = time.time()
+		self.assertEqual(controller.limit, 2)
+		self.assertEqual(controller.adjust(True, now + 1), 4)
+		self.assertEqual(controller.adjust(True, now + 2), 8)
+		controller.congested()
+		controller.congested()
+		self.assertEqual(controller.limit, 4)
+		self.assertEqual(controller.adjust(True, now + 3), 4)
+		self.assertEqual(controller.adjust(True, now + 4), 5)
+		self.assertEqual(controller.adjust(True, now + 5), 6)
+
+	def test_limits(self):
+		'''
+			The limit shouldn't grow without a backlog, at the target rate,
+			when latency goes up or past the maximum.
+		'''
+		controller = ConcurrencyController(1, 3)
+		now        = time.time()
+		self.assertEqual(controller.adjust(False, now + 1), 2)
+		self.assertEqual(controller.adjust(True, now + 2), 3)
+		self.assertEqual(controller.adjust(True, now + 3), 3)
+
+		controller = ConcurrencyController(1, 10)
+		now        = time.time()
+		controller.sent(.1)
+		self.assertEqual(controller.adjust(True, now + 1), 2)
+
+		controller = ConcurrencyController(100, 10)
+		now        = time.time()
+		controller.sent(.1)
+		self.assertEqual(controller.adjust(True, now + 1), 4)
+		controller.sent(.5)
+		self.assertEqual(controller.adjust(True, now + 2), 4)
+
+class LocalSMTPServer(smtpd.SMTPServer):
+	'''
+		A local debugging SMTP server so no mail leaves the machine. It runs
+		its own asyncore loop, on its own socket map, in a thread until it is
+		stopped, so servers of different tests never share a loop. Messages
+		to an address in replies get the next reply for it instead of being
+		accepted.
+	'''
+
+	def __init__(self, replies=None):
+		self._localaddr  = ('127.0.0.1', 0)
+		self._remoteaddr = None
+		self.map         = {}
+		self.messages    = []
+		self.replies     = replies or {}
+		self._stopped    = threading.Event()
+		asyncore.dispatcher.__init__(self, map=self.map)
+		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.set_reuse_addr()
+		self.bind(self._localaddr)
+		self.listen(5)
+		self.port = self.socket.getsockname()[1]
+
+		self._thread = threading.Thread(target=self._loop, name='LocalSMTPServer')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _loop(self):
+		while not self._stopped.is_set():
+			asyncore.loop(timeout=.1, use_poll=True, count=1, map=self.map)
+
+	def handle_accept(self):
+		pair = self.accept()
+		if pair is not None:
+			conn, addr = pair
+			channel    = smtpd.SMTPChannel(self, conn, addr)
+			# SMTPChannel always joins the global socket map
+			channel.del_channel()
+			channel._map = self.map
+			channel.set_socket(conn)
+
+	def process_message(self, peer, mailfrom, rcpttos, data):
+		replies = self.replies.get(rcpttos[0], [])
+		if len(replies) > 0:
+			return replies.pop(0)
+		self.messages.append((mailfrom, rcpttos, data))
+
+	def stop(self):
+		'''
+			Stop the loop and close the server and its connections
+		'''
+		self._stopped.set()
+		self._thread.join()
+		asyncore.close_all(map=self.map)
+
+class SMTPConnectionPoolTestCase(TestCase):
+	'''
+		Runs against a local debugging SMTP server so no mail leaves the machine.
+	'''
+	def setUp(self):
+		self.server = LocalSMTPServer()
+		self.pool   = SMTPConnectionPool('127.0.0.1', self.server.port, ssl=False, max_messages=2)
+
+	def tearDown(self):
+		self.pool.close()
+		self.server.stop()
+
+	def test_reuse(self):
+		connection = self.pool.get()
+		connection.sendmail('from@example.com', 'to@example.com', 'Subject: test\n\ntest')
+		self.pool.put(connection)
+		self.assertTrue(self.pool.get() is connection)
+
+		# Recycled after max_messages
+		self.pool.put(connection)
+		self.assertTrue(self.pool.get() is not connection)
+
+	def test_health_check(self):
+		connection = self.pool.get()
+		connection.close()
+		self.pool.put(connection, sent=0)
+		self.pool._NOOP_AFTER = -1
+		self.assertTrue(self.pool.get() is not connection)
+
+class StatusWriterTestCase(TransactionTestCase):
+	def setUp(self):
+		now = datetime.now()
+		self.email = Email.objects.create(
+			title              = 'Test Email',
+			subject            = 'Test Email Subject',
+			source_html_uri    = 'http://example.com/email.html',
+			start_date         = now.date(),
+			send_time          = now.time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		self.instance = Instance.objects.create(email=self.email, sent_html='', requested_start=now)
+		for i in xrange(0, 5):
+			recipient = Recipient.objects.create(email_address='recipient%d@example.com' % i)
+			InstanceRecipientDetails.objects.create(recipient=recipient, instance=self.instance)
+
+	def test_write(self):
+		'''
+			Everything recorded should be written once the writer is closed.
+		'''
+		details = list(self.instance.recipient_details.all())
+		writer  = StatusWriter(InstanceRecipientDetails, batch_size=2)
+		writer.start()
+		for recipient_details in details[:-1]:
+			writer.record(recipient_details.pk, datetime.now())
+		writer.record(details[-1].pk, None, 'failed')
+		writer.close()
+
+		self.assertEqual(self.instance.recipient_details.exclude(when=None).count(), 4)
+		self.assertEqual(InstanceRecipientDetails.objects.get(pk=details[-1].pk).exception_msg, 'failed')
+
+	def test_retry(self):
+		'''
+			A batch that can't be written should be tried again rather than
+			dropped. If it still can't be, sending should be told to stop and
+			the outcomes kept until they can be written.
+		'''
+		details  = list(self.instance.recipient_details.all())
+		failures = [2]
+		failed   = []
+		writer   = StatusWriter(InstanceRecipientDetails, interval=.05, failed=lambda: failed.append(True))
+		writer._RETRY_WAIT = 0
+		update   = writer._update
+		def flaky(batch):
+			if failures[0] > 0:
+				failures[0] -= 1
+				raise DatabaseError('Lost connection')
+			update(batch)
+		writer._update = flaky
+
+		writer.start()
+		writer.record(details[0].pk, datetime.now())
+		deadline = time.time() + 5
+		while self.instance.recipient_details.exclude(when=None).count() == 0 and time.time() < deadline:
+			time.sleep(.01)
+		self.assertEqual(failed, [])
+
+		# Every attempt at the next write fails
+		failures[0] = StatusWriter._ATTEMPTS
+		writer.record(details[1].pk, datetime.now())
+		deadline = time.time() + 5
+		while len(failed) == 0 and time.time() < deadline:
+			time.sleep(.01)
+		writer.close()
+
+		self.assertEqual(failed, [True])
+		self.assertEqual(self.instance.recipient_details.exclude(when=None).count(), 2)
+
+class EventLoopSenderTestCase(TransactionTestCase):
+	'''
+		Sends to a local debugging SMTP server that throttles, disconnects and
+		rejects the way Amazon can.
+	'''
+	def setUp(self):
+		now = datetime.now()
+		self.server = LocalSMTPServer(replies={
+			'throttled@example.com'    : ['454 Throttling failure: Maximum sending rate exceeded.'],
+			'disconnected@example.com' : ['421 Service not available, closing transmission channel'],
+			'rejected@example.com'     : ['554 Message rejected: Address blacklisted.'] * 2,
+		})
+
+		self.email = Email.objects.create(
+			title              = 'Test Email',
+			subject            = 'Test Email Subject',
+			source_html_uri    = 'http://example.com/email.html',
+			start_date         = now.date(),
+			send_time          = now.time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		self.instance = Instance.objects.create(email=self.email, sent_html='<p>Hello</p>', requested_start=now)
+		for address in ['recipient@example.com', 'throttled@example.com', 'disconnected@example.com', 'rejected@example.com']:
+			recipient = Recipient.objects.create(email_address=address)
+			InstanceRecipientDetails.objects.create(recipient=recipient, instance=self.instance)
+
+	def tearDown(self):
+		self.server.stop()
+
+	def test_send(self):
+		'''
+			Throttled and disconnected messages should be retried, rejected
+			ones recorded as failed.
+		'''
+		delivery = Delivery(
+			self.instance,
+			self.email.subject,
+			None,
+			SendingLimiter(1000, 1000),
+			SMTPConnectionPool('127.0.0.1', self.server.port, ssl=False))
+		throttles = EventLoopSender(delivery, 2).send(Audience(self.instance.pending_recipient_chunks()))
+
+		self.assertEqual(throttles, 1)
+		self.assertEqual(
+			sorted(rcpttos[0] for mailfrom, rcpttos, data in self.server.messages),
+			['disconnected@example.com', 'recipient@example.com', 'throttled@example.com'])
+		self.assertEqual(self.instance.recipient_details.exclude(when=None).count(), 3)
+		rejected = self.instance.recipient_details.get(recipient__email_address='rejected@example.com')
+		self.assertEqual(rejected.when, None)
+		self.assertTrue('Address blacklisted' in rejected.exception_msg)
+
+class ThreadedSenderTestCase(TransactionTestCase):
+	'''
+		Sends to a local debugging SMTP server with threads.
+	'''
+	def setUp(self):
+		now = datetime.now()
+		self.server = LocalSMTPServer()
+		self.email = Email.objects.create(
+			title              = 'Test Email',
+			subject            = 'Test Email Subject',
+			source_html_uri    = 'http://example.com/email.html',
+			start_date         = now.date(),
+			send_time          = now.time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		self.instance = Instance.objects.create(email=self.email, sent_html='<p>Hello !@!First Name!@!</p>', requested_start=now)
+		for address in ['recipient@example.com', 'broken@example.com']:
+			recipient = Recipient.objects.create(email_address=address)
+			InstanceRecipientDetails.objects.create(recipient=recipient, instance=self.instance)
+
+	def tearDown(self):
+		self.server.stop()
+
+	def test_message_failure(self):
+		'''
+			A message that can't be built should be recorded as failed without
+			taking a connection, and the rest still sent.
+		'''
+		pool     = SMTPConnectionPool('127.0.0.1', self.server.port, ssl=False)
+		delivery = Delivery(self.instance, self.email.subject, None, SendingLimiter(1000, 1000), pool)
+		message  = delivery.message
+		def broken(recipient_details):
+			if recipient_details.recipient.email_address == 'broken@example.com':
+				raise ValueError('Unable to render')
+			return message(recipient_details)
+		delivery.message = broken
+		taken = []
+		get   = pool.get
+		def counted():
+			taken.append(True)
+			return get()
+		pool.get = counted
+
+		ThreadedSender(delivery, 2).send(Audience(self.instance.pending_recipient_chunks()))
+
+		self.assertEqual([rcpttos for mailfrom, rcpttos, data in self.server.messages], [['recipient@example.com']])
+		self.assertEqual(len(taken), 1)
+		broken = self.instance.recipient_details.get(recipient__email_address='broken@example.com')
+		self.assertEqual(broken.when, None)
+		self.assertEqual(broken.exception_msg, 'Unable to render')
+		pool.close()
+
+	def test_spool(self):
+		'''
+			Prerendered messages should be sent from the spool, which is closed
+			afterwards.
+		'''
+		folder = tempfile.mkdtemp()
+		try:
+			writer = SpoolWriter(os.path.join(folder, 'instance'))
+			for details in self.instance.recipient_details.order_by('pk'):
+				writer.write(details.pk, 'Subject: Prerendered\n\nTo %s' % details.recipient.email_address)
+			writer.close()
+			spool = Spool(os.path.join(folder, 'instance'))
+
+			pool     = SMTPConnectionPool('127.0.0.1', self.server.port, ssl=False)
+			delivery = Delivery(self.instance, self.email.subject, None, SendingLimiter(1000, 1000), pool, spool=spool)
+			delivery.send()
+			pool.close()
+
+			self.assertEqual(
+				sorted(data for mailfrom, rcpttos, data in self.server.messages),
+				['Subject: Prerendered\n\nTo broken@example.com', 'Subject: Prerendered\n\nTo recipient@example.com'])
+			self.assertEqual(delivery.spool, None)
+			self.assertTrue(spool._file.closed)
+		finally:
+			shutil.rmtree(folder)
+
+	def test_resumed_send_rate(self):
+		'''
+			The send rate of a resumed send should only count what it sent.
+		'''
+		for i in xrange(0, 10):
+			recipient = Recipient.objects.create(email_address='earlier%d@example.com' % i)
+			InstanceRecipientDetails.objects.create(recipient=recipient, instance=self.instance, when=datetime.now() - timedelta(hours=1))
+		finished = []
+		finish   = self.instance.finish
+		def recorded(throttles, sent, duration, timings=None):
+			finished.append((sent, duration))
+			finish(throttles, sent, duration, timings)
+		self.instance.finish = recorded
+
+		pool = SMTPConnectionPool('127.0.0.1', self.server.port, ssl=False)
+		Delivery(self.instance, self.email.subject, None, SendingLimiter(1000, 1000), pool).send()
+		pool.close()
+
+		self.assertEqual(len(self.server.messages), 2)
+		sent, duration = finished[0]
+		self.assertEqual(sent, 2)
+		self.assertAlmostEqual(Instance.objects.get(pk=self.instance.pk).send_rate, 2 / max(duration, 0.001), places=3)
+
+class BatchedDeliveryTestCase(TransactionTestCase):
+	'''
+		Sends an instance that isn't personalized to a local debugging SMTP
+		server.
+	'''
+	def setUp(self):
+		now = datetime.now()
+		self.server = LocalSMTPServer()
+
+		self.email = Email.objects.create(
+			title              = 'Test Email',
+			subject            = 'Test Email Subject',
+			source_html_uri    = 'http://example.com/email.html',
+			start_date         = now.date(),
+			send_time          = now.time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		self.instance = Instance.objects.create(email=self.email, sent_html='<p>Hello</p>', requested_start=now)
+		for i in xrange(0, 5):
+			recipient = Recipient.objects.create(email_address='recipient%d@example.com' % i)
+			InstanceRecipientDetails.objects.create(recipient=recipient, instance=self.instance)
+
+	def tearDown(self):
+		self.server.stop()
+
+	def test_send(self):
+		'''
+			Each message should go to a batch of recipients, who are each
+			counted against the rate and quota, and every recipient should be
+			recorded as sent.
+		'''
+		limiter = SendingLimiter(1000, 1000)
+		with override_settings(AMAZON_SMTP=dict(settings.AMAZON_SMTP, rate=10, recipients_per_message=2)):
+			delivery = Delivery(
+				self.instance,
+				self.email.subject,
+				None,
+				limiter,
+				SMTPConnectionPool('127.0.0.1', self.server.port, ssl=False))
+			self.assertTrue(delivery.batched)
+			delivery.send()
+
+		self.assertEqual(sorted(len(rcpttos) for mailfrom, rcpttos, data in self.server.messages), [1, 2, 2])
+		for mailfrom, rcpttos, data in self.server.messages:
+			self.assertTrue('To: %s' % Batch.TO in data)
+		self.assertEqual(limiter.sent, 5)
+		self.assertEqual(self.instance.recipient_details.exclude(when=None).count(), 5)
+
+		timings = StageTimings.loads(Instance.objects.get(pk=self.instance.pk).timings).summary()
+		self.assertEqual(timings[StageTimings.SMTP]['count'], 3)
+		self.assertEqual(timings[StageTimings.THROTTLING]['count'], 3)
+
+class ContentFetcherTestCase(TestCase):
+	'''
+		Fetches from a local HTTP server that supports conditional GETs.
+	'''
+	class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+		def do_GET(self):
+			self.server.requests.append(self.path)
+			if self.path == '/slow':
+				time.sleep(.5)
+			if self.headers.get('If-None-Match') == '"1"':
+				self.send_response(304)
+				self.end_headers()
+				return
+			body = 'content of %s' % self.path
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/html; charset=utf-8')
+			self.send_header('Content-Length', str(len(body)))
+			if self.path != '/uncached':
+				self.send_header('ETag', '"1"')
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, *args):
+			pass
+
+	def setUp(self):
+		self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), self.Handler)
+		self.server.requests = []
+		# The client gives up on slow requests
+		self.server.handle_error = lambda request, client_address: None
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def url(self, path):
+		return 'http://127.0.0.1:%d%s' % (self.server.server_address[1], path)
+
+	def test_fetch(self):
+		'''
+			Content should come back in the order asked for and unchanged
+			content should come from the cache.
+		'''
+		fetcher = ContentFetcher(CachedContent.objects)
+		self.assertEqual(fetcher.fetch(self.url('/html'), self.url('/uncached')), [u'content of /html', u'content of /uncached'])
+		self.assertEqual(CachedContent.objects.lookup(self.url('/html')).etag, '"1"')
+		self.assertEqual(CachedContent.objects.lookup(self.url('/uncached')), None)
+
+		CachedContent.objects.filter(uri=self.url('/html')).update(content='cached')
+		self.assertEqual(fetcher.fetch(self.url('/html')), [u'cached'])
+
+	def test_timeout(self):
+		'''
+			A server that takes too long should be given up on.
+		'''
+		fetcher = ContentFetcher(timeout=.1)
+		self.assertRaises(IOError, fetcher.fetch, self.url('/html'), self.url('/slow'))
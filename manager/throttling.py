@@ -0,0 +1,410 @@
+import logging
+import multiprocessing
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class TokenBucket(object):
+	'''
+		Hands out tokens at a steady rate. Anything that wants to do something
+		rate limited takes a token first and blocks until one is available.
+		More tokens than the bucket holds can be taken once it is full. The
+		bucket then goes into debt, which later takers wait out.
+		With multiprocess=True the bucket lives in shared memory so processes
+		forked after it is created all draw from it.
+	'''
+
+	_TOKENS, _STAMP, _RATE = range(0, 3)
+
+	def __init__(self, rate, capacity=1, multiprocess=False):
+		self.capacity = float(capacity)
+		if multiprocess:
+			self._state = multiprocessing.Array('d', [self.capacity, time.time(), float(rate)])
+			self._lock  = self._state.get_lock()
+		else:
+			self._state = [self.capacity, time.time(), float(rate)]
+			self._lock  = threading.Lock()
+
+	@property
+	def rate(self):
+		return self._state[self._RATE]
+
+	@rate.setter
+	def rate(self, rate):
+		'''
+			Change the rate. Processes sharing the bucket see the change too.
+		'''
+		with self._lock:
+			self._refill(time.time())
+			self._state[self._RATE] = float(rate)
+
+	def _refill(self, now):
+		state               = self._state
+		state[self._TOKENS] = min(self.capacity, state[self._TOKENS] + (now - state[self._STAMP]) * self.rate)
+		state[self._STAMP]  = now
+
+	def acquire(self, tokens=1):
+		'''
+			Block until the requested number of tokens is available.
+		'''
+		needed = min(tokens, self.capacity)
+		while True:
+			with self._lock:
+				self._refill(time.time())
+				if self._state[self._TOKENS] >= needed:
+					self._state[self._TOKENS] -= tokens
+					return
+				wait = (needed - self._state[self._TOKENS]) / self.rate
+			time.sleep(wait)
+
+	def try_acquire(self, tokens=1):
+		'''
+			Take the requested number of tokens if they are available now.
+			Returns how long to wait for them otherwise, 0 if they were taken.
+		'''
+		needed = min(tokens, self.capacity)
+		with self._lock:
+			self._refill(time.time())
+			if self._state[self._TOKENS] >= needed:
+				self._state[self._TOKENS] -= tokens
+				return 0
+			return (needed - self._state[self._TOKENS]) / self.rate
+
+	def refund(self, tokens=1):
+		'''
+			Give back tokens that were taken but not used
+		'''
+		with self._lock:
+			self._state[self._TOKENS] = min(self.capacity, self._state[self._TOKENS] + tokens)
+
+	def pause(self, seconds):
+		'''
+			Stop handing out tokens for a number of seconds. Pauses that overlap
+			don't add up.
+		'''
+		with self._lock:
+			self._refill(time.time())
+			self._state[self._TOKENS] = min(self._state[self._TOKENS], -seconds * self.rate)
+
+class SendingLimiter(object):
+	'''
+		Keeps sending within the Amazon SES limits. The sending rate is
+		enforced with a token bucket and the 24 hour quota with a rolling
+		window of how many recipients were sent to in each minute of the last
+		day. Only messages Amazon accepted count against the quota: acquire()
+		sets room aside for a message and the sender then either counts it
+		with accepted() or gives the room back with release(), e.g. when the
+		message is throttled and retried.
+		There is one limiter per process so every thread sending, for every
+		instance, shares the same budget. It is kept in shared memory so
+		worker processes forked for sending share it too.
+	'''
+
+	class QuotaExceeded(Exception):
+		pass
+
+	# How long to stop sending after Amazon says we are going too fast
+	_THROTTLE_PAUSE = 1
+
+	# Minutes in the quota window
+	_WINDOW = 24 * 60
+
+	_shared      = None
+	_shared_lock = threading.Lock()
+
+	def __init__(self, rate, quota, sent=(), multiprocess=False):
+		'''
+			sent has the time (a datetime) each recipient was sent to
+			recently, e.g. by an earlier process
+		'''
+		self.bucket        = TokenBucket(rate, multiprocess=multiprocess)
+		self.quota         = quota
+		self._multiprocess = multiprocess
+		self._shares       = []
+		self._shares_lock  = threading.Lock()
+		minute             = int(time.time() // 60)
+		if multiprocess:
+			self._minutes   = multiprocessing.Array('l', self._WINDOW, lock=False)
+			self._minute    = multiprocessing.Value('l', minute, lock=False)
+			self._sent      = multiprocessing.Value('l', 0, lock=False)
+			self._reserved  = multiprocessing.Value('l', 0, lock=False)
+			self._throttles = multiprocessing.Value('l', 0)
+			self._lock      = multiprocessing.Lock()
+		else:
+			self._minutes   = [0] * self._WINDOW
+			self._minute    = _Count(minute)
+			self._sent      = _Count(0)
+			self._reserved  = _Count(0)
+			self._throttles = _Count(0)
+			self._lock      = threading.Lock()
+		for when in sent:
+			self._count(int(time.mktime(when.timetuple()) // 60), 1)
+
+	@property
+	def sent(self):
+		'''
+			How many recipients were sent to in the last 24 hours
+		'''
+		with self._lock:
+			self._expire(time.time())
+			return self._sent.value
+
+	@property
+	def throttles(self):
+		return self._throttles.value
+
+	@classmethod
+	def shared(cls, rate, quota, sent_in_last_day):
+		'''
+			The process wide limiter. sent_in_last_day is a callable that
+			returns when each recipient sent to in the last day was sent to.
+			It is only called when the limiter is first created.
+		'''
+		with cls._shared_lock:
+			if cls._shared is None:
+				cls._shared = cls(rate, quota, sent_in_last_day(), multiprocess=True)
+			return cls._shared
+
+	def _expire(self, now):
+		'''
+			Forget the minutes that have left the window since it last moved
+		'''
+		minute = int(now // 60)
+		if minute - self._minute.value >= self._WINDOW:
+			for slot in xrange(0, self._WINDOW):
+				self._minutes[slot] = 0
+			self._sent.value = 0
+		else:
+			for expired in xrange(self._minute.value + 1, minute + 1):
+				slot              = expired % self._WINDOW
+				self._sent.value -= self._minutes[slot]
+				self._minutes[slot] = 0
+		self._minute.value = max(self._minute.value, minute)
+
+	def _count(self, minute, recipients):
+		if self._minute.value - self._WINDOW < minute <= self._minute.value:
+			self._minutes[minute % self._WINDOW] += recipients
+			self._sent.value                     += recipients
+
+	def _reserve(self, recipients):
+		self._expire(time.time())
+		if self._sent.value + self._reserved.value + recipients > self.quota:
+			raise self.QuotaExceeded()
+		self._reserved.value += recipients
+
+	def acquire(self, recipients=1):
+		'''
+			Block until a message to a number of recipients can be sent. Amazon
+			counts each recipient against the rate and quota. Raises
+			QuotaExceeded when the daily quota doesn't have room for them.
+			Follow up with accepted() or release().
+		'''
+		with self._lock:
+			self._reserve(recipients)
+		self.bucket.acquire(recipients)
+
+	def try_acquire(self, recipients=1):
+		'''
+			Like acquire() but doesn't block. Returns how long to wait before
+			trying again, 0 if the message can be sent now.
+		'''
+		with self._lock:
+			self._reserve(recipients)
+			wait = self.bucket.try_acquire(recipients)
+			if wait > 0:
+				self._reserved.value -= recipients
+			return wait
+
+	def accepted(self, recipients=1):
+		'''
+			Count recipients that room was set aside for as sent to
+		'''
+		now = time.time()
+		with self._lock:
+			self._expire(now)
+			self._reserved.value -= recipients
+			self._count(int(now // 60), recipients)
+
+	def release(self, recipients=1):
+		'''
+			Give back the room set aside for recipients that weren't sent to
+		'''
+		with self._lock:
+			self._reserved.value -= recipients
+
+	def throttled(self):
+		'''
+			Record that Amazon rejected a message for exceeding the sending rate
+			and back off for a bit.
+		'''
+		with self._lock:
+			self._throttles.value += 1
+		self.bucket.pause(self._THROTTLE_PAUSE)
+
+	def share(self):
+		'''
+			A share of the limiter for one instance to send with. Instances
+			sending at the same time each get an equal part of the rate so a
+			large instance doesn't hold up a small one. The quota is shared by
+			all of them. Close the share once sending is done so the others
+			get its part of the rate.
+		'''
+		with self._shares_lock:
+			share = LimiterShare(self, TokenBucket(self.bucket.rate, multiprocess=self._multiprocess))
+			self._shares.append(share)
+			self._rebalance()
+		return share
+
+	def _close_share(self, share):
+		with self._shares_lock:
+			if share in self._shares:
+				self._shares.remove(share)
+				self._rebalance()
+
+	def _rebalance(self):
+		for share in self._shares:
+			share.bucket.rate = self.bucket.rate / len(self._shares)
+
+class LimiterShare(object):
+	'''
+		One instance's part of a SendingLimiter (see SendingLimiter.share()).
+		It can be used anywhere a SendingLimiter is. Messages are paced by
+		its own bucket as well as the limiter's so the limiter still backs
+		everyone off when Amazon throttles the sending.
+	'''
+
+	def __init__(self, limiter, bucket):
+		self.limiter = limiter
+		self.bucket  = bucket
+
+	@property
+	def quota(self):
+		return self.limiter.quota
+
+	@property
+	def sent(self):
+		return self.limiter.sent
+
+	@property
+	def throttles(self):
+		return self.limiter.throttles
+
+	def acquire(self, recipients=1):
+		self.bucket.acquire(recipients)
+		try:
+			self.limiter.acquire(recipients)
+		except SendingLimiter.QuotaExceeded:
+			self.bucket.refund(recipients)
+			raise
+
+	def try_acquire(self, recipients=1):
+		wait = self.bucket.try_acquire(recipients)
+		if wait > 0:
+			return wait
+		try:
+			wait = self.limiter.try_acquire(recipients)
+		except SendingLimiter.QuotaExceeded:
+			self.bucket.refund(recipients)
+			raise
+		if wait > 0:
+			self.bucket.refund(recipients)
+		return wait
+
+	def accepted(self, recipients=1):
+		self.limiter.accepted(recipients)
+
+	def release(self, recipients=1):
+		self.limiter.release(recipients)
+
+	def throttled(self):
+		self.limiter.throttled()
+
+	def close(self):
+		self.limiter._close_share(self)
+
+class ConcurrencyController(object):
+	'''
+		Decides how many messages to send at once. The limit starts small and
+		once per interval it grows as long as there are messages waiting,
+		sending is slower than the target rate and latency is steady. Being
+		throttled or disconnected halves it, at most once per interval.
+		Until that first happens the limit doubles instead of growing by one
+		so large sends get up to speed quickly.
+	'''
+
+	# How often the limit is reconsidered, in seconds
+	_INTERVAL = 1
+
+	# How much slower than the fastest seen sending can get and still be steady
+	_LATENCY_TOLERANCE = 1.5
+
+	# How close to the target rate sending has to get to stop growing
+	_RATE_TOLERANCE = .9
+
+	def __init__(self, target_rate, maximum, start=2, minimum=1):
+		self.target_rate   = float(target_rate)
+		self.maximum       = maximum
+		self.minimum       = minimum
+		self.limit         = max(minimum, min(start, maximum))
+		self._slow_start   = True
+		self._baseline     = None
+		self._sent         = 0
+		self._latency      = 0
+		self._congested    = False
+		self._interval_end = time.time() + self._INTERVAL
+		self._lock         = threading.Lock()
+
+	def sent(self, latency):
+		'''
+			Record a message that took latency seconds to send
+		'''
+		with self._lock:
+			self._sent    += 1
+			self._latency += latency
+
+	def congested(self):
+		'''
+			Record being throttled or disconnected and back off
+		'''
+		with self._lock:
+			if not self._congested:
+				self._congested  = True
+				self._slow_start = False
+				self.limit       = max(self.minimum, self.limit / 2)
+
+	def adjust(self, backlog, now=None):
+		'''
+			Reconsider the limit if the interval is up and return it. backlog
+			is whether there are messages waiting to be sent.
+		'''
+		if now is None:
+			now = time.time()
+		with self._lock:
+			if now < self._interval_end:
+				return self.limit
+
+			rate   = self._sent / (now - self._interval_end + self._INTERVAL)
+			steady = True
+			if self._sent > 0:
+				latency = self._latency / self._sent
+				if self._baseline is not None:
+					steady = latency <= self._baseline * self._LATENCY_TOLERANCE
+				self._baseline = latency if self._baseline is None else min(self._baseline, latency)
+
+			if backlog and steady and not self._congested and rate < self.target_rate * self._RATE_TOLERANCE:
+				self.limit = min(self.maximum, self.limit * 2 if self._slow_start else self.limit + 1)
+
+			self._sent         = 0
+			self._latency      = 0
+			self._congested    = False
+			self._interval_end = now + self._INTERVAL
+			return self.limit
+
+class _Count(object):
+	'''
+		Same interface as multiprocessing.Value for a limiter used by a
+		single process
+	'''
+	def __init__(self, value):
+		self.value = value
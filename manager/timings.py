@@ -0,0 +1,147 @@
+from contextlib import contextmanager
+import bisect
+import json
+import threading
+import time
+
+class StageTimings(object):
+	'''
+		How often each stage of sending an instance happened and how long it
+		took, as a count, a total, a maximum and a histogram of durations.
+		Recording is a lock and a few additions so it is left on all the
+		time. Stages done by many threads at once overlap, so their totals
+		can add up to more than the whole send took.
+	'''
+
+	CONTENT       = 'content'
+	AUDIENCE      = 'audience'
+	ATTRIBUTES    = 'attributes'
+	RENDERING     = 'rendering'
+	SERIALIZATION = 'serialization'
+	THROTTLING    = 'throttling'
+	SMTP          = 'smtp'
+	STATUS        = 'status'
+
+	STAGES = (CONTENT, AUDIENCE, ATTRIBUTES, RENDERING, SERIALIZATION, THROTTLING, SMTP, STATUS)
+
+	LABELS = {
+		CONTENT       : 'Fetching the content',
+		AUDIENCE      : 'Querying the recipients',
+		ATTRIBUTES    : 'Loading recipient attributes',
+		RENDERING     : 'Rendering the html',
+		SERIALIZATION : 'Building the message',
+		THROTTLING    : 'Waiting on the sending rate',
+		SMTP          : 'Sending to Amazon',
+		STATUS        : 'Recording the outcomes',
+	}
+
+	# Upper bounds of the histogram buckets, in seconds. The last bucket is
+	# for anything slower.
+	BUCKETS = (.0001, .001, .005, .01, .05, .1, .5, 1, 5, 10, 60)
+
+	def __init__(self):
+		self._stages = {}
+		self._lock   = threading.Lock()
+
+	def _stage(self, stage):
+		if stage not in self._stages:
+			self._stages[stage] = {'count':0, 'total':0.0, 'max':0.0, 'histogram':[0] * (len(self.BUCKETS) + 1)}
+		return self._stages[stage]
+
+	def record(self, stage, seconds):
+		'''
+			Record one occurrence of stage that took seconds
+		'''
+		bucket = bisect.bisect_left(self.BUCKETS, seconds)
+		with self._lock:
+			counts = self._stage(stage)
+			counts['count'] += 1
+			counts['total'] += seconds
+			counts['max']    = max(counts['max'], seconds)
+			counts['histogram'][bucket] += 1
+
+	@contextmanager
+	def time(self, stage):
+		'''
+			Record how long the block takes as one occurrence of stage
+		'''
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.record(stage, time.time() - start)
+
+	def merge(self, summary):
+		'''
+			Add the timings in summary, e.g. from a worker process or an
+			earlier attempt at the same instance
+		'''
+		with self._lock:
+			for stage, other in summary.items():
+				counts = self._stage(stage)
+				counts['count'] += other['count']
+				counts['total'] += other['total']
+				counts['max']    = max(counts['max'], other['max'])
+				for bucket, count in enumerate(other['histogram'][:len(counts['histogram'])]):
+					counts['histogram'][bucket] += count
+
+	def summary(self):
+		'''
+			The timings as a dict of plain values keyed by stage
+		'''
+		with self._lock:
+			return json.loads(json.dumps(self._stages))
+
+	def dumps(self):
+		return json.dumps(self.summary(), sort_keys=True)
+
+	@classmethod
+	def loads(cls, serialized):
+		timings = cls()
+		if serialized:
+			timings.merge(json.loads(serialized))
+		return timings
+
+	def percentile(self, stage, fraction):
+		'''
+			Roughly how long the fraction (e.g. .95) of the occurrences of stage
+			took at most. It is the upper bound of the histogram bucket the
+			percentile falls in, or the maximum if that is lower.
+		'''
+		counts = self._stages.get(stage)
+		if counts is None or counts['count'] == 0:
+			return None
+		wanted = counts['count'] * fraction
+		seen   = 0
+		for bucket, count in enumerate(counts['histogram']):
+			seen += count
+			if seen >= wanted and bucket < len(self.BUCKETS):
+				return min(self.BUCKETS[bucket], counts['max'])
+		return counts['max']
+
+	def rows(self):
+		'''
+			One dict per stage that happened, in pipeline order, for display.
+			Durations are in milliseconds except the total, which is in
+			seconds.
+		'''
+		rows = []
+		for stage in self.STAGES:
+			counts = self._stages.get(stage)
+			if counts is None or counts['count'] == 0:
+				continue
+			rows.append({
+				'stage' : self.LABELS[stage],
+				'count' : counts['count'],
+				'total' : counts['total'],
+				'mean'  : counts['total'] / counts['count'] * 1000,
+				'median': self.percentile(stage, .5) * 1000,
+				'p95'   : self.percentile(stage, .95) * 1000,
+				'max'   : counts['max'] * 1000,
+			})
+		return rows
+
+	def __str__(self):
+		return ', '.join(
+			'%s %d in %.3fs' % (stage, self._stages[stage]['count'], self._stages[stage]['total'])
+			for stage in self.STAGES if stage in self._stages)
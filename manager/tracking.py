@@ -0,0 +1,457 @@
+from django.conf           import settings
+from django.core           import signals
+from django.db             import connection, transaction
+from django.utils.encoding import iri_to_uri
+from datetime              import datetime
+from manager.models        import Recipient, Instance, URL, URLClick, InstanceOpen
+from util                  import calc_url_mac, calc_link_mac, calc_open_mac
+import collections
+import errno
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import urllib
+import urlparse
+
+log = logging.getLogger(__name__)
+
+class TrackingBuffer(object):
+	'''
+		Write-behind buffer for URL clicks and opens. The tracking views
+		append each one to a file instead of writing it to the database, so
+		the redirect or image goes out straight away. The record-tracking
+		command later consumes the file and inserts everything in it in bulk.
+
+		Each event is one line of JSON appended with a single write, which
+		doesn't interleave with those of other processes. To consume the
+		buffer it is first renamed, so requests start a new one, and then
+		claimed by renaming it again so only one consumer reads it.
+	'''
+
+	# Clicks of links that carry the URL pk are CLICK_URL. CLICK is for
+	# links sent before, which carry the URL itself.
+	CLICK, CLICK_URL, OPEN = 'click', 'url', 'open'
+
+	# Events checked and inserted at a time
+	_BATCH_SIZE = 500
+
+	# Rows per INSERT. SQLite allows at most 999 query parameters.
+	_ROWS_PER_QUERY = 250
+
+	# How long to give requests that opened the buffer just before it was
+	# renamed to finish writing to it
+	_SETTLE = 1
+
+	# A claimed file this old was left behind by a consumer that died
+	_STALE = 600
+
+	def __init__(self, path):
+		self.path = path
+
+	@classmethod
+	def shared(cls):
+		'''
+			The buffer in the SPOOL_FOLDER setting's folder
+		'''
+		folder = getattr(settings, 'SPOOL_FOLDER', os.path.join(settings.PROJECT_FOLDER, 'spool'))
+		return cls(os.path.join(folder, 'tracking'))
+
+	def click(self, recipient_id, instance_id, url, position):
+		self._append([self.CLICK, time.time(), recipient_id, instance_id, position, url])
+
+	def click_url(self, recipient_id, url_id):
+		self._append([self.CLICK_URL, time.time(), recipient_id, url_id])
+
+	def open(self, recipient_id, instance_id):
+		self._append([self.OPEN, time.time(), recipient_id, instance_id])
+
+	def _append(self, event):
+		line = json.dumps(event, separators=(',', ':')) + '\n'
+		try:
+			fd = os.open(self.path + '.events', os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise
+			try:
+				os.makedirs(os.path.dirname(self.path))
+			except OSError, e:
+				# Another request created it first
+				if e.errno != errno.EEXIST:
+					raise
+			fd = os.open(self.path + '.events', os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+		try:
+			os.write(fd, line)
+		finally:
+			os.close(fd)
+
+	def consume(self):
+		'''
+			Insert everything buffered so far. Returns how many clicks and
+			opens were inserted.
+		'''
+		now = time.time()
+		for claimed in glob.glob(self.path + '-*.events.consuming'):
+			if now - os.path.getmtime(claimed) > self._STALE:
+				log.info('Retrying %s' % claimed)
+				os.rename(claimed, claimed[:-len('.consuming')])
+
+		if os.path.exists(self.path + '.events'):
+			os.rename(self.path + '.events', '%s-%.6f.events' % (self.path, now))
+			time.sleep(self._SETTLE)
+
+		clicks, opens = 0, 0
+		for pending in sorted(glob.glob(self.path + '-*.events')):
+			claimed = pending + '.consuming'
+			try:
+				os.rename(pending, claimed)
+			except OSError:
+				# Another consumer got to it first
+				continue
+			# All or nothing, so a file that fails is retried as a whole
+			with transaction.commit_on_success():
+				for batch in self._batches(claimed):
+					batch_clicks, batch_opens = self._insert(batch)
+					clicks += batch_clicks
+					opens  += batch_opens
+			os.remove(claimed)
+		return clicks, opens
+
+	def _batches(self, path):
+		'''
+			The events in the file at path, _BATCH_SIZE at a time
+		'''
+		batch = []
+		with open(path, 'rb') as f:
+			for line in f:
+				try:
+					batch.append(json.loads(line))
+				except ValueError:
+					log.error('Unreadable tracking event: %r' % line)
+					continue
+				if len(batch) == self._BATCH_SIZE:
+					yield batch
+					batch = []
+		if len(batch) > 0:
+			yield batch
+
+	def _insert(self, events):
+		'''
+			Insert the clicks and opens among events. Events for recipients,
+			instances or URLs that don't exist are dropped and opens already
+			recorded aren't recorded again, just like the tracking views used
+			to do. Returns how many clicks and opens were inserted.
+		'''
+		recipient_ids = set(Recipient.objects.filter(pk__in=set(event[2] for event in events)).values_list('pk', flat=True))
+		events        = [event for event in events if event[2] in recipient_ids]
+		instance_ids  = set(Instance.objects.filter(pk__in=set(event[3] for event in events if event[0] != self.CLICK_URL)).values_list('pk', flat=True))
+		click_rows    = []
+
+		url_clicks = [event for event in events if event[0] == self.CLICK_URL]
+		if len(url_clicks) > 0:
+			url_ids = set(URL.objects.filter(pk__in=set(event[3] for event in url_clicks)).values_list('pk', flat=True))
+			for kind, when, recipient_id, url_id in url_clicks:
+				if url_id in url_ids:
+					click_rows.append((recipient_id, url_id, datetime.fromtimestamp(when)))
+
+		clicks = [event for event in events if event[0] == self.CLICK and event[3] in instance_ids]
+		if len(clicks) > 0:
+			urls = {}
+			for url_id, instance_id, name, position in URL.objects.filter(instance__in=set(event[3] for event in clicks)).values_list('pk', 'instance', 'name', 'position'):
+				urls[(instance_id, name, position)] = url_id
+			for kind, when, recipient_id, instance_id, position, url in clicks:
+				url_id = urls.get((instance_id, url, position))
+				if url_id is not None:
+					click_rows.append((recipient_id, url_id, datetime.fromtimestamp(when)))
+
+		# Repeats within the batch are dropped here and opens already recorded
+		# by the unique (instance, recipient) key, keeping the first open
+		opens     = [event for event in events if event[0] == self.OPEN and event[3] in instance_ids]
+		seen      = set()
+		open_rows = []
+		for kind, when, recipient_id, instance_id in opens:
+			if (recipient_id, instance_id) not in seen:
+				seen.add((recipient_id, instance_id))
+				open_rows.append((recipient_id, instance_id, datetime.fromtimestamp(when)))
+
+		clicks = self._bulk_insert(URLClick, ('recipient', 'url', 'when'), click_rows)
+		opens  = self._bulk_insert(InstanceOpen, ('recipient', 'instance', 'when'), open_rows, ignore=True)
+		return clicks, opens
+
+	# How each database inserts rows while skipping the ones that would
+	# break a unique key
+	_INSERT_IGNORE = {
+		'mysql'     : 'INSERT IGNORE INTO %s (%s) VALUES %s',
+		'sqlite'    : 'INSERT OR IGNORE INTO %s (%s) VALUES %s',
+		'postgresql': 'INSERT INTO %s (%s) VALUES %s ON CONFLICT DO NOTHING',
+	}
+
+	def _bulk_insert(self, model, fields, rows, ignore=False):
+		'''
+			Insert rows, the values of fields with a datetime last. With ignore,
+			rows that would break a unique key are skipped. Returns how many
+			were inserted.
+		'''
+		if len(rows) == 0:
+			return 0
+		qn       = connection.ops.quote_name
+		table    = qn(model._meta.db_table)
+		columns  = ', '.join(qn(model._meta.get_field(field).column) for field in fields)
+		sql      = self._INSERT_IGNORE[connection.vendor] if ignore else 'INSERT INTO %s (%s) VALUES %s'
+		cursor   = connection.cursor()
+		inserted = 0
+		for i in xrange(0, len(rows), self._ROWS_PER_QUERY):
+			chunk  = rows[i:i + self._ROWS_PER_QUERY]
+			params = []
+			for row in chunk:
+				params.extend(row[:-1])
+				params.append(connection.ops.value_to_db_datetime(row[-1]))
+			cursor.execute(sql % (table, columns, ', '.join(['(%s, %s, %s)'] * len(chunk))), params)
+			inserted += cursor.rowcount
+		return inserted
+
+class DestinationCache(object):
+	'''
+		Where each URL pk in a tracking link redirects to. The destinations of
+		the most recently clicked URLs are kept in an LRU cache so a click
+		usually takes no query at all. A URL never changes once it is
+		created so nothing has to be invalidated.
+	'''
+
+	_shared      = None
+	_shared_lock = threading.Lock()
+
+	def __init__(self, size=10000):
+		self.size  = size
+		self._urls = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	@classmethod
+	def shared(cls):
+		'''
+			The process wide cache
+		'''
+		with cls._shared_lock:
+			if cls._shared is None:
+				cls._shared = cls()
+			return cls._shared
+
+	def get(self, url_id):
+		'''
+			The destination of the URL with pk url_id, None if there is no
+			such URL
+		'''
+		with self._lock:
+			name = self._urls.pop(url_id, None)
+			if name is not None:
+				# Most recently used go last
+				self._urls[url_id] = name
+				return name
+
+		names = list(URL.objects.filter(pk=url_id).values_list('name', flat=True))
+		if len(names) == 0:
+			return None
+		with self._lock:
+			self._urls[url_id] = names[0]
+			while len(self._urls) > self.size:
+				self._urls.popitem(last=False)
+		return names[0]
+
+class RecentOpens(object):
+	'''
+		The opens this process has buffered most recently, so repeats (e.g.
+		mail clients loading the image again each time the email is shown)
+		are dropped before they reach the buffer or the database. It is an
+		exact set rather than something like a Bloom filter: a false
+		positive would lose a first open. Anything it has forgotten is still
+		recorded only once thanks to the unique (instance, recipient) key.
+	'''
+
+	_shared      = None
+	_shared_lock = threading.Lock()
+
+	def __init__(self, size=100000):
+		self.size   = size
+		self._opens = collections.OrderedDict()
+		self._lock  = threading.Lock()
+
+	@classmethod
+	def shared(cls):
+		'''
+			The process wide filter
+		'''
+		with cls._shared_lock:
+			if cls._shared is None:
+				cls._shared = cls()
+			return cls._shared
+
+	def __contains__(self, key):
+		'''
+			Whether the (recipient pk, instance pk) open was added recently
+		'''
+		with self._lock:
+			if self._opens.pop(key, False):
+				# Most recently used go last
+				self._opens[key] = True
+				return True
+			return False
+
+	def add(self, key):
+		with self._lock:
+			self._opens[key] = True
+			while len(self._opens) > self.size:
+				self._opens.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._opens.clear()
+
+def follow_link(params):
+	'''
+		Where the tracking link with the query parameters params (e.g.
+		request.GET) redirects to, None if nowhere. The click is buffered if
+		its MAC is right. Links carry the pk of the URL (link) or, if they
+		were sent before that, the URL itself.
+	'''
+	link_id      = params.get('link',      None)
+	instance_id  = params.get('instance',  None)
+	url_string   = params.get('url',       None)
+	position     = params.get('position',  None)
+	recipient_id = params.get('recipient', None)
+	mac          = params.get('mac',       None)
+
+	if link_id:
+		try:
+			link_id = int(link_id)
+		except ValueError:
+			return None
+		destination = DestinationCache.shared().get(link_id)
+		if destination is None:
+			return None
+		# No matter what happens, make sure the redirection works
+		try:
+			if recipient_id and mac and mac == calc_link_mac(link_id, recipient_id):
+				TrackingBuffer.shared().click_url(int(recipient_id), link_id)
+				log.debug('url click buffered')
+			else:
+				log.error('wrong mac')
+		except Exception, e:
+			log.error(str(e))
+		return destination
+	elif not url_string:
+		return None
+	else:
+		url_string = urllib.unquote(url_string)
+		# No matter what happens, make sure the redirection works
+		try:
+			if position and recipient_id and mac and instance_id:
+				try:
+					position     = int(position)
+					recipient_id = int(recipient_id)
+					instance_id  = int(instance_id)
+				except ValueError:
+					log.error('value error')
+				else:
+					if mac == calc_url_mac(url_string, position, recipient_id, instance_id):
+						TrackingBuffer.shared().click(recipient_id, instance_id, url_string, position)
+						log.debug('url click buffered')
+					else:
+						log.error('wrong mac')
+			else:
+				log.error('something none')
+		except Exception, e:
+			log.error(str(e))
+		return url_string
+
+def record_open(params):
+	'''
+		Buffer the open in the query parameters params (e.g. request.GET) if
+		its MAC is right and it wasn't buffered recently
+	'''
+	instance_id  = params.get('instance',  None)
+	recipient_id = params.get('recipient', None)
+	mac          = params.get('mac',       None)
+
+	if recipient_id and mac and instance_id is not None:
+		try:
+			instance_id  = int(instance_id)
+			recipient_id = int(recipient_id)
+		except ValueError:
+			# corrupted
+			return
+		if mac == calc_open_mac(recipient_id, instance_id):
+			recent = RecentOpens.shared()
+			if (recipient_id, instance_id) in recent:
+				log.debug('open already buffered')
+				return
+			try:
+				TrackingBuffer.shared().open(recipient_id, instance_id)
+				recent.add((recipient_id, instance_id))
+				log.debug('open buffered')
+			except Exception, e:
+				log.error(str(e))
+
+class TrackingApplication(object):
+	'''
+		WSGI application that serves the open and redirect tracking
+		endpoints without going through Django's request handling: no
+		middleware, sessions, users or URL resolution, just the MAC, the
+		buffer and the response. Anything else is passed on to fallback
+		(e.g. Django's WSGIHandler) or gets a 404 if there is none. See
+		apache/tracking.wsgi.
+	'''
+
+	OPEN_PATH     = '/email/open'
+	REDIRECT_PATH = '/email/redirect'
+
+	# Same as HttpResponseRedirect
+	_ALLOWED_SCHEMES = ('http', 'https', 'ftp')
+
+	def __init__(self, fallback=None):
+		self.fallback = fallback
+
+	def __call__(self, environ, start_response):
+		# When mounted with WSGIScriptAlias(Match) on the endpoints themselves
+		# the path is all in SCRIPT_NAME
+		path = (environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')).rstrip('/')
+		if path.endswith(self.OPEN_PATH):
+			endpoint = self.open
+		elif path.endswith(self.REDIRECT_PATH):
+			endpoint = self.redirect
+		elif self.fallback is not None:
+			return self.fallback(environ, start_response)
+		else:
+			return self._respond(start_response, '404 NOT FOUND')
+
+		# Django's own handlers reset the queries and close the database
+		# connection on these
+		signals.request_started.send(sender=self.__class__)
+		try:
+			return endpoint(dict(urlparse.parse_qsl(environ.get('QUERY_STRING', ''))), start_response)
+		except Exception:
+			log.exception('Unable to serve %s' % path)
+			return self._respond(start_response, '500 INTERNAL SERVER ERROR')
+		finally:
+			signals.request_finished.send(sender=self.__class__)
+
+	def open(self, params, start_response):
+		record_open(params)
+		return self._respond(start_response, '200 OK', settings.DOT, [('Content-Type', 'image/png')])
+
+	def redirect(self, params, start_response):
+		destination = follow_link(params)
+		if destination is None:
+			return self._respond(start_response, '404 NOT FOUND')
+		scheme = urlparse.urlparse(destination).scheme
+		if scheme and scheme not in self._ALLOWED_SCHEMES:
+			log.error('Refusing to redirect to %s' % destination)
+			return self._respond(start_response, '400 BAD REQUEST')
+		return self._respond(start_response, '302 FOUND', headers=[('Location', iri_to_uri(destination))])
+
+	def _respond(self, start_response, status, body='', headers=None):
+		if headers is None:
+			headers = [('Content-Type', 'text/html; charset=utf-8')]
+		start_response(status, headers + [('Content-Length', str(len(body)))])
+		return [body]
@@ -4,16 +4,16 @@ from django.views.generic.list   import ListView
 from django.views.generic.detail import DetailView
 from django.core.urlresolvers    import reverse
 from django.shortcuts            import get_object_or_404
-from manager.models              import Email, RecipientGroup, Instance, Recipient, URL, URLClick, InstanceOpen, RecipientAttribute
+from manager.models              import Email, RecipientGroup, Instance, Recipient, RecipientAttribute
+from manager.tracking            import follow_link, record_open
 from manager.forms               import EmailCreateUpdateForm, RecipientGroupCreateUpdateForm, \
 	RecipientCreateUpdateForm, RecipientAttributeUpdateForm, RecipientAttributeCreateForm, RecipientSearchForm, RecipientSubscriptionsForm
 from django.contrib              import messages
-from django.http                 import HttpResponse, HttpResponseRedirect
-from util                        import calc_url_mac, calc_open_mac, calc_unsubscribe_mac, calc_unsubscribe_mac_old
+from django.http                 import HttpResponse, HttpResponseRedirect, Http404
+from util                        import calc_unsubscribe_mac, calc_unsubscribe_mac_old
 from django.conf                 import settings
 from django.views.generic.simple import direct_to_template
 from django.core.exceptions      import PermissionDenied
-import urllib
 import logging
 
 log = logging.getLogger(__name__)
@@ -346,91 +346,20 @@ class RecipientSubscriptionsUpdateView(UpdateView):
 ##
 def redirect(request):
 	'''
-		Redirects based on URL and records URL click
+		Redirects based on URL and records URL click. The click is buffered
+		and written to the database by the record-tracking command.
+		apache/tracking.wsgi serves this without the rest of Django.
 	'''
-	instance_id   = request.GET.get('instance',  None)
-	url_string    = request.GET.get('url',       None)
-	position      = request.GET.get('position',  None)
-	recipient_id  = request.GET.get('recipient', None)
-	mac           = request.GET.get('mac',       None)
-
-	if not url_string:
-		pass # Where do we go?
-	else:
-		url_string = urllib.unquote(url_string)
-		# No matter what happens, make sure the redirection works
-		try:
-			if position and recipient_id and mac and instance_id:
-				try:
-					position     = int(position)
-					recipient_id = int(recipient_id)
-					instance_id  = int(instance_id)
-				except ValueError:
-					log.error('value error')
-					pass
-				else:
-					if mac == calc_url_mac(url_string, position, recipient_id, instance_id):
-						try:
-							recipient = Recipient.objects.get(id=recipient_id)
-							instance  = Instance.objects.get(id=instance_id)
-							url       = URL.objects.get(name=url_string, position=position, instance=instance)
-						except URL.DoesNotExist:
-							# This should have been created
-							# in the mailer-process command
-							# when this email was sent
-							pass
-						except Recipient.DoesNotExist:
-							# strange
-							log.error('bad recipient')
-							pass
-						except Instance.DoesNotExist:
-							# also strange
-							log.error('bad instance')
-							pass
-						else:
-							url_click = URLClick(recipient=recipient, url=url)
-							url_click.save()
-							log.debug('url click saved')
-					else:
-						log.error('wrong mac')
-			else:
-				log.error('something none')
-		except Exception, e:
-			log.error(str(e))
-			pass
-		return HttpResponseRedirect(url_string)
+	destination = follow_link(request.GET)
+	if destination is None:
+		raise Http404
+	return HttpResponseRedirect(destination)
 
 def instance_open(request):
 	'''
-		Records an email open
+		Records an email open. The open is buffered and written to the
+		database by the record-tracking command. apache/tracking.wsgi serves
+		this without the rest of Django.
 	'''
-	instance_id   = request.GET.get('instance',  None)
-	recipient_id  = request.GET.get('recipient', None)
-	mac           = request.GET.get('mac',       None)
-
-	if recipient_id and mac and instance_id is not None:
-		try:
-			instance_id  = int(instance_id)
-			recipient_id = int(recipient_id)
-		except ValueError:
-			# corrupted
-			pass
-		else:
-			if mac == calc_open_mac(recipient_id, instance_id):
-				try:
-					recipient = Recipient.objects.get(id=recipient_id)
-					instance  = Instance.objects.get(id=instance_id)
-					InstanceOpen.objects.get(recipient=recipient, instance=instance)
-				except Recipient.DoesNotExist:
-					# strange
-					log.error('bad recipient')
-					pass
-				except Instance.DoesNotExist:
-					# also strange
-					log.error('bad instance')
-					pass
-				except InstanceOpen.DoesNotExist:
-					instance_open = InstanceOpen(recipient=recipient, instance=instance)
-					instance_open.save()
-					log.debug('open saved')
+	record_open(request.GET)
 	return HttpResponse(settings.DOT, content_type='image/png')
@@ -2,6 +2,7 @@
 # Django settings for generic project.
 import os
 import sys
+import tempfile
 from django.contrib.messages import constants as message_constants
 
 PROJECT_FOLDER    = os.path.dirname(os.path.abspath(__file__))
@@ -76,6 +77,11 @@ except ImportError:
 		'Ensure settings_local.py exists in project root.'
 	)
 
+# Sending writes to the database from other threads, which would each get
+# a separate, empty in-memory SQLite test database
+for alias, database in DATABASES.items():
+	if database['ENGINE'].endswith('sqlite3') and database.get('TEST_NAME') in (None, '', ':memory:'):
+		database['TEST_NAME'] = os.path.join(tempfile.gettempdir(), 'postmaster-test-%s-%d.db' % (alias, os.getpid()))
 
 TEMPLATE_DEBUG = DEBUG
 TEMPL_FOLDER   = os.path.join(PROJECT_FOLDER, 'templates')
@@ -57,8 +57,17 @@ AMAZON_SMTP = {
 	'port'    : 465,
 	'username': '',
 	'password': '',
-	'quota'   : 500000, # per 24 hours
-	'rate'    : 70 # per second
+	'quota'   : 500000, # recipients per 24 hours
+	'rate'    : 70, # recipients per second
+	# Set to False to use a plain SMTP server (e.g. python -m smtpd) for testing
+	'ssl'     : True,
+	# Connections are closed and replaced after sending this many messages
+	'max_messages': 1000,
+	# SMTP sessions kept open by mailer-process --engine=eventloop
+	'sessions': 200,
+	# Emails with no placeholders, tracking or unsubscribe link are sent to
+	# this many recipients per message. Amazon allows at most 50.
+	'recipients_per_message': 50
 }
 
 # NET Domain LDAP CONFIG
@@ -83,6 +92,13 @@ PROCESSING_INTERVAL_DURATION = (60 * 14) + 59 # 14:59 seconds - 15 minutes becau
 # How long before an email is sent with the previews be sent?
 PREVIEW_LEAD_TIME  = 60 * 60 # 1 hour
 
+# How long fetching the content of an email can take before giving up? In seconds
+CONTENT_TIMEOUT = 60
+
+# Where mailer-process --prerender keeps the messages it renders ahead of
+# sending. Needs room for one copy of each prerendered email per recipient
+SPOOL_FOLDER = os.path.join(PROJECT_FOLDER, 'spool')
+
 # Determines the minimum number of emails that should exist before importing them
 MINIMUM_IMPORT_EMAIL_COUNT = 1000
 
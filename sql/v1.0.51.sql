@@ -0,0 +1,8 @@
+set autocommit=0;
+use postmaster;
+start transaction;
+
+ALTER TABLE `manager_instance` ADD COLUMN `throttle_count` int(10) unsigned NOT NULL DEFAULT '0' AFTER `urls_tracked`;
+ALTER TABLE `manager_instance` ADD COLUMN `send_rate` double NULL DEFAULT NULL AFTER `throttle_count`;
+
+commit;
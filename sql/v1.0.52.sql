@@ -0,0 +1,7 @@
+set autocommit=0;
+use postmaster;
+start transaction;
+
+ALTER TABLE `manager_instance` ADD COLUMN `sent_text` longtext NULL AFTER `sent_html`;
+
+commit;
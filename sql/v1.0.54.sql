@@ -0,0 +1,7 @@
+set autocommit=0;
+use postmaster;
+start transaction;
+
+ALTER TABLE `manager_email` ADD COLUMN `modified` datetime NULL AFTER `preview_recipients`;
+
+commit;
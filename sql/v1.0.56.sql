@@ -0,0 +1,7 @@
+set autocommit=0;
+use postmaster;
+start transaction;
+
+ALTER TABLE `manager_instance` ADD COLUMN `timings` longtext NULL AFTER `prerendered`;
+
+commit;
@@ -0,0 +1,12 @@
+set autocommit=0;
+use postmaster;
+start transaction;
+
+-- Keep only the first open of each instance by each recipient
+DELETE `duplicate` FROM `manager_instanceopen` AS `duplicate` JOIN `manager_instanceopen` AS `first`
+	ON `first`.`instance_id` = `duplicate`.`instance_id` AND `first`.`recipient_id` = `duplicate`.`recipient_id`
+	AND (`first`.`when` < `duplicate`.`when` OR (`first`.`when` = `duplicate`.`when` AND `first`.`id` < `duplicate`.`id`));
+
+ALTER TABLE `manager_instanceopen` ADD UNIQUE KEY `manager_instanceopen_instance_id_recipient_id` (`instance_id`, `recipient_id`);
+
+commit;
@@ -1,13 +1,21 @@
-from django.conf import settings
+from django.conf              import settings
+from django.core.urlresolvers import reverse
 import hmac
 import logging
 import ldap
 import base64
+import re
+import threading
+import urllib
 
 def calc_url_mac(url, position, recipient, instance_id):
 	mash = ''.join([str(url), str(position), str(recipient), str(instance_id)])
 	return hmac.new(settings.SECRET_KEY, mash).hexdigest()
 
+def calc_link_mac(url_id, recipient):
+	mash = ''.join(['link', str(url_id), '-', str(recipient)])
+	return hmac.new(settings.SECRET_KEY, mash).hexdigest()
+
 def calc_open_mac(recipient, instance_id):
 	mash = ''.join([str(recipient), str(instance_id)])
 	return hmac.new(settings.SECRET_KEY, mash).hexdigest()
@@ -20,6 +28,105 @@ def calc_unsubscribe_mac_old(recipient_id, email_id):
 	mash = ''.join([str(recipient_id), str(email_id)])
 	return hmac.new(settings.SECRET_KEY, mash).hexdigest()
 
+class LinkFactory(object):
+	'''
+		Makes the tracking, open and unsubscribe links of an instance. What is
+		the same for every link is worked out once: the base URLs, the query
+		strings as far as they don't depend on the recipient and an HMAC keyed
+		with SECRET_KEY that each MAC is copied from. The links, and their
+		MACs, are the same as those made with calc_link_mac, calc_open_mac and
+		calc_unsubscribe_mac.
+	'''
+
+	# Stand-ins for the recipient and MAC while working out a link. In the
+	# query string they are escaped to %00 and %01, which nothing else in a
+	# link can be.
+	_RECIPIENT, _MAC = '\x00', '\x01'
+	_SLOT_RE         = re.compile('(%00|%01|\x00)')
+
+	# Stand-in for the recipient in the path of the subscriptions URL
+	_PK = 987654321
+
+	_shared      = None
+	_shared_lock = threading.Lock()
+
+	def __init__(self, instance_id=None):
+		self.instance_id = instance_id
+		self._hmac       = hmac.new(settings.SECRET_KEY)
+		self._links      = {}
+
+	@classmethod
+	def shared(cls):
+		'''
+			The process wide factory for links that don't belong to an
+			instance, i.e. unsubscribe links
+		'''
+		with cls._shared_lock:
+			if cls._shared is None:
+				cls._shared = cls()
+			return cls._shared
+
+	def mac(self, *values):
+		'''
+			Same as hmac.new(settings.SECRET_KEY, ''.join(values)).hexdigest()
+		'''
+		mac = self._hmac.copy()
+		mac.update(''.join([str(value) for value in values]))
+		return mac.hexdigest()
+
+	def _compile(self, key, base, params):
+		'''
+			Work out the link for base and params, broken up around the
+			recipient and MAC, and keep it under key
+		'''
+		self._links[key] = self._SLOT_RE.split('?'.join([base, urllib.urlencode(params)]))
+
+	def _fill(self, key, recipient_id, mac):
+		values = {'%00':str(recipient_id), '\x00':str(recipient_id), '%01':mac}
+		return ''.join([values.get(chunk, chunk) for chunk in self._links[key]])
+
+	def tracking_url(self, url, recipient_id):
+		'''
+			URL that records a click of url by a recipient and then redirects to
+			it. It carries the pk of url rather than where it goes. Links sent
+			before carry the url, its position and the instance instead (see
+			calc_url_mac) and still work.
+		'''
+		key = ('url', url.pk)
+		if key not in self._links:
+			self._compile(key, settings.PROJECT_URL + reverse('manager-email-redirect'), {
+				'link'      :url.pk,
+				'recipient' :self._RECIPIENT,
+				'mac'       :self._MAC
+			})
+		return self._fill(key, recipient_id, self.mac('link', url.pk, '-', recipient_id))
+
+	def open_url(self, recipient_id):
+		'''
+			URL of the image that records a recipient opening the instance
+		'''
+		if 'open' not in self._links:
+			self._compile('open', settings.PROJECT_URL + reverse('manager-email-open'), {
+				'recipient':self._RECIPIENT,
+				'instance' :self.instance_id,
+				'mac'      :self._MAC
+			})
+		return self._fill('open', recipient_id, self.mac(recipient_id, self.instance_id))
+
+	def unsubscribe_url(self, recipient_id):
+		'''
+			URL of the page where a recipient manages their subscriptions
+		'''
+		if 'unsubscribe' not in self._links:
+			# Use prefix='/' for reverse here instead of relying on get_script_prefix inside of
+			# reverse. This is because this method is called by management commands which
+			# have no concept of get_script_prefix().
+			path = reverse('manager-recipient-subscriptions', kwargs={'pk':self._PK}, prefix='/')
+			self._compile('unsubscribe', settings.PROJECT_URL + path.replace(str(self._PK), self._RECIPIENT), {
+				'mac':self._MAC
+			})
+		return self._fill('unsubscribe', recipient_id, self.mac(recipient_id))
+
 class LDAPHelper(object):
 		
 	class LDAPHelperException(Exception):